@@ -0,0 +1,388 @@
+"""
+Agent for file jobs on the acquisition computer, for setups where the controller runs on another computer than
+SpikeGLX. The controller cant reach the recorded files there, so it sends compress, verify, copy and purge jobs to the
+agent, which runs them next to the data and reports progress back. Jobs are json lines as in socket_utils and run one
+after the other in a worker thread, the I/O budget follows the recording state of the local SpikeGLX.
+
+Run the agent on the acquisition computer with: python -m spikeGLX_remote.acq_agent <data folder>
+"""
+import argparse
+import logging
+import shutil
+import socket
+import threading
+import time
+import uuid
+from ctypes import byref, c_bool
+from pathlib import Path
+from queue import Queue
+
+from spikeGLX_remote.compress_utils import compress_folder, estimate_compression
+from spikeGLX_remote.file_utils import CHUNK_SIZE, PART_SIZE, IOThrottle, copy_folder, summarize_sync, verify_recording
+from spikeGLX_remote.socket_utils import SocketMessage, MessageType, MessageStatus
+from spikeGLX_remote.transfer import TransferSender, _socket_comm
+
+log = logging.getLogger('acq_agent')
+
+AGENT_PORT = 8891
+
+
+class AcqAgent:
+    """
+    Serves one controller connection at a time and accepts the next one after it disconnected. Jobs are queued and run
+    in order by a worker thread, every job is answered with job_started, agent_progress messages and finally job_ok
+    with its result or job_fail with the error. Status requests are answered right away.
+    Only folders below root can be compressed, verified, copied or purged.
+
+    :param root: Path: data folder of SpikeGLX
+    :param host: str: address to listen on
+    :param port: int: port to listen on
+    :param budget_mbps: float: MB/s of the jobs while SpikeGLX saves data, None for no limit
+    :param budget_iops: float: IO operations/s of the jobs while SpikeGLX saves data, None for no limit
+    :param pause_while_recording: bool: pause the jobs completely while SpikeGLX saves data
+    :param sglx_port: int: port of the local SpikeGLX to ask for the recording state, None to always apply the
+        recording budget
+
+    :parameter throttle: IOThrottle: I/O budget of the jobs
+    :parameter current: dict: job currently running, None if idle
+    """
+
+    def __init__(self, root: Path, host: str = '0.0.0.0', port: int = AGENT_PORT, budget_mbps: [float, None] = 50,
+                 budget_iops: [float, None] = 100, pause_while_recording: bool = False,
+                 sglx_port: [int, None] = 4142):
+        self.root = Path(root).resolve()
+        self.host = host
+        self.port = port
+        self.budget_mbps = budget_mbps
+        self.budget_iops = budget_iops
+        self.pause_while_recording = pause_while_recording
+        self.sglx_port = sglx_port
+        self.throttle = IOThrottle(self.budget)
+        self.current = None
+        self._jobs = Queue()
+        self._comm = None
+        self._send_lock = threading.Lock()  # replies come from the connection and the worker thread
+        self._stop_event = threading.Event()
+        self._sglx_pool = None
+        self._sock = None
+        self._threads = []
+
+    def is_saving(self) -> bool:
+        """
+        asks the local SpikeGLX if it saves data, assumes it does if SpikeGLX cant be reached
+        :return: bool
+        """
+        if self.sglx_port is None:
+            return True
+        try:
+            if self._sglx_pool is None:  # the api library is only loaded if the agent asks SpikeGLX
+                from spikeGLX_remote.sglx_pool import SglxHandlePool
+                self._sglx_pool = SglxHandlePool('localhost', self.sglx_port, size=1)
+            if not self._sglx_pool.connect():
+                return True
+            import spikeGLX_remote.sglx as sglx
+            with self._sglx_pool.checkout() as hSglx:
+                if hSglx is None:
+                    return True
+                saving = c_bool()
+                if not sglx.c_sglx_isSaving(byref(saving), hSglx):
+                    return True
+                return saving.value
+        except OSError as e:  # SpikeGLX api library not available
+            log.warning(f"Cant ask SpikeGLX for the recording state, assuming it records: {e}")
+            self.sglx_port = None
+            return True
+
+    def budget(self) -> (float, float):
+        """
+        I/O budget of the jobs, see IOThrottle
+        :return: (bytes_per_s, ops_per_s), None for no limit, 0 for pause
+        """
+        if not self.is_saving():
+            return None, None
+        if self.pause_while_recording:
+            return 0, 0
+        return None if self.budget_mbps is None else self.budget_mbps * 2**20, self.budget_iops
+
+    def start(self):
+        """starts listening for the controller and the worker thread"""
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.host, self.port))
+        self._sock.listen()
+        self._sock.settimeout(0.5)
+        self._stop_event.clear()
+        self._threads = [threading.Thread(target=self._serve, daemon=True),
+                         threading.Thread(target=self._work, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        log.info(f"Agent for {self.root} listening on port {self.port}")
+
+    def stop(self):
+        """stops serving, a running job is finished first"""
+        self._stop_event.set()
+        self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._sock.close()
+
+    def _serve(self):
+        while not self._stop_event.is_set():
+            try:
+                conn, addr = self._sock.accept()
+            except socket.timeout:
+                continue
+            log.info(f"Controller connected from {addr}")
+            conn.settimeout(1.)
+            self._comm = _socket_comm(conn, 'server')
+            while not self._stop_event.is_set() and self._comm.connected:
+                message = self._comm.read_json_message_fast_linebreak()
+                if not message:
+                    continue
+                if message['type'] == MessageType.disconnected.value:
+                    break
+                if message['type'] != MessageType.agent_job.value:
+                    self._send({'type': MessageType.response.value, 'status': MessageStatus.error.value})
+                elif message.get('job') == 'status':
+                    self._send({'type': MessageType.response.value, 'status': MessageStatus.job_ok.value,
+                                'job_id': message.get('job_id'),
+                                'result': {'current': self.current, 'queued': self._jobs.qsize(),
+                                           'paused': self.throttle.paused}})
+                else:
+                    self._jobs.put(message)
+            with self._send_lock:
+                self._comm.close_socket()
+                self._comm = None
+            log.info(f"Controller {addr} disconnected")
+
+    def _send(self, message: dict):
+        with self._send_lock:
+            if self._comm is not None and self._comm.connected:
+                self._comm.send_json_message(message)
+
+    def _reply(self, job: dict, status: MessageStatus, **info):
+        self._send({'type': MessageType.response.value, 'status': status.value, 'job_id': job.get('job_id'), **info})
+
+    def _work(self):
+        while not self._stop_event.is_set():
+            job = self._jobs.get()
+            if job is None:
+                continue
+            self.current = {'job': job.get('job'), 'job_id': job.get('job_id'), 'fraction': 0.}
+            self._reply(job, MessageStatus.job_started)
+            log.info(f"Running job {job.get('job')} {job.get('job_id')}")
+            try:
+                result = self.run_job(job)
+            except (OSError, ValueError, KeyError) as e:
+                log.error(f"Job {job.get('job')} {job.get('job_id')} failed: {e}")
+                self.current = None
+                self._reply(job, MessageStatus.job_fail, error=str(e))
+            except Exception as e:  # a bug in a job must not stop the worker, the queued jobs would hang
+                log.error(f"Job {job.get('job')} {job.get('job_id')} failed unexpectedly: {e!r}", exc_info=True)
+                self.current = None
+                self._reply(job, MessageStatus.job_fail, error=repr(e))
+            else:
+                self.current = None
+                self._reply(job, MessageStatus.job_ok, result=result)
+
+    def _progress(self, job: dict):
+        """returns the progress callback of a job, it forwards fraction and detail to the controller"""
+        def progress(fraction: float, detail: str = ''):
+            self.current['fraction'] = fraction
+            self._send({'type': MessageType.agent_progress.value, 'job_id': job.get('job_id'),
+                        'fraction': fraction, 'detail': detail})
+        return progress
+
+    def _folder(self, job: dict, key: str = 'folder') -> Path:
+        folder = Path(job[key]).resolve()
+        if self.root not in folder.parents:
+            raise ValueError(f"{folder} is outside of the data folder {self.root}")
+        if not folder.exists():
+            raise FileNotFoundError(f"{folder} not found")
+        return folder
+
+    def run_job(self, job: dict) -> dict:
+        """
+        runs one job, raises OSError, ValueError or KeyError if it fails
+        :param job: dict: agent_job message with the job name and its parameters
+        :return: dict: result of the job, sent back with job_ok
+        """
+        name = job['job']
+        progress = self._progress(job)
+        chunk_size = job.get('chunk_size', CHUNK_SIZE)
+        if name == 'compress':
+            out_folder = compress_folder(self._folder(job), job['compression'], throttle=self.throttle,
+                                         progress=progress)
+            if out_folder is None:
+                raise OSError(f"Compression of {job['folder']} failed")
+            return {'path': str(out_folder)}
+        if name == 'estimate':
+            return estimate_compression(self._folder(job), job['compression'])
+        if name == 'verify':
+            return {'failed': verify_recording(self._folder(job), self.throttle, chunk_size, progress=progress)}
+        if name == 'copy':
+            src = self._folder(job, 'src')
+            flat = job.get('flat', True)
+            dst = Path(job['dst'])
+            if flat and not dst.exists():
+                raise FileNotFoundError(f"Session path {dst} doesnt exist")
+            reports = copy_folder(src, dst, flat=flat, sync=job.get('sync', True), throttle=self.throttle,
+                                  chunk_size=chunk_size, n_workers=job.get('n_workers', 1),
+                                  part_size=job.get('part_size', PART_SIZE), dry_run=job.get('dry_run', False),
+                                  progress=progress)
+            return {'reports': reports, 'summary': None if reports is None else summarize_sync(reports)}
+        if name == 'upload':
+            flat = job.get('flat', True)
+            sender = TransferSender(job['host'], job['port'], n_connections=job.get('n_workers', 4),
+                                    throttle=self.throttle)
+            report = sender.send_folder(self._folder(job, 'src'), job['session'], flat=flat, mkdir=not flat)
+            if report['failed']:
+                raise OSError(f"Upload of {report['failed']} failed")
+            return report
+        if name == 'purge':
+            folder = self._folder(job)
+            shutil.rmtree(folder)
+            log.info(f"Purged {folder}")
+            return {'purged': str(folder)}
+        raise ValueError(f"Unknown job {name}")
+
+
+class AgentClient:
+    """
+    Connection of the controller to an AcqAgent. Jobs can be submitted from several threads, the replies are sorted
+    to the jobs by a reader thread.
+
+    :param host: str: address of the acquisition computer
+    :param port: int: port of the agent
+    :param timeout: float: s to wait for connecting
+    :param on_progress: callable(job, fraction, detail) called with the progress messages of the agent
+
+    :parameter connected: bool: True while connected to the agent
+    """
+
+    def __init__(self, host: str, port: int = AGENT_PORT, timeout: float = 5., on_progress=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.on_progress = on_progress
+        self.connected = False
+        self._comm = None
+        self._jobs = {}  # job_id: dict with the job name, its final reply and an event set on the reply
+        self._lock = threading.Lock()
+        self._reader = None
+
+    def connect(self) -> bool:
+        """
+        connects to the agent if not connected yet
+        :return: bool if connected
+        """
+        with self._lock:
+            if self.connected:
+                return True
+            try:
+                sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            except OSError as e:
+                log.error(f"Cant connect to the acquisition agent at {self.host}:{self.port}: {e}")
+                return False
+            sock.settimeout(1.)
+            self._comm = _socket_comm(sock, 'client')
+            self.connected = True
+            self._reader = threading.Thread(target=self._read, daemon=True)
+            self._reader.start()
+            return True
+
+    def close(self):
+        """tells the agent that the connection ends and closes it"""
+        with self._lock:
+            if not self.connected:
+                return
+            self.connected = False
+            self._reader.join()  # stops within the socket timeout
+            try:
+                self._comm.send_json_message(SocketMessage.client_disconnected)
+            finally:
+                self._comm.close_socket()
+
+    def _read(self):
+        while self.connected and self._comm.connected:
+            message = self._comm.read_json_message_fast_linebreak()
+            if not message:
+                continue
+            if message['type'] == MessageType.disconnected.value:
+                break
+            job = self._jobs.get(message.get('job_id'))
+            if job is None:
+                continue
+            if message['type'] == MessageType.agent_progress.value:
+                if self.on_progress is not None:
+                    self.on_progress(job['job'], message['fraction'], message.get('detail', ''))
+            elif message.get('status') in (MessageStatus.job_ok.value, MessageStatus.job_fail.value):
+                job['reply'] = message
+                job['done'].set()
+        self.connected = False
+        for job in list(self._jobs.values()):  # wake up everyone waiting, their jobs are lost
+            job['done'].set()
+
+    def submit(self, job: str, **params) -> str:
+        """
+        sends a job to the agent
+        :param job: str: compress, estimate, verify, copy, upload, purge or status
+        :param params: parameters of the job, see AcqAgent.run_job
+        :return: str: id of the job
+        """
+        if not self.connect():
+            raise ConnectionError(f"Acquisition agent at {self.host}:{self.port} not reachable")
+        job_id = uuid.uuid4().hex[:12]  # unique across reconnects, the agent may still run jobs of before
+        self._jobs[job_id] = {'job': job, 'reply': None, 'done': threading.Event()}
+        with self._lock:
+            self._comm.send_json_message({'type': MessageType.agent_job.value, 'job': job, 'job_id': job_id,
+                                          **params})
+        return job_id
+
+    def wait(self, job_id: str, timeout: [float, None] = None) -> dict:
+        """
+        waits for a job to finish
+        :param job_id: str: id returned by submit
+        :param timeout: float: s to wait, None to wait until the job is done
+        :return: dict: result of the job
+        """
+        job = self._jobs[job_id]
+        if not job['done'].wait(timeout):
+            raise TimeoutError(f"Job {job['job']} {job_id} of the acquisition agent timed out")
+        del self._jobs[job_id]
+        reply = job['reply']
+        if reply is None:
+            raise ConnectionError("Connection to the acquisition agent lost")
+        if reply['status'] != MessageStatus.job_ok.value:
+            raise IOError(f"Job {job['job']} failed on the acquisition agent: {reply.get('error')}")
+        return reply.get('result')
+
+    def run(self, job: str, timeout: [float, None] = None, **params) -> dict:
+        """
+        sends a job and waits for its result, raises IOError if it failed
+        :param job: str: name of the job, see submit
+        :param timeout: float: s to wait, None to wait until the job is done
+        :return: dict: result of the job
+        """
+        return self.wait(self.submit(job, **params), timeout)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Agent running file jobs of a remote controller on the acquisition '
+                                                 'computer')
+    parser.add_argument('root', type=Path, help='data folder of SpikeGLX')
+    parser.add_argument('--port', type=int, default=AGENT_PORT)
+    parser.add_argument('--budget_mbps', type=float, default=50, help='MB/s while SpikeGLX saves data')
+    parser.add_argument('--budget_iops', type=float, default=100, help='IO operations/s while SpikeGLX saves data')
+    parser.add_argument('--pause', action='store_true', help='pause jobs while SpikeGLX saves data')
+    parser.add_argument('--sglx_port', type=int, default=4142, help='port of the local SpikeGLX, 0 if not reachable')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    agent = AcqAgent(args.root, port=args.port, budget_mbps=args.budget_mbps, budget_iops=args.budget_iops,
+                     pause_while_recording=args.pause, sglx_port=args.sglx_port or None)
+    agent.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        agent.stop()
@@ -0,0 +1,82 @@
+"""
+Batches of control commands executed in one pass, e.g. setting the session id, applying run parameters, starting the
+run and the recording with a single message instead of one round-trip per command. Every step that changes something
+leaves an undo, if a step fails the completed steps are undone in reverse order, so a failed batch leaves SpikeGLX as
+it was before.
+"""
+import logging
+import time
+from ctypes import byref, c_int
+
+import spikeGLX_remote.sglx as sglx
+
+log = logging.getLogger('batch')
+
+
+def get_params(hSglx) -> [dict, None]:
+    """
+    :param hSglx: handle to the spikeglx api connection
+    :return: dict: run parameters of SpikeGLX as strings, None on error
+    """
+    n_val, length = c_int(), c_int()
+    if not sglx.c_sglx_getParams(byref(n_val), hSglx):
+        return None
+    params = {}
+    for i in range(n_val.value):
+        key, _, value = sglx.c_sglx_getstr(byref(length), hSglx, i).decode().partition('=')
+        params[key] = value
+    return params
+
+
+def set_params(hSglx, params: dict) -> bool:
+    """
+    sets a subset of the run parameters of SpikeGLX, only possible while no run is in progress
+    :param hSglx: handle to the spikeglx api connection
+    :param params: dict: values per key of the [DAQSettings]
+    :return: bool if set
+    """
+    sglx.c_sglx_setkv(hSglx, b'', b'')
+    for key, value in params.items():
+        if isinstance(value, bool):
+            value = str(value).lower()
+        sglx.c_sglx_setkv(hSglx, str(key).encode(), str(value).encode())
+    return sglx.c_sglx_setKVParams(hSglx)
+
+
+def run_batch(steps: list, handlers: dict) -> dict:
+    """
+    runs the steps of a batch in order and undoes the completed ones if a step fails
+    :param steps: list of dicts with the command name under 'cmd' and its arguments
+    :param handlers: dict: per command name a callable(step) returning (ok, undo, info) with undo a callable
+        reverting the step and returning bool if it did, or None, and info a dict added to the result of the step
+    :return: dict with ok, the results of the steps run with cmd, ok, ms and info, failed_step (index, None if all
+        succeeded) and rolled_back (commands undone)
+    """
+    results, undos = [], []
+    report = {'ok': True, 'steps': results, 'failed_step': None, 'rolled_back': []}
+    for index, step in enumerate(steps):
+        command = step.get('cmd')
+        t_start = time.perf_counter()
+        handler = handlers.get(command)
+        if handler is None:
+            ok, undo, info = False, None, {'error': f"unknown command {command}"}
+        else:
+            try:
+                ok, undo, info = handler(step)
+            except (KeyError, TypeError, ValueError) as e:  # malformed step
+                ok, undo, info = False, None, {'error': f"{type(e).__name__}: {e}"}
+        results.append({'cmd': command, 'ok': ok, 'ms': round((time.perf_counter() - t_start) * 1000, 3), **info})
+        if not ok:
+            report['ok'] = False
+            report['failed_step'] = index
+            log.error(f"Batch step {index} {command} failed, rolling back")
+            break
+        if undo is not None:
+            undos.append((command, undo))
+    if not report['ok']:
+        for command, undo in reversed(undos):
+            if undo():
+                report['rolled_back'].append(command)
+            else:
+                log.error(f"Cant undo {command}")
+    return report
@@ -0,0 +1,389 @@
+"""
+Client library for task controllers talking to the SpikeGLX remote controller.
+Every request gets a request id and an awaitable reply, several requests can be in flight at once. Replies are matched
+by the echoed request id, or, by a controller that does not echo request ids, in order to the oldest request they can
+answer. Messages answering no request, e.g. the disk_low warning, go to the on_status callback. A lost connection is
+re-established in the background, requests in flight fail with ConnectionError. Both sides send heartbeats, a
+controller that sends none for heartbeat_timeout counts as lost even if the link dropped silently.
+
+ControllerClient is the asyncio client, SyncControllerClient runs it in a background thread for blocking code.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import threading
+import time
+
+from spikeGLX_remote.socket_utils import SocketMessage, MessageType, MessageStatus
+
+log = logging.getLogger('client')
+
+CONTROLLER_PORT = 8882
+
+# statuses that answer a request, per message type, for matching replies of controllers not echoing request ids
+REPLY_STATUSES = {
+    MessageType.start_video_rec.value: (MessageStatus.recording_ok.value, MessageStatus.recording_fail.value,
+                                        MessageStatus.error.value),
+    MessageType.start_video_view.value: (MessageStatus.viewing_ok.value, MessageStatus.error.value),
+    MessageType.stop_video.value: (MessageStatus.stop_ok.value, MessageStatus.error.value),
+    MessageType.poll_status.value: (MessageStatus.ready.value, MessageStatus.viewing.value,
+                                    MessageStatus.recording.value, MessageStatus.error.value),
+    MessageType.prepare_rec.value: (MessageStatus.prepare_ok.value, MessageStatus.prepare_fail.value),
+    MessageType.copy_files.value: (MessageStatus.copy_ok.value, MessageStatus.copy_fail.value),
+    MessageType.map_samples.value: (MessageStatus.map_ok.value, MessageStatus.map_fail.value),
+    MessageType.trial_plan.value: (MessageStatus.trial_plan_ok.value, MessageStatus.trial_fail.value),
+    MessageType.trial_start.value: (MessageStatus.trial_start_ok.value, MessageStatus.trial_fail.value),
+    MessageType.trial_end.value: (MessageStatus.trial_end_ok.value, MessageStatus.trial_fail.value),
+    MessageType.list_sessions.value: (MessageStatus.sessions_ok.value, MessageStatus.sessions_fail.value),
+    MessageType.disk_forecast.value: (MessageStatus.forecast_ok.value, MessageStatus.forecast_fail.value),
+    MessageType.batch.value: (MessageStatus.batch_ok.value, MessageStatus.batch_fail.value),
+}
+
+
+class ControllerClient:
+    """
+    asyncio client of the SpikeGLX remote controller
+
+    :param host: str: address of the controller
+    :param port: int: port of the controller
+    :param timeout: float: s to wait for a reply by default
+    :param reconnect: bool: re-establish a lost connection in the background
+    :param reconnect_interval: float: s between connection attempts
+    :param on_status: callable(message) for messages answering no request
+    :param heartbeat_interval: float: s between heartbeats to the controller, None to send none
+    :param heartbeat_timeout: float: s without data from a heartbeating controller until its connection counts as lost
+    :param unix_path: str: Unix domain socket of a controller on the same computer (REMOTE_UNIX_SOCKET), host and
+        port are ignored then
+
+    :parameter messages: SocketMessage: message templates, session_id and session_path set there are used by the
+        request methods
+    """
+
+    def __init__(self, host: str = 'localhost', port: int = CONTROLLER_PORT, timeout: float = 5.,
+                 reconnect: bool = True, reconnect_interval: float = 1., on_status=None,
+                 heartbeat_interval: [float, None] = 1., heartbeat_timeout: float = 5.,
+                 unix_path: [str, None] = None):
+        self.host = host
+        self.port = port
+        self.unix_path = unix_path
+        self.timeout = timeout
+        self.reconnect = reconnect
+        self.reconnect_interval = reconnect_interval
+        self.on_status = on_status
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.messages = SocketMessage()
+        self._reader = None
+        self._writer = None
+        self._connected = asyncio.Event()
+        self._pending = {}  # (message type, future) per request id, in order of sending
+        self._ids = itertools.count(1)
+        self._echoes_ids = False  # the controller echoes request ids, unmatched replies are status messages
+        self._read_task = None
+        self._heartbeat_task = None
+        self._last_received = time.monotonic()
+        self._peer_heartbeats = False  # the controller sends heartbeats, silence means it is lost
+        self._closing = False
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    @property
+    def address(self) -> str:
+        return self.unix_path if self.unix_path is not None else f"{self.host}:{self.port}"
+
+    async def connect(self):
+        """connects to the controller and starts reading its messages, raises OSError if not reachable"""
+        self._closing = False
+        if self.unix_path is not None:
+            self._reader, self._writer = await asyncio.open_unix_connection(self.unix_path)
+        else:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._connected.set()
+        self._last_received = time.monotonic()
+        self._peer_heartbeats = False
+        self._read_task = asyncio.create_task(self._read())
+        if self.heartbeat_interval:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        log.info(f"Connected to the controller at {self.address}")
+
+    async def close(self):
+        """tells the controller that the client disconnects and closes the connection"""
+        self._closing = True
+        if self.connected:
+            try:
+                await self._write(SocketMessage.client_disconnected)
+            except OSError:
+                pass
+            self._connected.clear()
+            self._writer.close()
+        for task in (self._read_task, self._heartbeat_task):
+            if task is not None:
+                task.cancel()
+        self._fail_pending(ConnectionError("Client closed"))
+
+    async def _write(self, message: dict):
+        self._writer.write(json.dumps(message).encode() + b'\n')
+        await self._writer.drain()
+
+    async def _read(self):
+        while True:
+            try:
+                line = await self._reader.readline()
+            except (OSError, asyncio.IncompleteReadError):
+                line = b''
+            if not line:
+                break
+            self._last_received = time.monotonic()
+            try:
+                message = json.loads(line.decode())
+            except json.JSONDecodeError:
+                log.error(f"Cant decode message {line}")
+                continue
+            self._dispatch(message)
+        self._connected.clear()
+        self._fail_pending(ConnectionError("Connection to the controller lost"))
+        if not self._closing:
+            log.warning("Connection to the controller lost")
+            if self.reconnect:
+                asyncio.create_task(self._reconnect())
+
+    async def _heartbeat(self):
+        """sends heartbeats and aborts the connection if a heartbeating controller went silent"""
+        while self.connected:
+            await asyncio.sleep(self.heartbeat_interval)
+            if not self.connected:
+                return
+            if self._peer_heartbeats and time.monotonic() - self._last_received > self.heartbeat_timeout:
+                log.warning(f"No heartbeat from the controller for {self.heartbeat_timeout}s")
+                self._writer.transport.abort()  # ends _read, which reconnects
+                return
+            try:
+                await self._write(SocketMessage.heartbeat)
+            except OSError:
+                return
+
+    async def _reconnect(self):
+        while not self._closing:
+            await asyncio.sleep(self.reconnect_interval)
+            try:
+                await self.connect()
+                return
+            except OSError as e:
+                log.debug(f"Reconnecting failed: {e}")
+
+    def _dispatch(self, message: dict):
+        """resolves the request a message answers, or hands it to on_status"""
+        if message['type'] == MessageType.heartbeat.value:
+            self._peer_heartbeats = True
+            return
+        request_id = message.get('request_id')
+        if request_id is not None:
+            self._echoes_ids = True
+            entry = self._pending.pop(request_id, None)
+        else:
+            entry = None
+            if not self._echoes_ids:  # oldest request this message can answer
+                for pending_id, (message_type, _) in self._pending.items():
+                    if message.get('status') in REPLY_STATUSES.get(message_type, ()):
+                        entry = self._pending.pop(pending_id)
+                        break
+        if entry is not None:
+            if not entry[1].done():
+                entry[1].set_result(message)
+        elif message['type'] == MessageType.disconnected.value:
+            log.info("Controller closed the connection")
+        elif self.on_status is not None:
+            self.on_status(message)
+        else:
+            log.debug(f"Message answering no request: {message}")
+
+    def _fail_pending(self, error: Exception):
+        pending, self._pending = self._pending, {}
+        for _, future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def send(self, message: dict) -> int:
+        """
+        sends a message without waiting for a reply, e.g. for commands the controller does not answer
+        :param message: dict: message of SocketMessage type
+        :return: int: request id of the message
+        """
+        if not self.connected:
+            try:
+                await asyncio.wait_for(self._connected.wait(), self.timeout)
+            except asyncio.TimeoutError:
+                raise ConnectionError(f"Controller at {self.address} not connected")
+        request_id = next(self._ids)
+        await self._write({**message, 'request_id': request_id})
+        return request_id
+
+    async def request(self, message: dict, timeout: [float, None] = None) -> dict:
+        """
+        sends a message and waits for its reply, other requests may be in flight meanwhile
+        :param message: dict: message of SocketMessage type
+        :param timeout: float: s to wait for the reply, default timeout if None
+        :return: dict: reply
+        """
+        future = asyncio.get_running_loop().create_future()
+        request_id = next(self._ids)
+        self._pending[request_id] = (message['type'], future)
+        try:
+            if not self.connected:
+                await asyncio.wait_for(self._connected.wait(), timeout or self.timeout)
+            await self._write({**message, 'request_id': request_id})
+            return await asyncio.wait_for(future, timeout or self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"No reply to {message['type']} within {timeout or self.timeout}s")
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def poll_status(self) -> str:
+        """:return: str: status of the controller, e.g. ready, viewing or recording"""
+        return (await self.request(self.messages.poll_status))['status']
+
+    async def start_viewing(self, session_id: [str, None] = None, timeout: [float, None] = None) -> dict:
+        """starts the run, session_id defaults to messages.session_id"""
+        return await self.request({**self.messages.view_spike_glx, **self._session(session_id)}, timeout)
+
+    async def prepare_recording(self, session_id: [str, None] = None, session_path: [str, None] = None,
+                                timeout: [float, None] = None) -> dict:
+        """arms the next recording, see SpikeGLX_Controller.prepare_recording"""
+        return await self.request({**self.messages.prepare_rec, **self._session(session_id, session_path)}, timeout)
+
+    async def start_recording(self, session_id: [str, None] = None, session_path: [str, None] = None,
+                              timeout: [float, None] = None) -> dict:
+        """starts recording, the reply carries the latencies and the sync stamp of the start"""
+        return await self.request({**self.messages.start_spike_glx, **self._session(session_id, session_path)},
+                                  timeout)
+
+    async def stop_recording(self, timeout: [float, None] = None) -> dict:
+        return await self.request(self.messages.stop_spike_glx, timeout)
+
+    async def plan_trials(self, session_id: [str, None] = None, n_trials: [int, None] = None, g_index: int = 0,
+                          session_path: [str, None] = None, timeout: [float, None] = None) -> dict:
+        return await self.request({**self.messages.trial_plan, **self._session(session_id, session_path),
+                                   'n_trials': n_trials, 'g_index': g_index}, timeout)
+
+    async def start_trial(self, timeout: [float, None] = None) -> dict:
+        return await self.request(self.messages.trial_start, timeout)
+
+    async def end_trial(self, timeout: [float, None] = None) -> dict:
+        return await self.request(self.messages.trial_end, timeout)
+
+    async def map_samples(self, samples: list, src: str = 'nidq', dst: str = 'imec0',
+                          timeout: [float, None] = None) -> dict:
+        return await self.request({**self.messages.map_samples, 'samples': list(samples), 'src': src, 'dst': dst},
+                                  timeout)
+
+    async def copy_files(self, session_path: [str, None] = None, wait: bool = True,
+                         timeout: [float, None] = None) -> [dict, None]:
+        """
+        copies or lists the recorded files for copying, depending on COPY_DIRECT of the controller
+        :param wait: bool: wait for the reply, only sent with COPY_DIRECT or if the files were replicated already
+        """
+        message = {**self.messages.copy_files, **self._session(None, session_path)}
+        if not wait:
+            await self.send(message)
+            return None
+        return await self.request(message, timeout)
+
+    async def purge_files(self):
+        """deletes the recorded files, answered only on failure"""
+        await self.send(self.messages.purge_files)
+
+    async def list_sessions(self, timeout: [float, None] = None, **filters) -> list:
+        """:return: list of the sessions of the session index, see SocketMessage.list_sessions for the filters"""
+        reply = await self.request({**self.messages.list_sessions, **filters}, timeout)
+        if reply['status'] != MessageStatus.sessions_ok.value:
+            raise IOError("Listing the sessions failed on the controller")
+        return reply['sessions']
+
+    async def disk_forecast(self, timeout: [float, None] = None) -> dict:
+        return await self.request(self.messages.disk_forecast, timeout)
+
+    async def batch(self, steps: list, timeout: [float, None] = None) -> dict:
+        """
+        runs several commands in one round-trip, e.g. [{'cmd': 'session_id', 'session_id': 'Mouse1'},
+        {'cmd': 'start_viewing'}, {'cmd': 'start_rec'}]
+        :param steps: list of dicts with the command under 'cmd' and its arguments
+        :return: dict: combined reply with ok, per step its result and duration in ms, failed_step and rolled_back
+        """
+        return await self.request({**self.messages.batch, 'steps': list(steps)}, timeout)
+
+    def _session(self, session_id: [str, None], session_path: [str, None] = None) -> dict:
+        fields = {'session_id': session_id or self.messages.session_id}
+        if session_path is not None:
+            fields['session_path'] = str(session_path)
+        return fields
+
+
+class SyncControllerClient:
+    """
+    Blocking wrapper of ControllerClient running its event loop in a background thread. Every request method of
+    ControllerClient is available with the same arguments, submit sends a request without blocking to pipeline
+    several.
+
+    :param kwargs: arguments of ControllerClient
+    """
+
+    def __init__(self, **kwargs):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self.client = self._run(self._create(kwargs))
+
+    @staticmethod
+    async def _create(kwargs) -> ControllerClient:
+        return ControllerClient(**kwargs)  # the client has to be created in its event loop
+
+    def _run(self, coroutine, timeout: [float, None] = None):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result(timeout)
+
+    def connect(self):
+        self._run(self.client.connect())
+
+    def close(self):
+        self._run(self.client.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def submit(self, message: dict, timeout: [float, None] = None):
+        """
+        sends a request without waiting for its reply
+        :param message: dict: message of SocketMessage type
+        :param timeout: float: s to wait for the reply
+        :return: concurrent.futures.Future of the reply
+        """
+        return asyncio.run_coroutine_threadsafe(self.client.request(message, timeout), self._loop)
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self.client, name)
+        if not asyncio.iscoroutinefunction(attribute):
+            return attribute
+        return lambda *args, **kwargs: self._run(attribute(*args, **kwargs))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Records a short test session via the remote controller')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=CONTROLLER_PORT)
+    parser.add_argument('--duration', type=float, default=5., help='s to record')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    async def main():
+        client = ControllerClient(args.host, args.port, on_status=lambda m: print(f"status: {m}"))
+        await client.connect()
+        print(await client.start_recording('testMousy42_yeah'))
+        await asyncio.sleep(args.duration)
+        status, stopped = await asyncio.gather(client.poll_status(), client.stop_recording())  # pipelined
+        print(status, stopped)
+        await client.close()
+
+    asyncio.run(main())
@@ -0,0 +1,666 @@
+"""
+Compression of SpikeGLX binary files.
+Uses the mtscomp format (.cbin data and .ch json header) from https://github.com/int-brain-lab/mtscomp.
+Besides zlib as in mtscomp the time-diffed int16 chunks can be compressed with zstd or lz4, the header then names the
+algorithm and keeps the chunk index for random access. Run as script to benchmark the codecs on a recorded file.
+"""
+import abc
+import argparse
+import hashlib
+import json
+import logging
+import shutil
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from mtscomp import Writer, FORMAT_VERSION
+
+from spikeGLX_remote.sglx_utils import (get_num_saved_channels, get_sample_rate, is_file_closed, read_live_meta,
+                                        read_meta)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+log = logging.getLogger('compress_utils')
+
+
+class Codec(abc.ABC):
+    """
+    Compresses the bytes of one time-diffed int16 chunk. Chunks are independent, so they can be compressed in parallel
+    and read back one at a time.
+
+    :param level: int: compression level, None for the default of the algorithm
+    :param n_threads: int: chunks compressed in parallel
+
+    :parameter name: str: name of the codec in the settings
+    :parameter algorithm: str: name of the algorithm in the .ch header
+    :parameter suffix: str: suffix of the compressed data file
+    """
+    name = None
+    algorithm = None
+    suffix = '.cbin'
+    default_level = None
+
+    def __init__(self, level: [int, None] = None, n_threads: int = 1):
+        self.level = self.default_level if level is None else level
+        self.n_threads = max(1, n_threads)
+
+    @classmethod
+    def available(cls) -> bool:
+        """:return: bool if the library of the codec is installed"""
+        return True
+
+    @abc.abstractmethod
+    def compress(self, data: bytes) -> bytes:
+        pass
+
+    @abc.abstractmethod
+    def decompress(self, data: bytes) -> bytes:
+        pass
+
+
+class MtscompCodec(Codec):
+    """zlib as used by mtscomp, the output can be read with mtscomp.Reader"""
+    name = 'mtscomp'
+    algorithm = 'zlib'
+    suffix = '.cbin'
+    default_level = -1
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class ZstdCodec(Codec):
+    """zstd, needs the zstandard package"""
+    name = 'zstd'
+    algorithm = 'zstd'
+    suffix = '.zbin'
+    default_level = 3
+
+    @classmethod
+    def available(cls) -> bool:
+        return zstandard is not None
+
+    def compress(self, data: bytes) -> bytes:
+        # compressor objects are not thread safe, creating one per chunk is cheap compared to the chunk
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+class Lz4Codec(Codec):
+    """lz4 frames, needs the lz4 package"""
+    name = 'lz4'
+    algorithm = 'lz4'
+    suffix = '.lzbin'
+    default_level = 0
+
+    @classmethod
+    def available(cls) -> bool:
+        return lz4 is not None
+
+    def compress(self, data: bytes) -> bytes:
+        return lz4.frame.compress(data, compression_level=self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return lz4.frame.decompress(data)
+
+
+CODECS = {codec.name: codec for codec in (MtscompCodec, ZstdCodec, Lz4Codec)}
+
+
+def get_codec(codec: str = 'mtscomp', level: [int, None] = None, n_threads: int = 1) -> Codec:
+    """
+    creates a codec from its settings, see COMPRESSION in config
+    :param codec: str: name of the codec, one of CODECS
+    :param level: int: compression level, None for the default of the codec
+    :param n_threads: int: chunks compressed in parallel
+    :return: Codec
+    """
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec {codec}, available {list(CODECS)}")
+    if not CODECS[codec].available():
+        raise ValueError(f"Codec {codec} is not installed")
+    return CODECS[codec](level=level, n_threads=n_threads)
+
+
+def get_codec_by_algorithm(algorithm: str) -> Codec:
+    """:return: Codec to decompress data whose .ch header names algorithm"""
+    for codec in CODECS.values():
+        if codec.algorithm == algorithm and codec.available():
+            return codec()
+    raise ValueError(f"No installed codec for {algorithm}")
+
+
+def stream_kind(bin_file: Path) -> [str, None]:
+    """
+    :return: str: kind of stream of a SpikeGLX file from its name: ap, lf, nidq or obx, None for a file not named
+        like a SpikeGLX stream
+    """
+    suffixes = Path(bin_file).suffixes
+    return suffixes[-2][1:] if len(suffixes) >= 2 else None
+
+
+def diff_chunk(chunk: np.ndarray) -> bytes:
+    """
+    time diff keeping the first sample, wraps around in int16 like mtscomp, the cumsum on reading undoes it
+    :return: bytes of the diffed chunk in F order
+    """
+    return np.concatenate((chunk[:1], np.diff(chunk, axis=0)), axis=0).tobytes(order='F')
+
+
+def undiff_chunk(data: bytes, n_channels: int) -> np.ndarray:
+    """inverse of diff_chunk"""
+    chunkd = np.frombuffer(data, dtype=np.int16).reshape(-1, n_channels, order='F')
+    return np.cumsum(chunkd, axis=0, dtype=np.int16)
+
+
+class ThrottledWriter(Writer):
+    """
+    mtscomp Writer that books every chunk it reads from the binary file against an IOThrottle, so a compression running
+    in the background does not starve SpikeGLX of disk bandwidth.
+
+    :param throttle: file_utils.IOThrottle: budget for reading, None for no limit
+    :param kwargs: passed to mtscomp.Writer
+    """
+
+    def __init__(self, throttle=None, **kwargs):
+        super().__init__(**kwargs)
+        self.throttle = throttle
+
+    def get_chunk(self, chunk_idx):
+        chunk = super().get_chunk(chunk_idx)
+        if self.throttle is not None:
+            self.throttle.consume(chunk.nbytes)
+        return chunk
+
+
+def compress_bin_file(bin_file: Path, out_file: Path, out_meta: Path, sample_rate: float, n_channels: int,
+                      throttle=None, **kwargs) -> float:
+    """
+    compresses a SpikeGLX int16 binary file into mtscomp format
+    :param bin_file: Path: .bin file to compress
+    :param out_file: Path: compressed .cbin file
+    :param out_meta: Path: .ch json header of the compressed file
+    :param sample_rate: float: sample rate of the stream
+    :param n_channels: int: number of saved channels
+    :param throttle: file_utils.IOThrottle: budget for reading, None for no limit
+    :param kwargs: mtscomp settings, e.g. comp_level, n_threads
+    :return: float: ratio of compressed to original size
+    """
+    writer = ThrottledWriter(throttle=throttle, quiet=True, **kwargs)
+    writer.open(bin_file, sample_rate=sample_rate, n_channels=n_channels, dtype=np.int16)
+    ratio = writer.write(out_file, out_meta)
+    writer.close()
+    return ratio
+
+
+def compressed_paths(bin_file: Path, suffix: str = '.cbin') -> (Path, Path):
+    """
+    :param suffix: str: suffix of the compressed data file, see Codec.suffix
+    :return: (data, ch) paths of the compressed version of a .bin file, kept in the subfolder compressed
+    """
+    return (bin_file.parent / 'compressed' / bin_file.with_suffix(suffix).name,
+            bin_file.parent / 'compressed' / bin_file.with_suffix('.ch').name)
+
+
+def compressed_up_to_date(bin_file: Path, suffix: str = '.cbin') -> bool:
+    """
+    :param suffix: str: suffix of the compressed data file, see Codec.suffix
+    :return: bool if the compressed version of a .bin file exists and is not older than it, e.g. compressed while
+        recording
+    """
+    out_file, out_meta = compressed_paths(bin_file, suffix)
+    return out_file.exists() and out_meta.exists() and out_meta.stat().st_mtime >= bin_file.stat().st_mtime
+
+
+class TailCompressor:
+    """
+    Compresses a .bin file while SpikeGLX is still writing it. Chunks lying at least lag seconds behind the end of the
+    file are compressed right away, so only the last few seconds are left when the recording stops. The output is the
+    same as mtscomp produces (time-diffed chunks in F order), with the default codec it can be read with mtscomp.Reader.
+    With lag=0 it compresses complete files with any codec.
+
+    :param bin_file: Path: growing .bin file
+    :param out_file: Path: compressed data file
+    :param out_meta: Path: .ch json header of the compressed file
+    :param sample_rate: float: sample rate of the stream
+    :param n_channels: int: number of saved channels
+    :param chunk_duration: float: s of data per chunk
+    :param lag: float: s of data to stay behind the end of the file
+    :param codec: Codec: compresses the chunks, None for mtscomp
+    :param throttle: file_utils.IOThrottle: budget for reading, None for no limit
+
+    :parameter chunk_bounds: list: first sample of each chunk and the sample count after the last one
+    :parameter chunk_offsets: list: byte offsets of the chunks in the compressed file and its size after the last one
+    :parameter finalized: bool: True once finalize ran, the header is only written if the data was verified
+    """
+
+    def __init__(self, bin_file: Path, out_file: Path, out_meta: Path, sample_rate: float, n_channels: int,
+                 chunk_duration: float = 1., lag: float = 1., codec: [Codec, None] = None, throttle=None):
+        self.bin_file = Path(bin_file)
+        self.out_file = Path(out_file)
+        self.out_meta = Path(out_meta)
+        self.sample_rate = float(sample_rate)
+        self.n_channels = n_channels
+        self.chunk_size = int(np.round(chunk_duration * self.sample_rate))
+        self.lag_samples = int(np.round(lag * self.sample_rate))
+        self.codec = MtscompCodec() if codec is None else codec
+        self.throttle = throttle
+        self.itemsize = np.dtype(np.int16).itemsize
+        self.chunk_bounds = [0]
+        self.chunk_offsets = [0]
+        self.sha1_compressed = hashlib.sha1()
+        self.sha1_uncompressed = hashlib.sha1()
+        self.finalized = False
+        self._pool = ThreadPoolExecutor(self.codec.n_threads) if self.codec.n_threads > 1 else None
+        self.out_file.parent.mkdir(exist_ok=True, parents=True)
+        self._out = self.out_file.open('wb')
+
+    @property
+    def n_samples(self) -> int:
+        """number of samples compressed so far"""
+        return self.chunk_bounds[-1]
+
+    def compress_available(self, final: bool = False) -> int:
+        """
+        compresses all complete chunks lying lag behind the end of the file, codec.n_threads chunks at a time
+        :param final: bool: the file is complete, compress everything including a last partial chunk
+        :return: int: number of compressed chunks
+        """
+        n_samples_file = self.bin_file.stat().st_size // (self.n_channels * self.itemsize)
+        limit = n_samples_file if final else n_samples_file - self.lag_samples
+        bounds = []
+        i0 = self.n_samples
+        while i0 + self.chunk_size <= limit or (final and i0 < limit):
+            bounds.append((i0, min(i0 + self.chunk_size, limit)))
+            i0 = bounds[-1][1]
+        with self.bin_file.open('rb') as f:
+            for i_batch in range(0, len(bounds), self.codec.n_threads):
+                chunks = [self._read_chunk(f, i0, i1) for i0, i1 in bounds[i_batch:i_batch + self.codec.n_threads]]
+                if self._pool is None:
+                    compressed = [self._compress(chunk) for chunk in chunks]
+                else:  # zlib, zstd and lz4 release the GIL
+                    compressed = list(self._pool.map(self._compress, chunks))
+                for chunk, data in zip(chunks, compressed):
+                    self._append(chunk, data)
+        return len(bounds)
+
+    def _read_chunk(self, f, i0: int, i1: int) -> np.ndarray:
+        n_bytes = (i1 - i0) * self.n_channels * self.itemsize
+        if self.throttle is not None:
+            self.throttle.consume(n_bytes)
+        f.seek(i0 * self.n_channels * self.itemsize)
+        return np.frombuffer(f.read(n_bytes), dtype=np.int16).reshape(i1 - i0, self.n_channels)
+
+    def _compress(self, chunk: np.ndarray) -> bytes:
+        return self.codec.compress(diff_chunk(chunk))
+
+    def _append(self, chunk: np.ndarray, compressed: bytes):
+        self._out.write(compressed)
+        self.chunk_bounds.append(self.chunk_bounds[-1] + chunk.shape[0])
+        self.chunk_offsets.append(self.chunk_offsets[-1] + len(compressed))
+        self.sha1_uncompressed.update(chunk)
+        self.sha1_compressed.update(compressed)
+
+    def get_cmeta(self) -> dict:
+        """:return: dict: header of the compressed file in mtscomp format"""
+        return {
+            'version': FORMAT_VERSION,
+            'algorithm': self.codec.algorithm,
+            'comp_level': self.codec.level,
+            'do_time_diff': True,
+            'do_spatial_diff': False,
+            'dtype': str(np.dtype(np.int16)),
+            'n_channels': self.n_channels,
+            'sample_rate': self.sample_rate,
+            'chunk_bounds': self.chunk_bounds,
+            'chunk_offsets': self.chunk_offsets,
+            'chunk_order': 'F',
+            'sha1_compressed': self.sha1_compressed.hexdigest(),
+            'sha1_uncompressed': self.sha1_uncompressed.hexdigest(),
+            'shape': (self.n_samples, self.n_channels),
+        }
+
+    def finalize(self, expected_sha1: [str, None] = None) -> bool:
+        """
+        compresses the rest of the file and writes the header, call once SpikeGLX closed the file. The header is only
+        written if the data matches expected_sha1, otherwise the compressed file is deleted, so compress_folder
+        compresses the file again instead of taking it as compressed while recording.
+        :param expected_sha1: str: SHA1 of the .bin file as SpikeGLX puts it into the meta file, checked if given
+        :return: bool if the compressed data matches the expected SHA1
+        """
+        self.compress_available(final=True)
+        self._out.close()
+        if self._pool is not None:
+            self._pool.shutdown()
+        self.finalized = True
+        if expected_sha1 and expected_sha1.lower() != self.sha1_uncompressed.hexdigest():
+            log.error(f"SHA1 of compressed data does not match {self.bin_file}, deleting the compressed file")
+            self.out_file.unlink(missing_ok=True)
+            self.out_meta.unlink(missing_ok=True)
+            return False
+        with self.out_meta.open('w') as f:
+            json.dump(self.get_cmeta(), f, indent=2, sort_keys=True)
+        return True
+
+
+def compress_file(bin_file: Path, out_file: Path, out_meta: Path, sample_rate: float, n_channels: int,
+                  codec: [Codec, None] = None, throttle=None) -> float:
+    """
+    compresses a complete SpikeGLX int16 binary file with a codec, mtscomp files are written by mtscomp itself
+    :param codec: Codec: None for mtscomp
+    :return: float: ratio of compressed to original size
+    """
+    if codec is None:
+        return compress_bin_file(bin_file, out_file, out_meta, sample_rate, n_channels, throttle=throttle)
+    if isinstance(codec, MtscompCodec):
+        return compress_bin_file(bin_file, out_file, out_meta, sample_rate, n_channels, throttle=throttle,
+                                 comp_level=codec.level, n_threads=codec.n_threads)
+    compressor = TailCompressor(bin_file, out_file, out_meta, sample_rate, n_channels, lag=0., codec=codec,
+                                throttle=throttle)
+    compressor.finalize()
+    return compressor.chunk_offsets[-1] / max(1, bin_file.stat().st_size)
+
+
+def read_compressed_chunk(data_file: Path, ch_file: Path, chunk_idx: int) -> np.ndarray:
+    """
+    reads a single chunk of a compressed file, using the chunk index of its header
+    :param data_file: Path: compressed data file
+    :param ch_file: Path: .ch json header
+    :param chunk_idx: int: index of the chunk
+    :return: np.ndarray: (n_samples, n_channels) int16 data of the chunk
+    """
+    with Path(ch_file).open() as f:
+        cmeta = json.load(f)
+    codec = get_codec_by_algorithm(cmeta['algorithm'])
+    i0, i1 = cmeta['chunk_offsets'][chunk_idx], cmeta['chunk_offsets'][chunk_idx + 1]
+    with Path(data_file).open('rb') as f:
+        f.seek(i0)
+        return undiff_chunk(codec.decompress(f.read(i1 - i0)), cmeta['n_channels'])
+
+
+def compress_folder(folder: [Path, str], compression: dict, throttle=None, progress=None) -> [Path, None]:
+    """
+    compresses the recorded files of a session folder into its subfolder compressed, each stream kind (ap, lf, nidq,
+    obx) with its codec settings, kinds without settings are not compressed. Files already compressed while recording
+    are skipped. The meta files and the event log are copied along.
+    :param folder: Path: session folder or file in it
+    :param compression: dict: codec settings per stream kind, see COMPRESSION in config
+    :param throttle: file_utils.IOThrottle: budget for reading, None for no limit
+    :param progress: callable(fraction, detail) called after each file
+    :return: Path of the compressed folder, None on failure
+    """
+    folder = Path(folder)
+    if not folder.exists():
+        log.error(f"Path {folder} not found")
+        return None
+    if not folder.is_dir():
+        folder = folder.parent
+    # files not named like a SpikeGLX stream have no kind and are left alone
+    bin_files = [f for f in sorted(folder.glob('*.bin')) if stream_kind(f) and compression.get(stream_kind(f))]
+    out_folder = None
+    for i, bin_file in enumerate(bin_files):
+        try:
+            codec = get_codec(**compression[stream_kind(bin_file)])
+        except ValueError as e:
+            log.error(f"Cant compress {bin_file.name}: {e}")
+            return None
+        metafile = bin_file.with_suffix('.meta')
+        out_file, out_meta = compressed_paths(bin_file, codec.suffix)
+        out_folder = out_file.parent
+        if compressed_up_to_date(bin_file, codec.suffix):
+            log.info(f"{bin_file.name} was already compressed while recording")
+        else:
+            meta = read_meta(metafile)
+            if not meta:
+                log.error(f"No meta file found for {bin_file}")
+                return None
+            ratio = compress_file(bin_file, out_file, out_meta, get_sample_rate(meta), get_num_saved_channels(meta),
+                                  codec=codec, throttle=throttle)
+            log.info(f"Compressed {bin_file.name} with {codec.name} to {ratio:.2f} of its size")
+            shutil.copy2(metafile, out_folder)
+        if progress is not None:
+            progress((i + 1) / len(bin_files), bin_file.name)
+    if out_folder is None:
+        log.error(f"No files to compress found at {folder}")
+        return None
+    # copy the event log of the session
+    for events_file in folder.glob('*.events.jsonl'):
+        shutil.copy2(events_file, out_folder)
+    return out_folder
+
+
+class LiveCompressor:
+    """
+    Follows all binary files matching pattern in a recording folder while SpikeGLX writes them and compresses them
+    with a TailCompressor each. Files SpikeGLX closed are finalized right away (e.g. in a trial series), the others
+    when stop is called. The output goes to the subfolder compressed like for compress_folder.
+
+    :param folder: Path: recording folder
+    :param pattern: str: glob pattern of the files to compress
+    :param interval: float: s between passes over the files
+    :param lag: float: s of data to stay behind the end of each file
+    :param codec: Codec: compresses the chunks, None for mtscomp
+    :param throttle: file_utils.IOThrottle: budget for reading, None for no limit
+
+    :parameter compressors: dict: TailCompressor per bin file
+    :parameter failed: list: bin files whose compressed data did not match the SHA1 in the meta file
+    """
+
+    def __init__(self, folder: Path, pattern: str = '*.ap.bin', interval: float = 5., lag: float = 1.,
+                 codec: [Codec, None] = None, throttle=None):
+        self.folder = Path(folder)
+        self.pattern = pattern
+        self.interval = interval
+        self.lag = lag
+        self.codec = MtscompCodec() if codec is None else codec
+        self.throttle = throttle
+        self.compressors = {}
+        self.failed = []
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """starts following the files in a background thread"""
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        log.info(f"Compressing {self.pattern} files in {self.folder} while recording")
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.step()
+            except (OSError, ValueError) as e:
+                log.error(f"Error compressing while recording: {e}")
+            self._stop_event.wait(self.interval)
+
+    def _open_compressor(self, bin_file: Path) -> [TailCompressor, None]:
+        meta = read_live_meta(bin_file.with_suffix('.meta'))  # SpikeGLX writes it when opening the bin file
+        try:
+            sample_rate, n_channels = get_sample_rate(meta), get_num_saved_channels(meta)
+        except (KeyError, ValueError):  # not complete yet, tried again on the next pass
+            return None
+        out_file, out_meta = compressed_paths(bin_file, self.codec.suffix)
+        return TailCompressor(bin_file, out_file, out_meta, sample_rate, n_channels, lag=self.lag, codec=self.codec,
+                              throttle=self.throttle)
+
+    def step(self, final: bool = False):
+        """
+        one pass over all files: opens compressors for new files, compresses what is available and finalizes closed
+        files
+        :param final: bool: the recording stopped, finalize all files
+        """
+        for bin_file in sorted(self.folder.glob(self.pattern)):
+            if bin_file not in self.compressors:
+                compressor = self._open_compressor(bin_file)
+                if compressor is None:
+                    continue
+                self.compressors[bin_file] = compressor
+            compressor = self.compressors[bin_file]
+            if compressor.finalized:
+                continue
+            meta = read_live_meta(bin_file.with_suffix('.meta'))
+            if final or is_file_closed(bin_file, meta):
+                self._finalize(bin_file, compressor, meta)
+            else:
+                compressor.compress_available()
+
+    def _finalize(self, bin_file: Path, compressor: TailCompressor, meta: dict):
+        if not compressor.finalize(meta.get('fileSHA1')):
+            self.failed.append(bin_file)
+            return
+        shutil.copy2(bin_file.with_suffix('.meta'), compressor.out_meta.parent)
+        log.info(f"Finished compressing {bin_file.name} "
+                 f"({compressor.chunk_offsets[-1] / max(1, bin_file.stat().st_size):.2f} of original size)")
+
+    def stop(self, timeout: float = 10.) -> bool:
+        """
+        stops following the files, waits up to timeout for SpikeGLX to close them and finalizes them
+        :param timeout: float: s to wait for SpikeGLX to close the files
+        :return: bool if all files were compressed without error
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            bin_files = sorted(self.folder.glob(self.pattern))
+            if all(is_file_closed(f, read_live_meta(f.with_suffix('.meta'))) for f in bin_files):
+                break
+            time.sleep(0.2)
+        else:
+            log.warning("SpikeGLX did not close all files in time, compressing them as they are")
+        self.step(final=True)
+        return not self.failed and all(c.finalized for c in self.compressors.values())
+
+
+def benchmark_codecs(bin_file: Path, settings: list, n_chunks: int = 5, chunk_duration: float = 1.) -> list:
+    """
+    Compresses a few chunks spread over a recorded file with every codec setting and measures speed and ratio.
+    Throughput is given for the uncompressed data including the time diff, realtime is how many times faster than
+    SpikeGLX writes the stream the codec compresses it.
+
+    :param bin_file: Path: recorded .bin file with its .meta file next to it
+    :param settings: list of dicts with codec settings, see get_codec
+    :param n_chunks: int: number of chunks to sample
+    :param chunk_duration: float: s of data per chunk
+    :return: list of dicts with codec, level, n_threads, ratio, compress_MBps, decompress_MBps and realtime per setting
+    """
+    bin_file = Path(bin_file)
+    meta = read_meta(bin_file.with_suffix('.meta'))
+    sample_rate, n_channels = get_sample_rate(meta), get_num_saved_channels(meta)
+    data_rate = sample_rate * n_channels * 2  # bytes/s SpikeGLX writes
+    chunk_size = int(np.round(chunk_duration * sample_rate))
+    n_samples = bin_file.stat().st_size // (n_channels * 2)
+    data = np.memmap(bin_file, dtype=np.int16, mode='r', shape=(n_samples, n_channels))
+    starts = np.linspace(0, max(0, n_samples - chunk_size), n_chunks).astype(np.int64)
+    chunks = [np.array(data[i0:i0 + chunk_size]) for i0 in starts]
+    raw_size = sum(chunk.nbytes for chunk in chunks)
+    results = []
+    for setting in settings:
+        try:
+            codec = get_codec(**setting)
+        except ValueError as e:
+            log.warning(f"Skipping {setting}: {e}")
+            continue
+
+        def compress(chunk):
+            return codec.compress(diff_chunk(chunk))
+
+        with ThreadPoolExecutor(codec.n_threads) as pool:
+            t_start = time.perf_counter()
+            compressed = list(pool.map(compress, chunks))
+            t_compress = time.perf_counter() - t_start
+            t_start = time.perf_counter()
+            list(pool.map(codec.decompress, compressed))
+            t_decompress = time.perf_counter() - t_start
+        results.append({'codec': codec.name, 'level': codec.level, 'n_threads': codec.n_threads,
+                        'ratio': sum(len(c) for c in compressed) / raw_size,
+                        'compress_MBps': raw_size / t_compress / 2**20,
+                        'decompress_MBps': raw_size / t_decompress / 2**20,
+                        'realtime': raw_size / t_compress / data_rate})
+    return results
+
+
+def estimate_compression(folder: Path, compression: dict, n_chunks: int = 3) -> dict:
+    """
+    Predicts time and output size of compressing a session folder on this machine from a few chunks sampled from each
+    .bin file, see benchmark_codecs. The time assumes the compression is not throttled.
+
+    :param folder: Path: session folder
+    :param compression: dict: codec settings per stream kind, see COMPRESSION in config
+    :param n_chunks: int: number of chunks sampled per file
+    :return: dict with raw_bytes of the recorded files in the folder, compressed_bytes of the compressed files,
+        compress_s and per compressed .bin file name a dict with codec, raw_bytes, compressed_bytes and compress_s.
+        Files already compressed while recording count with the size of their output and take no time.
+    """
+    folder = Path(folder)
+    # only the recorded files, not the subfolder compressed of a session compressed while recording
+    estimate = {'raw_bytes': sum(f.stat().st_size for f in folder.iterdir() if f.is_file()),
+                'compressed_bytes': 0, 'compress_s': 0., 'files': {}}
+    for bin_file in sorted(folder.glob('*.bin')):
+        kind = stream_kind(bin_file)
+        settings = compression.get(kind) if kind else None
+        if not settings:
+            continue
+        try:
+            codec = get_codec(**settings)
+        except ValueError as e:
+            log.warning(f"Skipping {bin_file.name}: {e}")
+            continue
+        if compressed_up_to_date(bin_file, codec.suffix):
+            out_file, _ = compressed_paths(bin_file, codec.suffix)
+            file_estimate = {'codec': codec.name, 'raw_bytes': bin_file.stat().st_size,
+                             'compressed_bytes': out_file.stat().st_size, 'compress_s': 0.}
+            estimate['files'][bin_file.name] = file_estimate
+            estimate['compressed_bytes'] += file_estimate['compressed_bytes']
+            continue
+        results = benchmark_codecs(bin_file, [settings], n_chunks=n_chunks)
+        if not results:
+            continue
+        size = bin_file.stat().st_size
+        file_estimate = {'codec': results[0]['codec'], 'raw_bytes': size,
+                         'compressed_bytes': size * results[0]['ratio'],
+                         'compress_s': size / (results[0]['compress_MBps'] * 2**20)}
+        estimate['files'][bin_file.name] = file_estimate
+        estimate['compressed_bytes'] += file_estimate['compressed_bytes']
+        estimate['compress_s'] += file_estimate['compress_s']
+    return estimate
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the compression codecs on chunks of recorded SpikeGLX '
+                                                 'files to pick the one keeping up with the daily data volume')
+    parser.add_argument('path', type=Path, help='.bin file or session folder with .bin files')
+    parser.add_argument('--n_chunks', type=int, default=5, help='number of chunks sampled per file')
+    parser.add_argument('--n_threads', type=int, default=1, help='chunks compressed in parallel')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    codec_settings = [{'codec': 'mtscomp'}, {'codec': 'mtscomp', 'level': 1},
+                      {'codec': 'zstd', 'level': 1}, {'codec': 'zstd', 'level': 3}, {'codec': 'zstd', 'level': 9},
+                      {'codec': 'lz4'}]
+    for setting in codec_settings:
+        setting['n_threads'] = args.n_threads
+    bin_files = sorted(args.path.glob('*.bin')) if args.path.is_dir() else [args.path]
+    for file in bin_files:
+        print(f"{file.name} ({stream_kind(file)})")
+        print(f"{'codec':>8} {'level':>5} {'ratio':>6} {'comp MB/s':>10} {'decomp MB/s':>12} {'realtime':>9}")
+        for res in benchmark_codecs(file, codec_settings, n_chunks=args.n_chunks):
+            print(f"{res['codec']:>8} {res['level']:>5} {res['ratio']:>6.3f} {res['compress_MBps']:>10.1f} "
+                  f"{res['decompress_MBps']:>12.1f} {res['realtime']:>8.1f}x")
@@ -2,8 +2,49 @@ PATH2DATA = 'D:\\Neuropixels_Data'
 REMOTE_HOST = '10.4.26.49'  # if remote client is on same computer use localhost,
 # else the IP adress of the server
 REMOTE_PORT = 8882
+REMOTE_UNIX_SOCKET = None  # path of a Unix domain socket to serve a remote controller on the same computer instead of TCP
+HEARTBEAT_INTERVAL = 1  # s between heartbeats sent to a remote controller that sends heartbeats itself, None to send none
+HEARTBEAT_TIMEOUT = 5  # s without data from a remote controller sending heartbeats until its connection counts as lost
+TCP_KEEPALIVE = (5, 1, 3)  # idle s, probe interval s, probe count: detects lost remote controllers without heartbeats
+REMOTE_REACCEPT = True  # wait for the next remote controller as soon as the connection ended
 SPIKEGLX_COMPUTER = 'localhost'
 SPIKEGLX_PORT = 4142
+RIGS = {}  # name: (host, port) of further SpikeGLX instances started/stopped/recording together with SPIKEGLX_COMPUTER
+SGLX_POOL_SIZE = 2  # parallel SpikeGLX connections for queries/fetches, one more is reserved for start/stop
+AUTO_ARM_RECORDING = True  # prepare the recording (folder, file name) as soon as the session id is received
+LIVE_SHM_STREAMS = []  # streams published to shared memory for analysis processes on this computer, e.g. ['imec0'] or ['all'], see live_shm
+LIVE_SHM_PREFIX = 'sglx_live'  # name of the shared memory index the analysis processes look the streams up in
+LIVE_SHM_BLOCK = 0.02  # s of data per fetch for the shared memory, uses a pooled SpikeGLX connection per fetch
+LIVE_SHM_SECONDS = 1  # s of data kept in shared memory, analysis processes falling behind further lose blocks
+SAMPLE_MAP_REFRESH = 60  # s after which the sample mapping between streams is fitted again
 COPY_DIRECT = False # if True, the data will be copied directly to the server, if False, the data will be when the button is pressed
 COPY_AFTER_COMPRESS = True
+COPY_SYNC = True  # only transfer files and blocks missing or changed on the data server, e.g. after an interrupted copy
+# codec settings per stream kind: codec mtscomp, zstd or lz4, level (None for default), n_threads;
+# kinds set to None are not compressed, pick with: python -m spikeGLX_remote.compress_utils <session folder>
+COMPRESSION = {'ap': {'codec': 'mtscomp', 'level': None, 'n_threads': 4}, 'lf': None, 'nidq': None, 'obx': None}
+LIVE_COMPRESS = False  # compress the .ap.bin files already while SpikeGLX writes them
+LIVE_COMPRESS_LAG = 2  # s of data the compression while recording stays behind the end of the files
+LIVE_REPLICATE = False  # copy the files to the session_path sent with the start message already while recording
+LIVE_REPLICATE_INTERVAL = 10  # s between passes of the replication while recording
+IO_PAUSE_WHILE_RECORDING = False  # pause background copy/compression completely while SpikeGLX saves data
+IO_BUDGET_RECORDING_MBPS = 50  # MB/s for background copy/compression while SpikeGLX saves data, None for no limit
+IO_BUDGET_RECORDING_IOPS = 100  # IO operations/s for background copy/compression while SpikeGLX saves data
+IO_CHUNK_SIZE = 8  # MB read/written per IO operation of background copy
+COPY_WORKERS = 4  # concurrent streams copying to the data server, one stream to a share does not fill the link
+COPY_PART_SIZE = 256  # MB of a large file copied by one stream
+TRANSFER_HOST = None  # data server running python -m spikeGLX_remote.transfer receive, None to copy to the mounted path
+TRANSFER_PORT = 8890
+TRANSFER_ROOT = 'O:\\archive'  # session paths below this folder are uploaded relative to the root of the receiver
+AGENT_HOST = None  # acquisition computer running python -m spikeGLX_remote.acq_agent, for file jobs if SPIKEGLX_COMPUTER is remote
+AGENT_PORT = 8891
+SESSION_INDEX = True  # keep an index of the sessions in PATH2DATA, see session_index
+RETENTION_FREE_GB = None  # GB to keep free by deleting sessions verified on the data server, oldest first, None to keep all
+RETENTION_MIN_AGE = 1  # days since the last change of a session before it may be deleted
+RETENTION_INTERVAL = 600  # s between checks of the free space for the retention
+DATA_DIRS = []  # further data folders on other drives, each session goes to the drive with most free space fast enough
+MULTI_DRIVE = False  # let spikeGLX split the probes of a run over PATH2DATA and DATA_DIRS, switches multi-drive of spikeGLX on or off
+COPY_RATE_ESTIMATE = 100  # MB/s to the data server assumed for copy time estimates until a copy measured it
+DISK_FORECAST_INTERVAL = 10  # s between forecasts of the remaining recording time from the stream write rates
+WARN_RECORDING_MINUTES = 60  # warn if the free space lasts for less recording time, replaces WARN_DISK_SPACE once forecasted
 WARN_DISK_SPACE = 120 # GB warn if less disc space available
\ No newline at end of file
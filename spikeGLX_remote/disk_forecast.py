@@ -0,0 +1,157 @@
+"""
+Forecast of the remaining recording time on the SpikeGLX data directories.
+The write rate of every stream follows from its sample rate and the number of saved channels, so the forecast is
+available as soon as a run is configured, before the recording starts, and differs with the number of probes.
+Free space is polled on every data directory, with multi-drive enabled SpikeGLX writes the probes to several of them.
+"""
+import logging
+import shutil
+import threading
+import time
+from ctypes import byref, c_char_p, c_int
+from pathlib import Path
+
+import spikeGLX_remote.sglx as sglx
+from spikeGLX_remote.sglx_sync import enumerate_streams, stream_name
+
+log = logging.getLogger('disk_forecast')
+
+MAX_DATA_DIRS = 16  # SpikeGLX has no call for the number of data directories
+
+
+def get_data_dirs(hSglx) -> list:
+    """
+    :param hSglx: handle to the spikeglx api connection
+    :return: list of the data directories of SpikeGLX as str, the main directory first
+    """
+    dirs = []
+    for idir in range(MAX_DATA_DIRS):
+        path = c_char_p()
+        if not sglx.c_sglx_getDataDir(byref(path), hSglx, idir) or not path.value:
+            break
+        dirs.append(path.value.decode())
+    return dirs
+
+
+def get_write_rate(hSglx, js: int, ip: int) -> float:
+    """
+    bytes per second SpikeGLX writes for a stream, from its sample rate and saved channels. Imec streams are split into
+    the AP file at the full rate and the LF file at 1/12 of it, both carrying the saved sync channel.
+    :param hSglx: handle to the spikeglx api connection
+    :param js: int: stream type
+    :param ip: int: substream
+    :return: float: bytes/s, 0 if unavailable
+    """
+    rate = sglx.c_sglx_getStreamSampleRate(hSglx, js, ip)
+    n_val = c_int()
+    if not rate or not sglx.c_sglx_getStreamSaveChans(byref(n_val), hSglx, js, ip):
+        return 0.
+    saved = [sglx.c_sglx_getint(hSglx, i) for i in range(n_val.value)]
+    if js != 2:
+        return 2. * rate * len(saved)
+    if not sglx.c_sglx_getStreamAcqChans(byref(n_val), hSglx, js, ip):
+        return 2. * rate * len(saved)
+    n_ap, n_lf = sglx.c_sglx_getint(hSglx, 0), sglx.c_sglx_getint(hSglx, 1)
+    ap = sum(c < n_ap for c in saved)
+    lf = sum(n_ap <= c < n_ap + n_lf for c in saved)
+    sync = len(saved) - ap - lf
+    return 2. * rate * (ap + sync) + (2. * rate / 12 * (lf + sync) if lf else 0.)
+
+
+class DiskForecaster:
+    """
+    Polls SpikeGLX for the write rates of the streams of the current run and the free space of its data directories in
+    a background thread and forecasts the minutes left until the first directory is full. Without multi-drive all
+    streams go to the main directory, with multi-drive NI and OneBox stay in the main directory and the probes are
+    spread over the directories in turn.
+
+    :param sglx_pool: SglxHandlePool: pool to check out handles from
+    :param interval: float: s between polls
+    :param warn_minutes: float: minutes left below which on_warning is called
+    :param multi_drive: bool: SpikeGLX splits the run over its data directories
+    :param on_warning: callable(forecast) called once when the minutes left drop below warn_minutes
+
+    :parameter forecast: dict: last forecast, see update
+    """
+
+    def __init__(self, sglx_pool, interval: float = 10., warn_minutes: float = 60., multi_drive: bool = False,
+                 on_warning=None):
+        self.sglx_pool = sglx_pool
+        self.interval = interval
+        self.warn_minutes = warn_minutes
+        self.multi_drive = multi_drive
+        self.on_warning = on_warning
+        self.forecast = None
+        self._warned = False
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _assign(self, streams: list, dirs: list) -> dict:
+        """maps the stream names to the data directories they are written to"""
+        if not self.multi_drive or len(dirs) < 2:
+            return {stream_name(js, ip): dirs[0] for js, ip in streams}
+        return {stream_name(js, ip): dirs[ip % len(dirs)] if js == 2 else dirs[0] for js, ip in streams}
+
+    def update(self) -> [dict, None]:
+        """
+        polls the write rates and the free space once
+        :return: dict with minutes_left (None without streams), write_MBps and per data directory its free_gb,
+            write_MBps, minutes_left and streams; None if SpikeGLX is not reachable
+        """
+        with self.sglx_pool.checkout() as hSglx:
+            if hSglx is None:
+                return None
+            streams = enumerate_streams(hSglx)
+            dirs = get_data_dirs(hSglx)
+            rates = {stream_name(js, ip): get_write_rate(hSglx, js, ip) for js, ip in streams}
+        if not dirs:
+            log.error("SpikeGLX reported no data directory")
+            return None
+        forecast = {'time': time.time(), 'write_MBps': sum(rates.values()) / 2**20, 'minutes_left': None, 'dirs': {}}
+        assignment = self._assign(streams, dirs)
+        for data_dir in dirs:
+            dir_streams = [name for name, d in assignment.items() if d == data_dir]
+            rate = sum(rates[name] for name in dir_streams)
+            try:
+                free = shutil.disk_usage(Path(data_dir)).free
+            except OSError:  # not on this computer
+                free = None
+            entry = {'free_gb': None if free is None else free / 2**30, 'write_MBps': rate / 2**20,
+                     'minutes_left': free / rate / 60 if free is not None and rate else None, 'streams': dir_streams}
+            forecast['dirs'][data_dir] = entry
+            if entry['minutes_left'] is not None:
+                if forecast['minutes_left'] is None or entry['minutes_left'] < forecast['minutes_left']:
+                    forecast['minutes_left'] = entry['minutes_left']
+        self.forecast = forecast
+        self._check_warning(forecast)
+        return forecast
+
+    def _check_warning(self, forecast: dict):
+        minutes = forecast['minutes_left']
+        if minutes is None or minutes >= self.warn_minutes:
+            self._warned = False
+            return
+        if not self._warned:
+            self._warned = True
+            log.warning(f"Disk space left for {minutes:.0f} min of recording at {forecast['write_MBps']:.1f} MB/s")
+            if self.on_warning is not None:
+                self.on_warning(forecast)
+
+    def start(self):
+        """starts polling in a background thread"""
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.update()
+            except OSError as e:
+                log.error(f"Error forecasting the recording time: {e}")
+            self._stop_event.wait(self.interval)
@@ -0,0 +1,118 @@
+"""
+Balancing of the recordings over several data drives of the acquisition computer.
+Each drive is rated by its free space and its sequential write throughput, measured with a test file while nothing is
+recorded. A session goes to the best drive, or with multi-drive SpikeGLX splits the probes of a run over the drives in
+the order given here.
+"""
+import logging
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+log = logging.getLogger('drive_balance')
+
+TEST_FILE = '.write_test'
+TEST_SIZE = 256 * 2**20  # bytes written to measure the throughput
+TEST_CHUNK = 8 * 2**20
+
+
+def measure_write_throughput(folder: [str, Path], size: int = TEST_SIZE, chunk_size: int = TEST_CHUNK) -> float:
+    """
+    writes a test file to folder, flushes it to the disk and deletes it again
+    :param folder: Path: folder on the drive
+    :param size: int: bytes to write
+    :param chunk_size: int: bytes per write
+    :return: float: bytes/s
+    """
+    test_file = Path(folder) / TEST_FILE
+    chunk = os.urandom(chunk_size)  # not compressible by the drive
+    t_start = time.perf_counter()
+    try:
+        with test_file.open('wb', buffering=0) as f:
+            for _ in range(max(1, size // chunk_size)):
+                f.write(chunk)
+            os.fsync(f.fileno())
+        elapsed = time.perf_counter() - t_start
+    finally:
+        test_file.unlink(missing_ok=True)
+    return max(1, size // chunk_size) * chunk_size / elapsed
+
+
+class DriveBalancer:
+    """
+    Ranks the data drives for the next recording. Drives that sustain the write rate of the recording with margin come
+    first, among them the one that lasts longest, so the drives fill up evenly. The throughputs are measured again
+    after max_age, but only when refresh is called and busy returns False before each drive, the test writes would
+    disturb a recording.
+
+    :param dirs: list: data folders, one per drive
+    :param margin: float: factor the throughput of a drive has to exceed the write rate by
+    :param max_age: float: s after which a throughput is measured again
+    :param test_size: int: bytes written per measurement
+    :param busy: callable() -> bool: True while no drive may be measured, e.g. while recording, None to always measure
+
+    :parameter throughput: dict: (bytes/s, time.time() of the measurement) per data folder
+    """
+
+    def __init__(self, dirs: list, margin: float = 2., max_age: float = 86400., test_size: int = TEST_SIZE,
+                 busy=None):
+        self.dirs = [Path(d) for d in dirs]
+        self.busy = busy
+        self.margin = margin
+        self.max_age = max_age
+        self.test_size = test_size
+        self.throughput = {}
+        self._lock = threading.Lock()  # one measurement at a time, they would slow each other down
+
+    def refresh(self, force: bool = False):
+        """
+        measures the throughput of the drives without a recent measurement
+        :param force: bool: measure all drives
+        """
+        with self._lock:
+            for data_dir in self.dirs:
+                last = self.throughput.get(data_dir)
+                if not force and last is not None and time.time() - last[1] < self.max_age:
+                    continue
+                if self.busy is not None and self.busy():
+                    log.info("Recording started, measuring the write throughput aborted")
+                    return
+                try:
+                    data_dir.mkdir(exist_ok=True, parents=True)
+                    rate = measure_write_throughput(data_dir, self.test_size)
+                except OSError as e:
+                    log.error(f"Cant measure the write throughput of {data_dir}: {e}")
+                    continue
+                self.throughput[data_dir] = (rate, time.time())
+                log.info(f"Write throughput of {data_dir}: {rate / 2**20:.0f} MB/s")
+
+    def status(self) -> list:
+        """
+        :return: list of dicts with dir, free_gb and write_MBps (None if not measured yet) per drive, unreachable
+            drives are left out
+        """
+        drives = []
+        for data_dir in self.dirs:
+            try:
+                free = shutil.disk_usage(data_dir).free
+            except OSError:
+                log.warning(f"Data folder {data_dir} not reachable")
+                continue
+            rate = self.throughput.get(data_dir, (None,))[0]
+            drives.append({'dir': data_dir, 'free_gb': free / 2**30,
+                           'write_MBps': None if rate is None else rate / 2**20})
+        return drives
+
+    def rank(self, write_rate: float = 0.) -> list:
+        """
+        orders the drives for the next recording, best first
+        :param write_rate: float: bytes/s the recording writes to a drive, 0 if unknown
+        :return: list of Path of the data folders
+        """
+        def key(drive):
+            fast = drive['write_MBps'] is None or drive['write_MBps'] * 2**20 >= self.margin * write_rate
+            return not fast, -drive['free_gb'], -(drive['write_MBps'] or 0)
+
+        return [drive['dir'] for drive in sorted(self.status(), key=key)]
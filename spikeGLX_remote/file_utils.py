@@ -0,0 +1,434 @@
+"""
+Helpers for background file jobs (copying, compressing) on the acquisition computer.
+These jobs compete with SpikeGLX for the same disks, so they can be throttled with an IOThrottle whose budget follows
+the recording state. Run as script for a dry run of syncing a session folder to the data server.
+"""
+import argparse
+import logging
+import os
+import shutil
+import threading
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from spikeGLX_remote.sglx_utils import read_meta
+
+log = logging.getLogger('file_utils')
+
+CHUNK_SIZE = 8 * 2**20  # bytes read/written per IO operation
+MTIME_TOLERANCE = 2.  # s, network shares and FAT store modification times coarsely
+PART_SIZE = 256 * 2**20  # bytes of a large file copied by one worker of a parallel copy
+
+
+class IOThrottle:
+    """
+    Token bucket limiting the bandwidth and the IO operations per second of background file jobs.
+    The budget is asked from a callback at most every poll_interval, so it can follow the recording state, e.g. be
+    limited while SpikeGLX is saving data and unlimited afterwards. The throttle is shared between threads.
+
+    :param budget: callable returning (bytes_per_s, ops_per_s), None for no limit, 0 to pause;
+        if None the throttle never limits
+    :param poll_interval: float: s between calls of budget, also the granularity of pauses
+
+    :parameter paused: bool: True while the budget pauses all jobs
+    """
+
+    def __init__(self, budget=None, poll_interval: float = 1.):
+        self.budget = budget
+        self.poll_interval = poll_interval
+        self.paused = False
+        self._rates = (None, None)
+        self._last_poll = None
+        self._last_refill = time.monotonic()
+        self._allowance = [0., 0.]  # bytes, ops; negative while in debt
+        self._lock = threading.Lock()
+
+    def get_rates(self) -> (float, float):
+        """
+        :return: (bytes_per_s, ops_per_s) of the current budget, polled at most every poll_interval
+        """
+        if self.budget is None:
+            return None, None
+        if self._last_poll is None or time.monotonic() - self._last_poll > self.poll_interval:
+            self._rates = self.budget()
+            self._last_poll = time.monotonic()
+        return self._rates
+
+    def _is_unlimited(self) -> bool:
+        return all(rate is None for rate in self.get_rates())
+
+    def _is_paused(self) -> bool:
+        return any(rate == 0 for rate in self.get_rates())
+
+    def consume(self, n_bytes: int, n_ops: int = 1):
+        """
+        Books n_bytes and n_ops against the budget, blocks while paused or until the budget allows them.
+        :param n_bytes: int: bytes read or written
+        :param n_ops: int: IO operations done
+        """
+        with self._lock:  # waiting threads queue up here, so the budget is shared between them
+            while self._is_paused():
+                if not self.paused:
+                    log.info("Background file jobs paused while SpikeGLX is saving data")
+                self.paused = True
+                time.sleep(self.poll_interval)
+            if self.paused:
+                log.info("Background file jobs resumed")
+                self.paused = False
+            now = time.monotonic()
+            elapsed = now - self._last_refill
+            self._last_refill = now
+            wait = 0.
+            for i, (rate, amount) in enumerate(zip(self.get_rates(), (n_bytes, n_ops))):
+                if rate is None:
+                    self._allowance[i] = 0.
+                    continue
+                # bursts of at most one second worth of budget
+                self._allowance[i] = min(rate, self._allowance[i] + elapsed * rate) - amount
+                wait = max(wait, -self._allowance[i] / rate)
+            deadline = now + wait
+            while time.monotonic() < deadline:
+                if self._is_unlimited():  # recording stopped, no need to pay off the debt
+                    self._allowance = [0., 0.]
+                    break
+                time.sleep(min(self.poll_interval, deadline - time.monotonic()))
+
+
+def throttled_copy(src: [str, Path], dst: [str, Path], throttle: [IOThrottle, None] = None,
+                   chunk_size: int = CHUNK_SIZE) -> Path:
+    """
+    Copies a file chunk-wise, booking every read and write against the throttle. Like shutil.copy2 dst can be a
+    directory and the file metadata is copied as well, so it can be used as copy_function of shutil.copytree.
+
+    :param src: file to copy
+    :param dst: target file or directory
+    :param throttle: IOThrottle: budget for the copy, None for no limit
+    :param chunk_size: int: bytes per read/write
+    :return: Path of the copied file
+    """
+    src, dst = Path(src), Path(dst)
+    if dst.is_dir():
+        dst = dst / src.name
+    with src.open('rb') as fsrc, dst.open('wb') as fdst:
+        while True:
+            if throttle is not None:
+                throttle.consume(chunk_size, 2)  # one read, one write
+            chunk = fsrc.read(chunk_size)
+            if not chunk:
+                break
+            fdst.write(chunk)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def _copy_range(src: Path, dst: Path, start: int, stop: int, throttle: [IOThrottle, None], chunk_size: int) -> int:
+    """copies bytes start to stop of src into the preallocated dst"""
+    with src.open('rb') as fsrc, dst.open('r+b') as fdst:
+        fsrc.seek(start)
+        fdst.seek(start)
+        pos = start
+        while pos < stop:
+            n_bytes = min(chunk_size, stop - pos)
+            if throttle is not None:
+                throttle.consume(n_bytes, 2)  # one read, one write
+            chunk = fsrc.read(n_bytes)
+            if not chunk:
+                raise OSError(f"{src} is shorter than expected")
+            fdst.write(chunk)
+            pos += len(chunk)
+    return stop - start
+
+
+def _finish_copy(src: Path, dst: Path):
+    """moves the completely copied <dst>.part into place"""
+    part = dst.with_name(dst.name + '.part')
+    os.replace(part, dst)
+    shutil.copystat(src, dst)
+
+
+def parallel_copy(pairs: list, throttle: [IOThrottle, None] = None, n_workers: int = 4, chunk_size: int = CHUNK_SIZE,
+                  part_size: int = PART_SIZE, progress=None) -> dict:
+    """
+    Copies files with several concurrent streams. Large files are split into parts of part_size that are copied
+    concurrently into a preallocated <dst>.part, so even a single large file uses all workers. A single stream to a
+    network share is limited by its latency, parallel streams fill the link. The throttle is shared by all workers.
+    A file is renamed to dst only once all its parts are copied, an interrupted copy leaves no dst of full size with
+    holes that a later sync would take for complete.
+
+    :param pairs: list of (src, dst) file paths
+    :param throttle: IOThrottle: budget for the copy, None for no limit
+    :param n_workers: int: number of concurrent streams
+    :param chunk_size: int: bytes per read/write
+    :param part_size: int: bytes per part of a large file
+    :param progress: callable(fraction, detail) called after each part
+    :return: dict with the number of files, bytes, seconds and the aggregate MBps
+    """
+    t_start = time.monotonic()
+    jobs = []
+    remaining = {}  # parts left to copy per destination
+    for src, dst in pairs:
+        src, dst = Path(src), Path(dst)
+        part = dst.with_name(dst.name + '.part')
+        size = src.stat().st_size
+        with part.open('wb') as f:
+            f.truncate(size)
+        starts = range(0, size, part_size)
+        remaining[dst] = len(starts)
+        jobs += [(src, dst, start, min(start + part_size, size)) for start in starts]
+        if not starts:  # empty file
+            _finish_copy(src, dst)
+    total = sum(stop - start for _, _, start, stop in jobs)
+    n_bytes = 0
+    with ThreadPoolExecutor(max(1, n_workers)) as pool:
+        futures = {pool.submit(_copy_range, src, dst.with_name(dst.name + '.part'), start, stop, throttle,
+                               chunk_size): (src, dst) for src, dst, start, stop in jobs}
+        for future in as_completed(futures):
+            n_bytes += future.result()  # raises the first error of a worker
+            src, dst = futures[future]
+            remaining[dst] -= 1
+            if not remaining[dst]:
+                _finish_copy(src, dst)
+            if progress is not None:
+                progress(n_bytes / total, f"{n_bytes / 2**30:.2f} GB copied")
+    seconds = time.monotonic() - t_start
+    report = {'files': len(pairs), 'bytes': n_bytes, 'seconds': seconds,
+              'MBps': n_bytes / 2**20 / seconds if seconds > 0 else 0.}
+    if pairs:
+        log.info(f"Copied {report['files']} files, {n_bytes / 2**30:.2f} GB in {seconds:.1f}s "
+                 f"({report['MBps']:.1f} MB/s with {n_workers} streams)")
+    return report
+
+
+def sync_file(src: [str, Path], dst: [str, Path], throttle: [IOThrottle, None] = None, block_size: int = CHUNK_SIZE,
+              dry_run: bool = False) -> dict:
+    """
+    Brings dst up to date with src, transferring only what is missing or changed, like rsync. Files with equal size
+    and modification time are skipped. A dst shorter than src whose last block matches src there is the start of an
+    interrupted copy, only the missing end is appended. For the others src and dst are compared block by block and
+    only differing blocks are written. Both files are accessible from here, so blocks are compared directly instead of
+    via hashes.
+
+    :param src: file to sync
+    :param dst: target file or directory
+    :param throttle: IOThrottle: budget for the sync, None for no limit
+    :param block_size: int: bytes per compared block
+    :param dry_run: bool: only report what would be transferred, judged from size and modification time without
+        reading the files, changed files count with their full size
+    :return: dict with file, action (copy, skip or update) and the bytes transferred (or to transfer on a dry run)
+    """
+    src, dst = Path(src), Path(dst)
+    if dst.is_dir():
+        dst = dst / src.name
+    src_size = src.stat().st_size
+    report = {'file': src.name, 'action': 'copy', 'bytes': src_size}
+    if not dst.exists():
+        if not dry_run:
+            throttled_copy(src, dst, throttle, block_size)
+        return report
+    dst_stat = dst.stat()
+    if dst_stat.st_size == src_size and abs(dst_stat.st_mtime - src.stat().st_mtime) <= MTIME_TOLERANCE:
+        report.update(action='skip', bytes=0)
+        return report
+    if dry_run:
+        missing = src_size - dst_stat.st_size
+        report.update(action='update', bytes=missing if 0 < missing < src_size else src_size)
+        return report
+    with src.open('rb') as fsrc, dst.open('r+b') as fdst:
+        if 0 < dst_stat.st_size < src_size and _same_block(fsrc, fdst, dst_stat.st_size, block_size, throttle):
+            n_changed = _copy_tail(fsrc, fdst, dst_stat.st_size, block_size, throttle)
+        else:
+            n_changed = _sync_blocks(fsrc, fdst, src_size, block_size, throttle)
+        fdst.truncate(src_size)
+    shutil.copystat(src, dst)
+    report.update(action='update', bytes=n_changed)
+    return report
+
+
+def _same_block(fsrc, fdst, end: int, block_size: int, throttle: [IOThrottle, None]) -> bool:
+    """compares the block of both files ending at end, the last one dst has"""
+    start = max(0, end - block_size)
+    if throttle is not None:
+        throttle.consume(2 * (end - start), 2)
+    fsrc.seek(start)
+    fdst.seek(start)
+    return fsrc.read(end - start) == fdst.read(end - start)
+
+
+def _copy_tail(fsrc, fdst, offset: int, block_size: int, throttle: [IOThrottle, None]) -> int:
+    """appends src from offset on to dst, returns the bytes written"""
+    fsrc.seek(offset)
+    fdst.seek(offset)
+    n_bytes = 0
+    while True:
+        if throttle is not None:
+            throttle.consume(2 * block_size, 2)  # read and write
+        block = fsrc.read(block_size)
+        if not block:
+            return n_bytes
+        fdst.write(block)
+        n_bytes += len(block)
+
+
+def _sync_blocks(fsrc, fdst, size: int, block_size: int, throttle: [IOThrottle, None]) -> int:
+    """compares src and dst block by block and writes the differing blocks, returns the bytes written"""
+    n_changed = 0
+    offset = 0
+    while offset < size:
+        if throttle is not None:
+            throttle.consume(2 * block_size, 2)  # read both sides
+        fsrc.seek(offset)
+        block = fsrc.read(block_size)
+        if not block:
+            break
+        fdst.seek(offset)
+        if block != fdst.read(len(block)):
+            n_changed += len(block)
+            if throttle is not None:
+                throttle.consume(len(block))
+            fdst.seek(offset)
+            fdst.write(block)
+        offset += len(block)
+    return n_changed
+
+
+def sync_folder(src: [str, Path], dst: [str, Path], throttle: [IOThrottle, None] = None, block_size: int = CHUNK_SIZE,
+                dry_run: bool = False, flat: bool = True, n_workers: int = 1, part_size: int = PART_SIZE,
+                progress=None) -> list:
+    """
+    syncs all files of a folder and its subfolders to dst, see sync_file. With several workers files missing at dst
+    are copied with parallel_copy and the others are compared concurrently.
+    :param src: folder to sync
+    :param dst: target folder
+    :param throttle: IOThrottle: budget for the sync, None for no limit
+    :param block_size: int: bytes per compared block
+    :param dry_run: bool: only report what would be transferred
+    :param flat: bool: put all files directly into dst like the copy of a session, else keep the subfolders
+    :param n_workers: int: number of concurrent streams
+    :param part_size: int: bytes per part of a large file copied in parallel
+    :param progress: callable(fraction, detail) called after each file
+    :return: list of the reports of sync_file
+    """
+    src, dst = Path(src), Path(dst)
+    pairs = [(file, dst / (file.name if flat else file.relative_to(src)))
+             for file in sorted(f for f in src.rglob('*') if f.is_file())]
+    if not dry_run:
+        for _, target in pairs:
+            target.parent.mkdir(exist_ok=True, parents=True)
+    if dry_run or n_workers <= 1:
+        reports = []
+        for file, target in pairs:
+            reports.append(sync_file(file, target, throttle, block_size, dry_run))
+            if progress is not None:
+                progress(len(reports) / len(pairs), file.name)
+        return reports
+    new = [(file, target) for file, target in pairs if not target.exists()]
+    parallel_copy(new, throttle, n_workers, block_size, part_size)
+    reports = [{'file': file.name, 'action': 'copy', 'bytes': file.stat().st_size} for file, _ in new]
+    if progress is not None and pairs:
+        progress(len(reports) / len(pairs), f"copied {len(new)} new files")
+    with ThreadPoolExecutor(n_workers) as pool:
+        for report in pool.map(lambda pair: sync_file(*pair, throttle, block_size),
+                               [pair for pair in pairs if pair not in new]):
+            reports.append(report)
+            if progress is not None:
+                progress(len(reports) / len(pairs), report['file'])
+    return reports
+
+
+def copy_folder(src: [str, Path], dst: [str, Path], flat: bool = True, sync: bool = True,
+                throttle: [IOThrottle, None] = None, chunk_size: int = CHUNK_SIZE, n_workers: int = 1,
+                part_size: int = PART_SIZE, dry_run: bool = False, progress=None) -> [list, None]:
+    """
+    copies a recorded folder to its session folder, with sync only what is missing or changed at dst
+    :param src: folder to copy
+    :param dst: target folder
+    :param flat: bool: put all files directly into dst like the copy of a session, else keep the subfolders
+    :param sync: bool: use sync_folder, else copy everything with parallel_copy
+    :param throttle: IOThrottle: budget for the copy, None for no limit
+    :param chunk_size: int: bytes per read/write
+    :param n_workers: int: number of concurrent streams
+    :param part_size: int: bytes per part of a large file copied in parallel
+    :param dry_run: bool: only report what would be transferred, implies sync
+    :param progress: callable(fraction, detail)
+    :return: list of the sync reports with sync, else None
+    """
+    src, dst = Path(src), Path(dst)
+    if sync or dry_run:
+        reports = sync_folder(src, dst, throttle, block_size=chunk_size, dry_run=dry_run, flat=flat,
+                              n_workers=n_workers, part_size=part_size, progress=progress)
+        log.info(f"{'Dry run ' if dry_run else ''}{src} -> {dst}: {summarize_sync(reports)}")
+        return reports
+    pairs = [(file, dst / (file.name if flat else file.relative_to(src)))
+             for file in src.rglob('*') if file.is_file()]
+    for _, target in pairs:
+        target.parent.mkdir(exist_ok=True, parents=True)
+    parallel_copy(pairs, throttle, n_workers=n_workers, chunk_size=chunk_size, part_size=part_size,
+                  progress=progress)
+    return None
+
+
+def file_sha1(file: [str, Path], throttle: [IOThrottle, None] = None, chunk_size: int = CHUNK_SIZE) -> str:
+    """
+    :param file: file to hash
+    :param throttle: IOThrottle: budget for reading, None for no limit
+    :param chunk_size: int: bytes per read
+    :return: str: SHA1 of the file content as lower case hex digest
+    """
+    sha1 = hashlib.sha1()
+    with Path(file).open('rb') as f:
+        while True:
+            if throttle is not None:
+                throttle.consume(chunk_size)
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def verify_recording(folder: [str, Path], throttle: [IOThrottle, None] = None, chunk_size: int = CHUNK_SIZE,
+                     progress=None) -> list:
+    """
+    checks every .bin file of a folder against the size and SHA1 SpikeGLX wrote to its meta file
+    :param folder: recorded folder, or its copy including the meta files
+    :param throttle: IOThrottle: budget for reading, None for no limit
+    :param chunk_size: int: bytes per read
+    :param progress: callable(fraction, detail) called after each file
+    :return: list of the names of files that do not match or have no complete meta file
+    """
+    bin_files = sorted(Path(folder).glob('*.bin'))
+    failed = []
+    for i, bin_file in enumerate(bin_files):
+        meta = read_meta(bin_file.with_suffix('.meta'))
+        if 'fileSHA1' not in meta or bin_file.stat().st_size != int(meta.get('fileSizeBytes', -1)):
+            failed.append(bin_file.name)
+        elif file_sha1(bin_file, throttle, chunk_size) != meta['fileSHA1'].lower():
+            failed.append(bin_file.name)
+        if progress is not None:
+            progress((i + 1) / len(bin_files), bin_file.name)
+    if failed:
+        log.error(f"Verification failed for {failed}")
+    return failed
+
+
+def summarize_sync(reports: list) -> str:
+    """:return: str: one line summary of the reports of sync_folder"""
+    counts = {action: sum(r['action'] == action for r in reports) for action in ('copy', 'update', 'skip')}
+    n_bytes = sum(r['bytes'] for r in reports)
+    return (f"{counts['copy']} files to copy, {counts['update']} to update, {counts['skip']} up to date, "
+            f"{n_bytes / 2**30:.2f} GB to transfer")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reports what syncing a session folder to the data server would '
+                                                 'transfer')
+    parser.add_argument('src', type=Path, help='recorded session folder')
+    parser.add_argument('dst', type=Path, help='session folder on the data server')
+    parser.add_argument('--keep_subfolders', action='store_true', help='keep subfolders instead of copying flat')
+    args = parser.parse_args()
+    sync_reports = sync_folder(args.src, args.dst, dry_run=True, flat=not args.keep_subfolders)
+    for r in sync_reports:
+        print(f"{r['action']:>7} {r['bytes'] / 2**20:>10.1f} MB  {r['file']}")
+    print(summarize_sync(sync_reports))
@@ -0,0 +1,173 @@
+"""
+Publishing of the live data of SpikeGLX to shared memory, see live_shm for the readers.
+A thread of the controller fetches the samples of the streams since its last fetch with c_sglx_fetch and writes them
+straight from the buffer of the SpikeGLX-api to the rings, SpikeGLX is fetched from once however many analysis
+processes read.
+"""
+import json
+import logging
+import math
+import threading
+import time
+from ctypes import POINTER, byref, c_int, c_short
+
+import numpy as np
+
+import spikeGLX_remote.sglx as sglx
+from spikeGLX_remote.live_shm import ALL_STREAMS, LIVE_PREFIX
+from spikeGLX_remote.sglx_sync import enumerate_streams, stream_name
+from spikeGLX_remote.shm_ring import ShmRing
+
+log = logging.getLogger('live_publish')
+
+INDEX_SLOT_SIZE = 2**16
+
+
+def get_acquired_channel_count(hSglx, js: int, ip: int) -> int:
+    """
+    :param hSglx: handle to the spikeglx api connection
+    :param js: int: stream type
+    :param ip: int: substream
+    :return: int: channels per sample fetched with channel subset -1 (all acquired), 0 on error
+    """
+    n_val = c_int()
+    if not sglx.c_sglx_getStreamAcqChans(byref(n_val), hSglx, js, ip):
+        return 0
+    return sum(sglx.c_sglx_getint(hSglx, i) for i in range(n_val.value))
+
+
+def _create_ring(name: str, n_slots: int, slot_size: int) -> ShmRing:
+    """creates a ring, replacing one left over by a controller that was not closed"""
+    try:
+        return ShmRing(name, n_slots, slot_size, create=True)
+    except FileExistsError:
+        log.warning(f"Replacing the stale shared memory {name}")
+        from multiprocessing import shared_memory
+        shared_memory.SharedMemory(name).unlink()
+        return ShmRing(name, n_slots, slot_size, create=True)
+
+
+class LivePublisher:
+    """
+    Publishes the live data of the streams of the current run to shared memory while the run lasts, see live_shm.
+    Start it once the run is started and stop it before the next run, the stream layout changes with it.
+
+    :param sglx_pool: SglxHandlePool: pool to check out the handle for the fetches from, one per cycle
+    :param streams: list: names of the streams to publish, e.g. ['imec0', 'nidq'], or ['all']
+    :param prefix: str: name of the index ring
+    :param block: float: s of data per fetch
+    :param seconds: float: s of data a ring holds, readers falling behind further lose blocks
+
+    :parameter published: dict: per stream name its blocks written and samples lost because SpikeGLX overwrote them
+        before they were fetched
+    """
+
+    def __init__(self, sglx_pool, streams: list, prefix: str = LIVE_PREFIX, block: float = 0.02,
+                 seconds: float = 1.):
+        self.sglx_pool = sglx_pool
+        self.stream_names = streams
+        self.prefix = prefix
+        self.block = block
+        self.seconds = seconds
+        self.published = {}
+        self._streams = []  # dict per published stream with js, ip, name, ring, n_channels, max_samps, next_ct
+        self._index = None
+        self._channels = (c_int * 1)(-1)  # all acquired channels
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _setup(self, hSglx) -> list:
+        """creates the rings of the streams of the current run, returns the index entries"""
+        entries = []
+        for js, ip in enumerate_streams(hSglx):
+            name = stream_name(js, ip)
+            if ALL_STREAMS not in self.stream_names and name not in self.stream_names:
+                continue
+            rate = sglx.c_sglx_getStreamSampleRate(hSglx, js, ip)
+            n_channels = get_acquired_channel_count(hSglx, js, ip)
+            if not rate or not n_channels:
+                log.error(f"Cant publish {name}: {sglx.c_sglx_getError(hSglx).decode()}")
+                continue
+            max_samps = max(1, int(rate * self.block * 2))  # room to catch up after a late cycle
+            ring = _create_ring(f"{self.prefix}_{name}", max(2, math.ceil(self.seconds / self.block)),
+                                max_samps * n_channels * 2)
+            self._streams.append({'js': js, 'ip': ip, 'name': name, 'ring': ring, 'n_channels': n_channels,
+                                  'max_samps': max_samps, 'next_ct': sglx.c_sglx_getStreamSampleCount(hSglx, js, ip)})
+            self.published[name] = {'blocks': 0, 'lost_samples': 0}
+            entries.append({'stream': name, 'ring': ring.name, 'n_channels': n_channels, 'sample_rate': rate,
+                            'dtype': 'int16'})
+        return entries
+
+    def start(self) -> bool:
+        """
+        creates the rings of the streams of the current run and starts publishing
+        :return: bool if any stream is published
+        """
+        if self.running:
+            self.stop()
+        self.published = {}
+        with self.sglx_pool.checkout() as hSglx:
+            if hSglx is None:
+                return False
+            entries = self._setup(hSglx)
+        if not entries:
+            log.warning(f"None of the streams {self.stream_names} in the run")
+            return False
+        self._index = _create_ring(self.prefix, 4, INDEX_SLOT_SIZE)
+        self._index.write(json.dumps({'time': time.time(), 'streams': entries}).encode())
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        log.info(f"Publishing {[entry['stream'] for entry in entries]} to shared memory {self.prefix}")
+        return True
+
+    def stop(self):
+        """stops publishing and removes the rings, attached readers keep what they mapped"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for stream in self._streams:
+            stream['ring'].close()
+        self._streams = []
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    def _fetch(self, hSglx, stream: dict) -> bool:
+        """
+        fetches the samples of a stream since the last fetch and writes them to its ring
+        :return: bool if the fetch was full, more samples are waiting
+        """
+        data, n_data = POINTER(c_short)(), c_int()
+        head_ct = sglx.c_sglx_fetch(byref(data), byref(n_data), hSglx, stream['js'], stream['ip'], stream['next_ct'],
+                                    stream['max_samps'], self._channels, 1, 1)
+        if not head_ct:
+            log.error(f"Fetching {stream['name']} failed: {sglx.c_sglx_getError(hSglx).decode()}")
+            return False
+        if head_ct > stream['next_ct']:  # SpikeGLX dropped the samples from its buffer already
+            self.published[stream['name']]['lost_samples'] += head_ct - stream['next_ct']
+        n_samps = n_data.value // stream['n_channels']
+        if not n_samps:
+            stream['next_ct'] = head_ct
+            return False
+        # written straight from the buffer of the DLL to the ring, valid until the next fetch with this handle
+        stream['ring'].write(np.ctypeslib.as_array(data, shape=(n_data.value,)), tag=head_ct)
+        stream['next_ct'] = head_ct + n_samps
+        self.published[stream['name']]['blocks'] += 1
+        return n_samps >= stream['max_samps']
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            t_start = time.perf_counter()
+            full = False
+            with self.sglx_pool.checkout() as hSglx:
+                if hSglx is not None:
+                    for stream in self._streams:
+                        full |= self._fetch(hSglx, stream)
+            if not full:
+                self._stop_event.wait(max(0., self.block - (time.perf_counter() - t_start)))
@@ -0,0 +1,64 @@
+"""
+Live data of SpikeGLX in shared memory, read side for analysis processes on the acquisition computer.
+The controller publishes the new samples of the streams in blocks to one shm_ring.ShmRing per stream, tagged with the
+sample index of their first sample, see live_publish. Analysis processes attach to the rings by name and map the blocks
+as numpy arrays, each at its own pace and on its own cores, without the SpikeGLX-api. A slow reader only loses blocks
+itself.
+The layout of the published streams (ring name, channel count, sample rate) is written as json to an index ring named
+by the prefix, readers look their stream up there.
+"""
+import json
+
+import numpy as np
+
+from spikeGLX_remote.shm_ring import ShmRing
+
+LIVE_PREFIX = 'sglx_live'  # name of the index ring, the rings of the streams are named <prefix>_<stream>
+ALL_STREAMS = 'all'
+
+
+class LiveReader:
+    """
+    Reads the blocks of one stream published by the controller, for analysis processes on the acquisition computer.
+    Attach after the run started, the rings are created anew with every run.
+
+    :param stream: str: stream name, e.g. imec0
+    :param prefix: str: name of the index ring, LIVE_SHM_PREFIX of the controller
+
+    :parameter n_channels: int: channels per sample, all acquired channels of the stream
+    :parameter sample_rate: float: Hz
+    :parameter ring: ShmRing: ring of the stream, ring.dropped counts the blocks this reader lost
+    """
+
+    def __init__(self, stream: str, prefix: str = LIVE_PREFIX):
+        index = ShmRing(prefix)
+        try:
+            record = index.view(index.head)
+            if record is None:
+                raise ValueError(f"Nothing published to {prefix}")
+            streams = {entry['stream']: entry for entry in json.loads(bytes(record[1]))['streams']}
+            del record
+        finally:
+            index.close()
+        if stream not in streams:
+            raise ValueError(f"Stream {stream} not published, only {list(streams)}")
+        self.stream = stream
+        self.n_channels = streams[stream]['n_channels']
+        self.sample_rate = streams[stream]['sample_rate']
+        self.ring = ShmRing(streams[stream]['ring'])
+
+    def read(self, copy: bool = True) -> [tuple, None]:
+        """
+        returns the next block
+        :param copy: bool: copy the block, else it is mapped from shared memory and only valid as long as
+            ring.valid(seq) is True after using it
+        :return: tuple (seq, first sample index, int16 array of shape (samples, n_channels)) or None if no new block
+        """
+        record = self.ring.read(copy=copy)
+        if record is None:
+            return None
+        seq, first_sample, data = record
+        return seq, first_sample, np.frombuffer(data, dtype=np.int16).reshape(-1, self.n_channels)
+
+    def close(self):
+        self.ring.close()
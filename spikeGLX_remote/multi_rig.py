@@ -0,0 +1,184 @@
+"""
+Control of several SpikeGLX instances as one, e.g. for dual-rig experiments.
+A control command is sent to all rigs at once from one thread per rig: every thread first checks out the control
+handle of its rig and then waits at a barrier, so the calls leave as close together as the threads get scheduled
+instead of one round-trip after the other. Per rig the time from issuing the call to its acknowledgement is measured,
+the skew is the spread of the issue and acknowledgement times over the rigs.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ctypes import byref, c_char_p
+
+import spikeGLX_remote.sglx as sglx
+from spikeGLX_remote.sglx_pool import SglxHandlePool
+
+log = logging.getLogger('multi_rig')
+
+MAIN_RIG = 'main'  # rig of SPIKEGLX_COMPUTER, its pool is shared with the controller
+
+
+class RigCoordinator:
+    """
+    Sends control commands concurrently to several SpikeGLX instances. If a command fails on some rigs it is undone on
+    the rigs where it succeeded, so the rigs never end up in different states, e.g. only one of them recording.
+
+    :param pools: dict: SglxHandlePool per rig name
+    :param timeout: float: s to wait for all rigs to be ready to issue a command
+
+    :parameter last_report: dict: report of the last command, see fan_out
+    """
+
+    def __init__(self, pools: dict, timeout: float = 5.):
+        self.pools = pools
+        self.timeout = timeout
+        self.last_report = None
+        self._executor = ThreadPoolExecutor(max_workers=len(pools))  # threads stay warm between commands
+        self._lock = threading.Lock()  # one command at a time, each needs all threads
+
+    @classmethod
+    def from_config(cls, main_pool: SglxHandlePool, rigs: dict, **kwargs) -> 'RigCoordinator':
+        """
+        :param main_pool: SglxHandlePool: pool of the rig the controller runs with
+        :param rigs: dict: (host, port) of the further rigs per name
+        """
+        pools = {MAIN_RIG: main_pool}
+        pools.update({name: SglxHandlePool(host, port, size=1) for name, (host, port) in rigs.items()})
+        return cls(pools, **kwargs)
+
+    @property
+    def connected(self) -> bool:
+        return all(pool.connected for pool in self.pools.values())
+
+    def connect(self) -> bool:
+        """
+        connects all rigs that are not connected yet
+        :return: bool if all rigs are connected
+        """
+        for name, pool in self.pools.items():
+            if not pool.connected and not pool.connect():
+                log.error(f"Cant connect to rig {name} at {pool.host}:{pool.port}: {pool.last_error}")
+        return self.connected
+
+    def close(self):
+        """closes the pools of the further rigs, the main pool belongs to the controller"""
+        for name, pool in self.pools.items():
+            if name != MAIN_RIG:
+                pool.close()
+        self._executor.shutdown()
+
+    def _call(self, name: str, call, barrier: threading.Barrier, held) -> dict:
+        """runs call(hSglx) on one rig once all rigs are ready, returns its result entry"""
+        result = {'ok': False, 'ack_ms': None, 'error': None}
+        if held is not None:
+            return self._timed_call(call, held, barrier, result)
+        with self.pools[name].checkout(control=True) as hSglx:
+            return self._timed_call(call, hSglx, barrier, result)
+
+    def _timed_call(self, call, hSglx, barrier: threading.Barrier, result: dict) -> dict:
+        try:
+            barrier.wait(self.timeout)
+        except threading.BrokenBarrierError:
+            result['error'] = 'not all rigs ready'
+            return result
+        if hSglx is None:
+            result['error'] = 'not connected'
+            return result
+        result['issued'] = time.perf_counter()
+        result['ok'] = bool(call(hSglx))
+        result['acked'] = time.perf_counter()
+        result['ack_ms'] = round((result['acked'] - result['issued']) * 1000, 3)
+        if not result['ok']:
+            result['error'] = sglx.c_sglx_getError(hSglx).decode()
+        return result
+
+    def fan_out(self, call, rigs: [list, None] = None, held: [dict, None] = None) -> dict:
+        """
+        runs a command on several rigs at once
+        :param call: callable(hSglx) -> bool, a SpikeGLX-api call
+        :param rigs: list: names of the rigs, all if None
+        :param held: dict: control handles per rig name the caller already checked out
+        :return: dict with ok (all rigs succeeded), per rig in rigs its ok, ack_ms and error, issue_skew_ms and
+            ack_skew_ms (spread of the issue and acknowledgement times over the rigs)
+        """
+        rigs = list(self.pools) if rigs is None else rigs
+        if not rigs:
+            return {'ok': True, 'rigs': {}, 'issue_skew_ms': None, 'ack_skew_ms': None}
+        held = held or {}
+        with self._lock:
+            barrier = threading.Barrier(len(rigs))
+            futures = {name: self._executor.submit(self._call, name, call, barrier, held.get(name)) for name in rigs}
+            results = {name: future.result() for name, future in futures.items()}
+        issued = [r.pop('issued') for r in results.values() if 'issued' in r]
+        acked = [r.pop('acked') for r in results.values() if 'acked' in r]
+        report = {'ok': all(r['ok'] for r in results.values()), 'rigs': results,
+                  'issue_skew_ms': round((max(issued) - min(issued)) * 1000, 3) if issued else None,
+                  'ack_skew_ms': round((max(acked) - min(acked)) * 1000, 3) if acked else None}
+        for name, result in results.items():
+            if not result['ok']:
+                log.error(f"Rig {name}: {result['error']}")
+        self.last_report = report
+        return report
+
+    def _all_or_none(self, call, undo, held: [dict, None] = None) -> dict:
+        """fans out call and undoes it on the rigs where it succeeded if it failed on any other"""
+        report = self.fan_out(call, held=held)
+        succeeded = [name for name, result in report['rigs'].items() if result['ok']]
+        if not report['ok'] and succeeded:
+            log.warning(f"Undoing the command on rigs {succeeded}")
+            undo_report = self.fan_out(undo, rigs=succeeded, held=held)
+            report['undone'] = [name for name, result in undo_report['rigs'].items() if result['ok']]
+            self.last_report = report
+        return report
+
+    def start_run(self, run_name: str, held: [dict, None] = None) -> dict:
+        """
+        starts a run with the same name on all rigs, stops it again on all if it fails on one
+        :param run_name: str: run name
+        :param held: dict: control handles per rig name the caller already checked out
+        :return: dict: report, see fan_out
+        """
+        return self._all_or_none(lambda h: sglx.c_sglx_startRun(h, run_name.encode()), sglx.c_sglx_stopRun, held)
+
+    def stop_run(self, held: [dict, None] = None) -> dict:
+        """stops the runs of all rigs, see fan_out for the report"""
+        return self.fan_out(sglx.c_sglx_stopRun, held=held)
+
+    def set_recording(self, enable: bool, held: [dict, None] = None) -> dict:
+        """
+        enables or disables the recording on all rigs. If enabling fails on a rig, the recording is disabled again on
+        the others.
+        :param enable: bool: enable recording
+        :param held: dict: control handles per rig name the caller already checked out
+        :return: dict: report, see fan_out
+        """
+        if enable:
+            return self._all_or_none(lambda h: sglx.c_sglx_setRecordingEnable(h, 1),
+                                     lambda h: sglx.c_sglx_setRecordingEnable(h, 0), held)
+        return self.fan_out(lambda h: sglx.c_sglx_setRecordingEnable(h, 0), held=held)
+
+    def set_next_file_names(self, session_id: str, rigs: [list, None] = None, file_name: [str, None] = None) -> dict:
+        """
+        sets the next file name of the rigs to <data directory of the rig>/<file_name>. The files go directly into
+        the data directory: SpikeGLX creates no folders for a set file name and the data directory is the only one
+        known to exist on the computer of the rig, the controller cannot create a session folder there. The file names
+        start with the session id, so the sessions stay apart.
+        :param session_id: str: session id
+        :param rigs: list: names of the rigs, by default all but the main rig whose folder the controller creates
+        :param file_name: str: file name without folder starting with the session id, e.g. of a trial, session_id if
+            None
+        :return: dict: report, see fan_out
+        """
+        file_name = session_id if file_name is None else file_name
+
+        def set_name(hSglx) -> bool:
+            data_dir = c_char_p()
+            if not sglx.c_sglx_getDataDir(byref(data_dir), hSglx, 0) or not data_dir.value:
+                return False
+            # the rigs may run another OS than this computer, keep the separators of their data directory
+            separator = '\\' if '\\' in data_dir.value.decode() else '/'
+            path = separator.join((data_dir.value.decode().rstrip(separator), file_name))
+            return sglx.c_sglx_setNextFileName(hSglx, path.encode())
+
+        return self.fan_out(set_name, rigs=[name for name in self.pools if name != MAIN_RIG] if rigs is None else rigs)
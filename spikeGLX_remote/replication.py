@@ -0,0 +1,186 @@
+"""
+Replication of recording files to the data server while SpikeGLX is still writing them.
+SpikeGLX only appends to the binary files, so after the first pass only the bytes added since the last pass are sent.
+The meta files are rewritten by SpikeGLX when it closes a binary file, so small files are copied as a whole whenever
+they change.
+"""
+import hashlib
+import logging
+import threading
+import time
+from pathlib import Path
+
+from spikeGLX_remote.file_utils import CHUNK_SIZE, throttled_copy
+from spikeGLX_remote.sglx_utils import is_file_closed, read_live_meta
+
+log = logging.getLogger('replication')
+
+
+class FileTail:
+    """
+    Follows one growing file and appends the bytes added since the last call to the destination file.
+    The SHA1 of everything sent is kept, so the copy can be checked against the fileSHA1 SpikeGLX writes to the meta
+    file without reading the data again.
+
+    :param src: Path: growing file
+    :param dst: Path: destination file, truncated on creation
+    :param throttle: file_utils.IOThrottle: budget for reading and writing, None for no limit
+    :param chunk_size: int: bytes per read/write
+
+    :parameter offset: int: bytes replicated so far
+    """
+
+    def __init__(self, src: Path, dst: Path, throttle=None, chunk_size: int = CHUNK_SIZE):
+        self.src = Path(src)
+        self.dst = Path(dst)
+        self.throttle = throttle
+        self.chunk_size = chunk_size
+        self.offset = 0
+        self.sha1 = hashlib.sha1()
+        self.dst.parent.mkdir(exist_ok=True, parents=True)
+        self.dst.open('wb').close()  # start from scratch, the SHA1 has to cover the whole file
+
+    def replicate(self) -> int:
+        """
+        sends the bytes appended to src since the last call
+        :return: int: number of bytes sent
+        """
+        size = self.src.stat().st_size
+        if size < self.offset:
+            raise OSError(f"{self.src} got shorter while replicating it")
+        n_sent = 0
+        with self.src.open('rb') as fsrc, self.dst.open('r+b') as fdst:
+            fsrc.seek(self.offset)
+            fdst.seek(self.offset)
+            while self.offset < size:
+                n_bytes = min(self.chunk_size, size - self.offset)
+                if self.throttle is not None:
+                    self.throttle.consume(n_bytes, 2)  # one read, one write
+                chunk = fsrc.read(n_bytes)
+                if not chunk:
+                    break
+                fdst.write(chunk)
+                self.sha1.update(chunk)
+                self.offset += len(chunk)
+                n_sent += len(chunk)
+        return n_sent
+
+    def verify(self, expected_sha1: [str, None]) -> bool:
+        """
+        :param expected_sha1: str: SHA1 of the source file as SpikeGLX puts it into the meta file when closing it,
+            None if it is not there yet
+        :return: bool if the destination has the size of the source and the sent data matches expected_sha1, False
+            without expected_sha1 as the copy cannot be verified then
+        """
+        size = self.src.stat().st_size
+        if self.offset != size or self.dst.stat().st_size != size:
+            log.error(f"Size of {self.dst} does not match {self.src}")
+            return False
+        if not expected_sha1:
+            log.error(f"No SHA1 of {self.src} in its meta file, cant verify {self.dst}")
+            return False
+        if expected_sha1.lower() != self.sha1.hexdigest():
+            log.error(f"SHA1 of {self.dst} does not match {self.src}")
+            return False
+        return True
+
+
+class LiveReplicator:
+    """
+    Replicates a recording folder to the data server in a background thread while SpikeGLX writes it. Binary files are
+    followed with a FileTail each, small files (meta files, event log) are copied when their size or modification time
+    changed. On stop the replicator waits for SpikeGLX to close the binary files, catches up and verifies every binary
+    file against the SHA1 in its meta file.
+
+    :param folder: Path: recording folder
+    :param destination: Path: folder on the data server, the files are put directly into it
+    :param interval: float: s between passes over the files
+    :param tail_patterns: tuple: glob patterns of the growing binary files
+    :param copy_patterns: tuple: glob patterns of the small files copied as a whole
+    :param throttle: file_utils.IOThrottle: budget for reading and writing, None for no limit
+    :param chunk_size: int: bytes per read/write
+
+    :parameter tails: dict: FileTail per binary file
+    :parameter failed: list: binary files whose copy did not verify
+    :parameter verified: bool: True once stop verified all files
+    """
+
+    def __init__(self, folder: Path, destination: Path, interval: float = 10., tail_patterns: tuple = ('*.bin',),
+                 copy_patterns: tuple = ('*.meta', '*.events.jsonl'), throttle=None, chunk_size: int = CHUNK_SIZE):
+        self.folder = Path(folder)
+        self.destination = Path(destination)
+        self.interval = interval
+        self.tail_patterns = tail_patterns
+        self.copy_patterns = copy_patterns
+        self.throttle = throttle
+        self.chunk_size = chunk_size
+        self.tails = {}
+        self.failed = []
+        self.verified = False
+        self._copied = {}  # (size, mtime) of the small files when they were last copied
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """starts replicating in a background thread"""
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        log.info(f"Replicating {self.folder} to {self.destination} while recording")
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.step()
+            except OSError as e:
+                log.error(f"Error replicating while recording: {e}")
+            self._stop_event.wait(self.interval)
+
+    def _glob(self, patterns: tuple) -> list:
+        return sorted({f for pattern in patterns for f in self.folder.glob(pattern)})
+
+    def step(self) -> int:
+        """
+        one pass over all files: appends new data of the binary files and copies changed small files
+        :return: int: number of bytes sent
+        """
+        n_sent = 0
+        for src in self._glob(self.tail_patterns):
+            if src not in self.tails:
+                self.tails[src] = FileTail(src, self.destination / src.name, self.throttle, self.chunk_size)
+            n_sent += self.tails[src].replicate()
+        for src in self._glob(self.copy_patterns):
+            stat = src.stat()
+            if self._copied.get(src) != (stat.st_size, stat.st_mtime):
+                throttled_copy(src, self.destination, self.throttle, self.chunk_size)
+                self._copied[src] = (stat.st_size, stat.st_mtime)
+                n_sent += stat.st_size
+        return n_sent
+
+    def stop(self, timeout: float = 10.) -> bool:
+        """
+        stops replicating, waits up to timeout for SpikeGLX to close the binary files, catches up and verifies them
+        :param timeout: float: s to wait for SpikeGLX to close the files
+        :return: bool if all files were replicated and verified
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if all(is_file_closed(f, read_live_meta(f.with_suffix('.meta'))) for f in self._glob(self.tail_patterns)):
+                break
+            time.sleep(0.2)
+        else:
+            log.warning("SpikeGLX did not close all files in time, replicating them as they are")
+        try:
+            self.step()
+        except OSError as e:
+            log.error(f"Error catching up the replication: {e}")
+            return False
+        self.failed = [src for src, tail in self.tails.items()
+                       if not tail.verify(read_live_meta(src.with_suffix('.meta')).get('fileSHA1'))]
+        self.verified = not self.failed
+        if self.verified:
+            log.info(f"Replicated and verified {len(self.tails)} files in {self.destination}")
+        return self.verified
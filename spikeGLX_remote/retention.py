@@ -0,0 +1,222 @@
+"""
+Retention of recorded sessions on the acquisition drives. Sessions are only deleted once their copy on the data server
+is verified, oldest first and only as many as needed to get back to the free space target. Deleting runs in a
+background thread and is throttled, as deleting thousands of files competes with SpikeGLX for the disk like any other
+file job.
+
+Run as script to show which sessions a policy would delete.
+"""
+import argparse
+import logging
+import shutil
+import threading
+from pathlib import Path
+
+from spikeGLX_remote.file_utils import file_sha1
+from spikeGLX_remote.session_index import SessionIndex
+
+log = logging.getLogger('retention')
+
+
+class RetentionPolicy:
+    """
+    Frees space on the data folder by deleting sessions whose copy on the data server is verified. Sessions that are
+    only copied can be verified on the fly: every .bin file on the data server is checked against the SHA1 SpikeGLX
+    wrote to the local meta file. Sessions copied compressed or without a SHA1 in the meta files cant be verified
+    this way and are kept.
+
+    :param index: SessionIndex: index of the data folder
+    :param free_gb: float: free space in GB to reach
+    :param min_age: float: s since the last change of a session before it may be deleted
+    :param verify_copies: bool: verify copied sessions that are not verified yet before deleting them
+    :param throttle: file_utils.IOThrottle: budget for verifying and deleting, None for no limit
+    :param protected: callable returning the folders that must not be deleted, e.g. the current recording
+    :param interval: float: s between checks of the free space in the background
+
+    :parameter deleted: list: sessions deleted so far
+    """
+
+    def __init__(self, index: SessionIndex, free_gb: float, min_age: float = 86400., verify_copies: bool = True,
+                 throttle=None, protected=None, interval: float = 600.):
+        self.index = index
+        self.free_gb = free_gb
+        self.min_age = min_age
+        self.verify_copies = verify_copies
+        self.throttle = throttle
+        self.protected = protected
+        self.interval = interval
+        self.deleted = []
+        self._trigger = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def root(self) -> Path:
+        return self.index.root
+
+    def free_bytes(self) -> int:
+        return shutil.disk_usage(self.root).free
+
+    def _protected_sessions(self) -> set:
+        if self.protected is None:
+            return set()
+        sessions = set()
+        for folder in self.protected():
+            if folder is None:
+                continue
+            try:
+                sessions.add(Path(folder).relative_to(self.root).parts[0])
+            except (ValueError, IndexError):  # not in the data folder
+                continue
+        return sessions
+
+    def candidates(self) -> list:
+        """
+        :return: list of the session dicts of the index that may be deleted, oldest first
+        """
+        protected = self._protected_sessions()
+        candidates = [s for s in self.index.list_sessions(copied=True, older_than=self.min_age)
+                      if s['session'] not in protected]
+        if not self.verify_copies:
+            candidates = [s for s in candidates if s['verified_at'] is not None]
+        return candidates
+
+    def plan(self) -> list:
+        """
+        picks the sessions to delete to reach the free space target, oldest first, without deleting anything
+        :return: list of session dicts of the index, see SessionIndex.list_sessions
+        """
+        missing = self.free_gb * 2**30 - self.free_bytes()
+        if missing <= 0:
+            return []
+        selected = []
+        for session in self.candidates():
+            if missing <= 0:
+                break
+            selected.append(session)
+            missing -= session['bytes']
+        return selected
+
+    def verify_copy(self, session: dict) -> bool:
+        """
+        checks the .bin files of a session on the data server against the SHA1 of the local meta files, marks the
+        session verified in the index if all match
+        :param session: dict: session of the index
+        :return: bool if verified
+        """
+        if session['verified_at'] is not None:
+            return True
+        destination = Path(session['copied_to'])
+        bin_files = [f for f in self.index.get_files(session['session']) if f['name'].endswith('.bin')]
+        if not bin_files:
+            return False
+        for file in bin_files:
+            if not file['sha1']:
+                log.warning(f"No SHA1 for {file['name']}, cant verify the copy of {session['session']}")
+                return False
+            # sessions are copied flat, test sessions keep their subfolders
+            copies = [destination / Path(file['name']).name, destination / file['name']]
+            copy = next((c for c in copies if c.is_file() and c.stat().st_size == file['size']), None)
+            try:
+                if copy is None or file_sha1(copy, self.throttle) != file['sha1'].lower():
+                    log.warning(f"Copy of {file['name']} on the data server does not match, keeping "
+                                f"{session['session']}")
+                    return False
+            except OSError as e:
+                log.error(f"Cant read the copy of {file['name']}: {e}")
+                return False
+        self.index.mark_verified(self.root / session['session'])
+        return True
+
+    def delete_session(self, session: str) -> int:
+        """
+        deletes a session folder file by file, throttled by IO operations
+        :param session: str: session name
+        :return: int: bytes freed
+        """
+        folder = self.root / session
+        freed = 0
+        for file in sorted((f for f in folder.rglob('*') if f.is_file()), reverse=True):
+            if self.throttle is not None:
+                self.throttle.consume(0)
+            size = file.stat().st_size
+            file.unlink()
+            freed += size
+        for directory in sorted((d for d in folder.rglob('*') if d.is_dir()), key=lambda d: len(d.parts),
+                                reverse=True):
+            directory.rmdir()
+        folder.rmdir()
+        self.index.remove(session)
+        self.deleted.append(session)
+        log.info(f"Deleted session {session}, freed {freed / 2**30:.2f} GB")
+        return freed
+
+    def enforce(self) -> int:
+        """
+        deletes verified sessions until the free space target is reached, sessions whose copy does not verify are
+        skipped in favour of the next ones
+        :return: int: bytes freed
+        """
+        self.index.scan()
+        freed = 0
+        if self.free_bytes() >= self.free_gb * 2**30:
+            return freed
+        for session in self.candidates():
+            if self.free_bytes() >= self.free_gb * 2**30 or self._stop_event.is_set():
+                break
+            if session['session'] in self._protected_sessions():  # e.g. a recording started meanwhile
+                continue
+            if not self.verify_copy(session):
+                continue
+            try:
+                freed += self.delete_session(session['session'])
+            except OSError as e:
+                log.error(f"Error deleting session {session['session']}: {e}")
+        if self.free_bytes() < self.free_gb * 2**30:
+            log.warning(f"Only {self.free_bytes() / 2**30:.0f} GB free on {self.root} after deleting all verified "
+                        f"sessions, target is {self.free_gb} GB")
+        return freed
+
+    def start(self):
+        """checks the free space every interval in a background thread"""
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def trigger(self):
+        """checks the free space right away instead of waiting for the interval"""
+        self._trigger.set()
+
+    def stop(self):
+        """stops the background thread after the session it is currently deleting"""
+        self._stop_event.set()
+        self._trigger.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.enforce()
+            except OSError as e:
+                log.error(f"Error enforcing the retention policy: {e}")
+            self._trigger.wait(self.interval)
+            self._trigger.clear()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Shows which sessions the retention policy would delete')
+    parser.add_argument('root', type=Path, help='data folder')
+    parser.add_argument('free_gb', type=float, help='free space to reach in GB')
+    parser.add_argument('--min_age', type=float, default=1., help='days since the last change of a session')
+    parser.add_argument('--delete', action='store_true', help='delete the sessions after verifying their copies')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    policy = RetentionPolicy(SessionIndex(args.root), args.free_gb, min_age=args.min_age * 86400)
+    if args.delete:
+        print(f"Freed {policy.enforce() / 2**30:.2f} GB")
+    else:
+        policy.index.scan()
+        for s in policy.plan():
+            print(f"{s['session']:<40} {s['bytes'] / 2**30:>8.2f} GB {'verified' if s['verified_at'] else 'copied'} "
+                  f"to {s['copied_to']}")
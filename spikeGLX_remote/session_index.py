@@ -0,0 +1,279 @@
+"""
+Index of the recorded sessions in the data folder, kept in an SQLite database next to the data.
+Every direct subfolder of the data folder is a session. Per session the index holds the files with their stream, size
+and duration from the meta file, the SHA1 SpikeGLX wrote to the meta file, and whether the session was compressed,
+copied to the data server and verified there. A scan only reads the meta files of files whose size or modification
+time changed since the last scan, session folders are scanned in parallel.
+
+Run as script to scan a data folder and list its sessions.
+"""
+import argparse
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from spikeGLX_remote.sglx_utils import get_num_saved_channels, get_sample_rate, read_meta
+
+log = logging.getLogger('session_index')
+
+INDEX_FILE = '.session_index.sqlite'
+COMPRESSED_SUFFIXES = ('.cbin', '.zbin', '.lzbin')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session TEXT PRIMARY KEY,   -- folder relative to the data folder
+    mtime REAL,                 -- latest modification of any file
+    n_files INTEGER,
+    bytes INTEGER,              -- all files including the compressed copies
+    duration REAL,              -- s of the longest stream
+    streams TEXT,               -- comma separated, e.g. imec0.ap,imec0.lf,nidq
+    compressed INTEGER,         -- 1 if the session folder holds compressed files
+    copied_to TEXT,             -- session folder on the data server
+    copied_at REAL,
+    verified_at REAL,           -- time the copy on the data server was verified
+    indexed_at REAL
+);
+CREATE TABLE IF NOT EXISTS files (
+    session TEXT,
+    name TEXT,                  -- path relative to the session folder
+    stream TEXT,
+    size INTEGER,
+    mtime REAL,
+    sample_rate REAL,
+    n_channels INTEGER,
+    duration REAL,
+    sha1 TEXT,                  -- fileSHA1 of the meta file, set once SpikeGLX closed the file
+    PRIMARY KEY (session, name)
+);
+"""
+
+
+def _stream(file: Path) -> [str, None]:
+    """stream of a recorded file as in its name, e.g. imec0.ap or nidq, None for other files"""
+    if file.suffix not in ('.bin', '.meta') + COMPRESSED_SUFFIXES or len(file.suffixes) < 2:
+        return None
+    if file.suffixes[-2] in ('.ap', '.lf') and len(file.suffixes) >= 3:
+        return f"{file.suffixes[-3][1:]}{file.suffixes[-2]}"
+    return file.suffixes[-2][1:]
+
+
+def _scan_session(folder: Path, known: dict) -> (list, list):
+    """
+    stats all files of a session folder and reads the meta files of .bin files that changed
+    :param folder: Path: session folder
+    :param known: dict: (size, mtime) per file name from the last scan
+    :return: (rows of new or changed files, names of removed files)
+    """
+    stats = {}
+    for file in folder.rglob('*'):
+        if file.is_file():
+            stat = file.stat()
+            stats[file.relative_to(folder).as_posix()] = (file, stat.st_size, stat.st_mtime)
+    rows = []
+    for name, (file, size, mtime) in stats.items():
+        changed = known.get(name) != (size, mtime)
+        meta_name = Path(name).with_suffix('.meta').as_posix()
+        if file.suffix == '.bin' and meta_name in stats:
+            changed |= known.get(meta_name) != stats[meta_name][1:]  # rewritten by SpikeGLX when closing the file
+        if not changed:
+            continue
+        row = {'name': name, 'stream': _stream(file), 'size': size, 'mtime': mtime, 'sample_rate': None,
+               'n_channels': None, 'duration': None, 'sha1': None}
+        if file.suffix == '.bin':
+            meta = read_meta(file.with_suffix('.meta'))
+            if meta:
+                try:
+                    row['sample_rate'] = get_sample_rate(meta)
+                    row['n_channels'] = get_num_saved_channels(meta)
+                    row['duration'] = size / (2 * row['n_channels'] * row['sample_rate'])
+                except (KeyError, ValueError, ZeroDivisionError):
+                    log.warning(f"Incomplete meta file of {file}")
+                row['sha1'] = meta.get('fileSHA1')
+        rows.append(row)
+    return rows, [name for name in known if name not in stats]
+
+
+class SessionIndex:
+    """
+    SQLite index of the sessions in a data folder. The index is safe to use from several threads.
+
+    :param root: Path: data folder, each subfolder is a session
+    :param db_path: Path: database file, by default INDEX_FILE in root
+    """
+
+    def __init__(self, root: [str, Path], db_path: [str, Path, None] = None):
+        self.root = Path(root)
+        self.db_path = Path(db_path) if db_path is not None else self.root / INDEX_FILE
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def scan(self, n_workers: int = 4) -> dict:
+        """
+        brings the index up to date with the data folder, only changed files are read
+        :param n_workers: int: number of session folders scanned in parallel
+        :return: dict with the number of sessions, sessions updated and sessions removed
+        """
+        t_start = time.monotonic()
+        folders = sorted(f for f in self.root.iterdir() if f.is_dir() and not f.name.startswith('.'))
+        with self._lock:
+            known = {}
+            for row in self._db.execute("SELECT session, name, size, mtime FROM files"):
+                known.setdefault(row['session'], {})[row['name']] = (row['size'], row['mtime'])
+        with ThreadPoolExecutor(max(1, n_workers)) as pool:
+            results = pool.map(lambda f: _scan_session(f, known.get(f.name, {})), folders)
+            changes = {folder.name: result for folder, result in zip(folders, results)}
+        removed = [session for session in known if session not in changes]
+        updated = [session for session, (rows, gone) in changes.items()
+                   if rows or gone or session not in known]
+        with self._lock, self._db:
+            for session in removed:
+                self._db.execute("DELETE FROM files WHERE session = ?", (session,))
+                self._db.execute("DELETE FROM sessions WHERE session = ?", (session,))
+            for session in updated:
+                self._store_session(session, *changes[session])
+        log.info(f"Indexed {len(folders)} sessions in {time.monotonic() - t_start:.1f}s, {len(updated)} updated, "
+                 f"{len(removed)} removed")
+        return {'sessions': len(folders), 'updated': len(updated), 'removed': len(removed)}
+
+    def scan_session(self, folder: [str, Path]) -> bool:
+        """
+        brings the index up to date with one session, e.g. after it was copied, without scanning the whole data folder
+        :param folder: Path: session folder, or folder or file in it
+        :return: bool if the session changed
+        """
+        session = self._session(folder)
+        with self._lock:
+            known = {row['name']: (row['size'], row['mtime']) for row in
+                     self._db.execute("SELECT name, size, mtime FROM files WHERE session = ?", (session,))}
+            indexed = self._db.execute("SELECT 1 FROM sessions WHERE session = ?", (session,)).fetchone() is not None
+        if not (self.root / session).is_dir():
+            self.remove(session)
+            return indexed
+        rows, gone = _scan_session(self.root / session, known)
+        if not (rows or gone or not indexed):
+            return False
+        with self._lock, self._db:
+            self._store_session(session, rows, gone)
+        return True
+
+    def _store_session(self, session: str, rows: list, gone: list):
+        """writes the changed and removed files of a session, the caller holds the lock and the transaction"""
+        self._db.executemany("DELETE FROM files WHERE session = ? AND name = ?", [(session, name) for name in gone])
+        self._db.executemany(
+            "INSERT OR REPLACE INTO files VALUES (:session, :name, :stream, :size, :mtime, :sample_rate, "
+            ":n_channels, :duration, :sha1)", [{'session': session, **row} for row in rows])
+        self._update_session(session)
+
+    def _update_session(self, session: str):
+        """recomputes the summary of a session from its files, a copy older than the files is no longer valid"""
+        files = self._db.execute("SELECT * FROM files WHERE session = ?", (session,)).fetchall()
+        streams = sorted({f['stream'] for f in files if f['stream'] and f['name'].endswith('.bin')})
+        durations = [f['duration'] for f in files if f['duration'] is not None]
+        summary = {'session': session, 'mtime': max((f['mtime'] for f in files), default=None),
+                   'n_files': len(files), 'bytes': sum(f['size'] for f in files),
+                   'duration': max(durations, default=None), 'streams': ','.join(streams),
+                   'compressed': int(any(f['name'].endswith(COMPRESSED_SUFFIXES) for f in files)),
+                   'indexed_at': time.time()}
+        self._db.execute(
+            "INSERT INTO sessions (session, mtime, n_files, bytes, duration, streams, compressed, indexed_at) "
+            "VALUES (:session, :mtime, :n_files, :bytes, :duration, :streams, :compressed, :indexed_at) "
+            "ON CONFLICT(session) DO UPDATE SET mtime = excluded.mtime, n_files = excluded.n_files, "
+            "bytes = excluded.bytes, duration = excluded.duration, streams = excluded.streams, "
+            "compressed = excluded.compressed, indexed_at = excluded.indexed_at, "
+            "copied_at = CASE WHEN copied_at < excluded.mtime THEN NULL ELSE copied_at END, "
+            "verified_at = CASE WHEN verified_at < excluded.mtime THEN NULL ELSE verified_at END", summary)
+
+    def _session(self, folder: [str, Path]) -> str:
+        folder = Path(folder)
+        return folder.relative_to(self.root).parts[0] if folder.is_absolute() else folder.parts[0]
+
+    def mark_copied(self, folder: [str, Path], destination: [str, Path]):
+        """
+        records that a session was copied to the data server
+        :param folder: Path: session folder, or folder or file in it
+        :param destination: Path: session folder on the data server
+        """
+        with self._lock, self._db:
+            self._db.execute("UPDATE sessions SET copied_to = ?, copied_at = ? WHERE session = ?",
+                             (str(destination), time.time(), self._session(folder)))
+
+    def mark_verified(self, folder: [str, Path]):
+        """
+        records that the copy of a session on the data server was verified
+        :param folder: Path: session folder, or folder or file in it
+        """
+        with self._lock, self._db:
+            self._db.execute("UPDATE sessions SET verified_at = ? WHERE session = ? AND copied_at IS NOT NULL",
+                             (time.time(), self._session(folder)))
+
+    def remove(self, session: str):
+        """
+        drops a session from the index, e.g. after deleting it
+        :param session: str: session name
+        """
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM files WHERE session = ?", (session,))
+            self._db.execute("DELETE FROM sessions WHERE session = ?", (session,))
+
+    def list_sessions(self, pattern: [str, None] = None, compressed: [bool, None] = None,
+                      copied: [bool, None] = None, verified: [bool, None] = None,
+                      older_than: [float, None] = None) -> list:
+        """
+        lists the indexed sessions, oldest first, filters set to None are not applied
+        :param pattern: str: glob pattern on the session name, e.g. MusterMaus*
+        :param compressed: bool: only sessions with or without compressed files
+        :param copied: bool: only sessions copied or not copied to the data server
+        :param verified: bool: only sessions with or without a verified copy
+        :param older_than: float: only sessions whose files were last modified more than older_than s ago
+        :return: list of dicts with the columns of the sessions table
+        """
+        where, params = [], []
+        if pattern is not None:
+            where.append("session GLOB ?")
+            params.append(pattern)
+        for column, value in (('compressed', compressed), ('copied_at', copied), ('verified_at', verified)):
+            if value is not None:
+                if column == 'compressed':
+                    where.append(f"compressed = {int(value)}")
+                else:
+                    where.append(f"{column} IS {'NOT ' if value else ''}NULL")
+        if older_than is not None:
+            where.append("mtime < ?")
+            params.append(time.time() - older_than)
+        query = "SELECT * FROM sessions" + (f" WHERE {' AND '.join(where)}" if where else "") + " ORDER BY mtime"
+        with self._lock:
+            return [dict(row) for row in self._db.execute(query, params)]
+
+    def get_files(self, session: str) -> list:
+        """
+        :param session: str: session name
+        :return: list of dicts with the columns of the files table
+        """
+        with self._lock:
+            return [dict(row) for row in self._db.execute("SELECT * FROM files WHERE session = ? ORDER BY name",
+                                                          (session,))]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scans a data folder into the session index and lists the sessions')
+    parser.add_argument('root', type=Path, help='data folder')
+    parser.add_argument('--pattern', default=None, help='glob pattern on the session names')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    index = SessionIndex(args.root)
+    index.scan()
+    for s in index.list_sessions(args.pattern):
+        state = 'verified' if s['verified_at'] else 'copied' if s['copied_at'] else 'local'
+        duration = f"{s['duration'] / 60:.1f} min" if s['duration'] else '-'
+        print(f"{s['session']:<40} {s['bytes'] / 2**30:>8.2f} GB {duration:>10} {state:>8} "
+              f"{'compressed' if s['compressed'] else ''} {s['streams']}")
+    index.close()
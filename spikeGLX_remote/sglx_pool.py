@@ -0,0 +1,126 @@
+"""
+Pool of connection handles to the SpikeGLX remote command server.
+A single SglxApi handle is not safe for concurrent use, so every thread that talks to SpikeGLX has to check out its own
+handle from the pool. One handle is reserved for control commands (start/stop run and recording), so they never wait
+behind a long status query or data fetch running in another thread.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+from queue import Queue, Empty
+
+import spikeGLX_remote.sglx as sglx
+
+
+class SglxHandlePool:
+    """
+    Holds several independent connections to SpikeGLX and hands them out one thread at a time.
+
+    :param host: str: address of the computer running SpikeGLX
+    :param port: int: port of the SpikeGLX remote command server
+    :param size: int: number of handles for queries and fetches, the control handle comes on top
+    :param timeout: float: max time in s to wait for a free handle
+
+    :parameter connected: bool: True if at least the control handle is connected
+    :parameter version: str: SpikeGLX version string reported on connection
+    :parameter last_error: str: last error reported while connecting
+    """
+
+    def __init__(self, host: str = 'localhost', port: int = 4142, size: int = 2, timeout: float = 5.):
+        self.host = host
+        self.port = port
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.log = logging.getLogger('SglxHandlePool')
+        self._control_handle = None
+        self._control_lock = threading.Lock()
+        self._handles = []  # all general purpose handles, needed for closing
+        self._free = Queue()  # general purpose handles currently not checked out
+        self.connected = False
+        self.version = None
+        self.last_error = ''
+
+    def _create_handle(self):
+        """creates a handle and connects it to SpikeGLX, returns None on failure"""
+        hSglx = sglx.c_sglx_createHandle()
+        if sglx.c_sglx_connect(hSglx, self.host.encode(), self.port):
+            return hSglx
+        self.last_error = sglx.c_sglx_getError(hSglx).decode()
+        sglx.c_sglx_destroyHandle(hSglx)
+        return None
+
+    @staticmethod
+    def _destroy_handle(hSglx):
+        sglx.c_sglx_close(hSglx)
+        sglx.c_sglx_destroyHandle(hSglx)
+
+    def connect(self) -> bool:
+        """
+        opens the control handle and the general purpose handles
+        :return: bool if connected
+        """
+        if self.connected:
+            return True
+        self._control_handle = self._create_handle()
+        if self._control_handle is None:
+            return False
+        self.version = sglx.c_sglx_getVersion(self._control_handle).decode()
+        for _ in range(self.size):
+            hSglx = self._create_handle()
+            if hSglx is None:
+                self.log.warning(f"Could only open {len(self._handles)} of {self.size} query handles: "
+                                 f"{self.last_error}")
+                break
+            self._handles.append(hSglx)
+            self._free.put(hSglx)
+        self.connected = True
+        return True
+
+    def close(self):
+        """
+        closes all handles, waits for checked out handles to be returned
+        """
+        if not self.connected:
+            return
+        self.connected = False  # no new checkouts from here on
+        for _ in self._handles:
+            try:
+                self._destroy_handle(self._free.get(timeout=self.timeout))
+            except Empty:
+                self.log.error("Handle was not returned to the pool, leaking it")
+        with self._control_lock:
+            self._destroy_handle(self._control_handle)
+        self._control_handle = None
+        self._handles = []
+
+    @contextmanager
+    def checkout(self, control: bool = False):
+        """
+        Context manager lending a handle to the calling thread. Yields None if not connected or no handle became free
+        within the timeout, callers need to check for this.
+
+        :param control: bool: use the handle reserved for control commands
+        """
+        if not self.connected:
+            yield None
+            return
+        if control or not self._handles:
+            if not self._control_lock.acquire(timeout=self.timeout):
+                self.log.error("Timed out waiting for the SpikeGLX control handle")
+                yield None
+                return
+            try:
+                yield self._control_handle
+            finally:
+                self._control_lock.release()
+        else:
+            try:
+                hSglx = self._free.get(timeout=self.timeout)
+            except Empty:
+                self.log.error("Timed out waiting for a free SpikeGLX handle")
+                yield None
+                return
+            try:
+                yield hSglx
+            finally:
+                self._free.put(hSglx)
@@ -0,0 +1,240 @@
+"""
+Helpers to relate commands and events to the sample clocks of the SpikeGLX streams.
+Streams are addressed as in the SpikeGLX-api by (js, ip): js=0 NI, js=1 OneBox, js=2 imec probe; ip is the index of
+the substream.
+"""
+import json
+import logging
+import threading
+import time
+from ctypes import byref, c_int
+from pathlib import Path
+
+import numpy as np
+
+import spikeGLX_remote.sglx as sglx
+
+log = logging.getLogger('sglx_sync')
+
+STREAM_TYPES = {0: 'nidq', 1: 'obx', 2: 'imec'}
+
+
+def stream_name(js: int, ip: int) -> str:
+    """
+    :return: str: name of the stream as used in the SpikeGLX file names, e.g. nidq, imec0
+    """
+    if js == 0:
+        return STREAM_TYPES[js]
+    return f"{STREAM_TYPES[js]}{ip}"
+
+
+def parse_stream_name(name: str) -> (int, int):
+    """
+    inverse of stream_name
+    :return: (js, ip)
+    """
+    if not isinstance(name, str):
+        raise ValueError(f"Stream name must be a str, got {name}")
+    if name == STREAM_TYPES[0]:
+        return 0, 0
+    for js, prefix in STREAM_TYPES.items():
+        if js and name.startswith(prefix) and name[len(prefix):].isdigit():
+            return js, int(name[len(prefix):])
+    raise ValueError(f"Unknown stream {name}")
+
+
+def enumerate_streams(hSglx) -> list:
+    """
+    lists all streams of the current run
+    :param hSglx: handle to the spikeglx api connection
+    :return: list of (js, ip) tuples
+    """
+    streams = []
+    n_streams = c_int()
+    for js in STREAM_TYPES:
+        if sglx.c_sglx_getStreamNP(byref(n_streams), hSglx, js):
+            streams += [(js, ip) for ip in range(n_streams.value)]
+    return streams
+
+
+def get_sync_stamp(hSglx, streams: list, file_start: bool = False) -> dict:
+    """
+    Stamps the current moment with the SpikeGLX clock and the sample count of every stream. Costs one round-trip for
+    the time and one (two with file_start) per stream.
+
+    :param hSglx: handle to the spikeglx api connection
+    :param streams: list of (js, ip) tuples, see enumerate_streams
+    :param file_start: bool: also get the first sample of the file currently written
+    :return: dict with 'sglx_time' in s since SpikeGLX start and per stream the 'sample' count and 'file_start',
+        values the api reports as unavailable are None
+    """
+    stamp = {'sglx_time': sglx.c_sglx_getTime(hSglx) or None, 'streams': {}}
+    for js, ip in streams:
+        entry = {'sample': sglx.c_sglx_getStreamSampleCount(hSglx, js, ip) or None}
+        if file_start:
+            entry['file_start'] = sglx.c_sglx_getStreamFileStart(hSglx, js, ip) or None
+        stamp['streams'][stream_name(js, ip)] = entry
+    return stamp
+
+
+class SampleMapper:
+    """
+    Maps sample indices between streams. c_sglx_mapSample maps one sample per round-trip, so instead the linear
+    relation of every stream to a reference stream (NI if present) is fitted from a few mapped samples and cached.
+    Arrays of samples are then mapped with NumPy in one go. Fits are refreshed once they are older than
+    refresh_interval, as the relation drifts slowly with the clocks.
+
+    :param sglx_pool: SglxHandlePool: pool to check out handles from
+    :param refresh_interval: float: s after which the fits are renewed
+    :param n_points: int: number of samples mapped via SpikeGLX per stream and fit
+
+    :parameter reference: str: name of the reference stream
+    :parameter fits: dict: per stream name (ref_sample0, sample0, slope) with
+        sample = sample0 + slope * (ref_sample - ref_sample0)
+    :parameter fit_time: float: time.monotonic() of the last fit
+    """
+
+    def __init__(self, sglx_pool, refresh_interval: float = 60., n_points: int = 8):
+        self.sglx_pool = sglx_pool
+        self.refresh_interval = refresh_interval
+        self.n_points = max(2, n_points)
+        self.reference = None
+        self.fits = {}
+        self.fit_time = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """drops all fits, e.g. when a new run starts"""
+        with self._lock:
+            self.fits = {}
+            self.fit_time = None
+
+    def refresh(self) -> bool:
+        """
+        fits the relation of all streams of the current run to the reference stream
+        :return: bool if successful
+        """
+        with self.sglx_pool.checkout() as hSglx:
+            if hSglx is None:
+                return False
+            streams = enumerate_streams(hSglx)
+            if not streams:
+                log.error("No streams to map samples between, is SpikeGLX running?")
+                return False
+            ref = (0, 0) if (0, 0) in streams else streams[0]
+            head = sglx.c_sglx_getStreamSampleCount(hSglx, *ref)
+            if head < self.n_points:
+                log.error("Not enough samples acquired to map between streams")
+                return False
+            ref_samples = np.linspace(1, head, self.n_points).astype(np.uint64)
+            fits = {}
+            for js, ip in streams:
+                if (js, ip) == ref:
+                    fits[stream_name(js, ip)] = (0., 0., 1.)
+                    continue
+                mapped = np.array([sglx.c_sglx_mapSample(hSglx, js, ip, int(sample), *ref)
+                                   for sample in ref_samples], dtype=np.float64)
+                valid = mapped > 0  # zero signals an error
+                if valid.sum() < 2:
+                    log.error(f"Could not map samples to {stream_name(js, ip)}: {sglx.c_sglx_getError(hSglx)}")
+                    continue
+                x = ref_samples[valid].astype(np.float64)
+                y = mapped[valid]
+                x0, y0 = x.mean(), y.mean()  # center the fit, sample indices are large
+                slope = np.sum((x - x0) * (y - y0)) / np.sum((x - x0) ** 2)
+                fits[stream_name(js, ip)] = (x0, y0, slope)
+        with self._lock:
+            self.reference = stream_name(*ref)
+            self.fits = fits
+            self.fit_time = time.monotonic()
+        log.debug(f"Fitted sample mapping of {list(fits)} to {self.reference}")
+        return True
+
+    def _get_fits(self, *streams) -> [list, None]:
+        """returns the fits of the streams, refreshing them if needed"""
+        for name in streams:
+            parse_stream_name(name)  # raises ValueError for invalid names
+        stale = self.fit_time is None or time.monotonic() - self.fit_time > self.refresh_interval
+        if stale or any(name not in self.fits for name in streams):
+            if not self.refresh():
+                return None
+        with self._lock:
+            if any(name not in self.fits for name in streams):
+                raise ValueError(f"Stream not found in current run, available {list(self.fits)}")
+            return [self.fits[name] for name in streams]
+
+    def map_samples(self, samples, src: str, dst: str) -> [np.ndarray, None]:
+        """
+        maps samples of stream src to stream dst
+        :param samples: array-like of sample indices in src
+        :param src: str: name of the source stream, e.g. nidq
+        :param dst: str: name of the destination stream, e.g. imec0
+        :return: np.ndarray of int64 sample indices in dst, None if the mapping could not be fitted
+        """
+        fits = self._get_fits(src, dst)
+        if fits is None:
+            return None
+        (x0_src, y0_src, slope_src), (x0_dst, y0_dst, slope_dst) = fits
+        ref_samples = x0_src + (np.asarray(samples, dtype=np.float64) - y0_src) / slope_src
+        return np.rint(y0_dst + slope_dst * (ref_samples - x0_dst)).astype(np.int64)
+
+
+class SessionEventLog:
+    """
+    Log of all commands of a session, each stamped with the SpikeGLX time and the stream sample counts.
+    Events are kept in memory until the session folder is known, from then on every event is appended as a json line
+    to <session_id>.events.jsonl in the session folder, so it is copied together with the data.
+
+    :parameter session_id: str: session the events belong to
+    :parameter events: list: all events of the session
+    :parameter path: Path: file the events are written to, None until the session folder is known
+    """
+
+    def __init__(self):
+        self.session_id = None
+        self.events = []
+        self.path = None
+        self._lock = threading.Lock()  # events come from the GUI and the remote thread
+
+    def add(self, session_id: str, command: str, stamp: [dict, None] = None, **info) -> dict:
+        """
+        adds an event, starts a new log if the session id changed
+        :param session_id: str: current session id
+        :param command: str: command or message type that is logged
+        :param stamp: dict: sync stamp, see get_sync_stamp
+        :param info: further entries for the event
+        :return: dict: the logged event
+        """
+        event = {'command': command, 'local_time': time.time()}
+        if stamp:
+            event.update(stamp)
+        event.update(info)
+        with self._lock:
+            if session_id != self.session_id:
+                self.session_id = session_id
+                self.events = []
+                self.path = None
+            self.events.append(event)
+            if self.path is not None:
+                self._write([event])
+        return event
+
+    def set_folder(self, folder: Path):
+        """
+        sets the session folder and writes all events collected so far
+        :param folder: Path: session folder
+        """
+        with self._lock:
+            path = Path(folder) / f'{self.session_id}.events.jsonl'
+            if path == self.path:
+                return
+            self.path = path
+            self._write(self.events)
+
+    def _write(self, events: list):
+        try:
+            with self.path.open('a') as f:
+                for event in events:
+                    f.write(json.dumps(event) + '\n')
+        except OSError as e:
+            log.error(f"Could not write event log {self.path}: {e}")
@@ -48,3 +48,18 @@ def get_sample_rate(meta: Dict[str, str]) -> float:
 
 def get_num_saved_channels(meta: Dict[str, str]) -> int:
     return int(meta["nSavedChans"])
+
+
+def is_file_closed(bin_file: Path, meta: Dict[str, str]) -> bool:
+    # SpikeGLX adds the final file size to the meta file when it closes the binary file,
+    # so the file is complete once both agree.
+    return "fileSizeBytes" in meta and bin_file.exists() and bin_file.stat().st_size == int(meta["fileSizeBytes"])
+
+
+def read_live_meta(meta_full_path: Path) -> Dict[str, str]:
+    # Read a meta file SpikeGLX may be rewriting at the moment, e.g. when it closes the binary file.
+    # A half-written line gives an empty dictionary, read it again later.
+    try:
+        return read_meta(meta_full_path)
+    except (IndexError, OSError):
+        return {}
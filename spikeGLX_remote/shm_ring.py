@@ -0,0 +1,159 @@
+"""
+Shared-memory ring buffer for bulk data between processes on the same computer, e.g. preview frames or blocks of live
+data, without serializing them through a socket.
+One writer fills fixed-size slots in turn and numbers the records it writes, any number of readers attach by the
+name of the ring and read at their own pace. The writer never waits for the readers: a reader that falls behind by more
+than the number of slots loses the oldest records and is told how many. Each slot carries the sequence number of its
+record, the writer clears it before overwriting the slot, so a reader detects a record overwritten while it read it.
+
+Layout: header of HEADER_FIELDS uint64 (magic, n_slots, slot_size, last sequence number written), then n_slots slots of
+SLOT_FIELDS uint64 (sequence number, length in bytes, tag) followed by slot_size bytes of data.
+"""
+import logging
+import sys
+from multiprocessing import shared_memory
+
+import numpy as np
+
+log = logging.getLogger('shm_ring')
+
+MAGIC = 0x53474c5852494e47  # 'SGLXRING'
+HEADER_FIELDS = 4
+SLOT_FIELDS = 3
+_HEAD = 3  # index of the last sequence number in the header
+_created = set()  # names of the blocks created by this process (or its parent before a fork), tracked for the writer
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """attaches to an existing block without handing it to the resource tracker, which would remove it on exit"""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track=False)
+    shm = shared_memory.SharedMemory(name)
+    # the tracker keeps one registration per name, unregistering a block of the writer's own process would drop it
+    if sys.platform != 'win32' and shm.name not in _created:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+class ShmRing:
+    """
+    Ring of records in shared memory. The writer creates it with create=True and removes it with unlink, readers attach
+    with the name and close it when done.
+
+    :param name: str: name of the shared memory block
+    :param n_slots: int: records the ring holds, only used when creating it
+    :param slot_size: int: maximum bytes per record, only used when creating it
+    :param create: bool: create the ring (writer) instead of attaching to it (reader)
+
+    :parameter next_seq: int: sequence number of the next record the reader returns
+    :parameter dropped: int: records the reader lost because it fell behind
+    """
+
+    def __init__(self, name: str, n_slots: int = 64, slot_size: int = 2**20, create: bool = False):
+        if create:
+            size = 8 * HEADER_FIELDS + n_slots * (8 * SLOT_FIELDS + slot_size)
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+            _created.add(self.shm.name)
+            header = np.ndarray((HEADER_FIELDS,), dtype=np.uint64, buffer=self.shm.buf)
+            header[:] = (0, n_slots, slot_size, 0)
+            header[0] = MAGIC  # last, a reader attaching during creation sees an invalid ring
+        else:
+            self.shm = _attach(name)
+            header = np.ndarray((HEADER_FIELDS,), dtype=np.uint64, buffer=self.shm.buf)
+            if int(header[0]) != MAGIC:
+                self.shm.close()
+                raise ValueError(f"Shared memory {name} is no ring buffer")
+        self.name = name
+        self.owner = create
+        self._header = header
+        self.n_slots = int(header[1])
+        self.slot_size = int(header[2])
+        self._stride = 8 * SLOT_FIELDS + self.slot_size
+        self._slots = np.ndarray((self.n_slots, SLOT_FIELDS), dtype=np.uint64, buffer=self.shm.buf,
+                                 offset=8 * HEADER_FIELDS, strides=(self._stride, 8))
+        self.next_seq = int(header[_HEAD]) + 1  # readers start with the next record written
+        self.dropped = 0
+
+    @property
+    def head(self) -> int:
+        """sequence number of the last record written, 0 if none"""
+        return int(self._header[_HEAD])
+
+    def _data(self, index: int, length: int) -> memoryview:
+        start = 8 * HEADER_FIELDS + index * self._stride + 8 * SLOT_FIELDS
+        return self.shm.buf[start:start + length]
+
+    def write(self, data, tag: int = 0) -> int:
+        """
+        writes a record to the next slot, overwriting the oldest record
+        :param data: bytes-like: record, at most slot_size bytes
+        :param tag: int: unsigned number stored with the record, e.g. the sample index of its first sample
+        :return: int: sequence number of the record
+        """
+        data = memoryview(data).cast('B')
+        if data.nbytes > self.slot_size:
+            raise ValueError(f"Record of {data.nbytes} bytes exceeds the slot size of {self.slot_size}")
+        seq = self.head + 1
+        slot = self._slots[seq % self.n_slots]
+        slot[0] = 0  # readers of the old record see it vanish
+        self._data(seq % self.n_slots, data.nbytes)[:] = data
+        slot[1] = data.nbytes
+        slot[2] = tag
+        slot[0] = seq
+        self._header[_HEAD] = seq
+        return seq
+
+    def read(self, copy: bool = True) -> [tuple, None]:
+        """
+        returns the next record, skipping the records that were overwritten already
+        :param copy: bool: copy the data, else a memoryview into the ring that is only valid as long as valid(seq)
+            is True after using it
+        :return: tuple (seq, tag, bytes or memoryview) or None if no new record was written
+        """
+        while True:
+            head = self.head
+            if self.next_seq > head:
+                return None
+            if head - self.next_seq >= self.n_slots:  # overwritten already
+                lost = head - self.n_slots + 1 - self.next_seq
+                self.dropped += lost
+                log.debug(f"Reader of {self.name} fell behind, {lost} records lost")
+                self.next_seq += lost
+            seq = self.next_seq
+            slot = self._slots[seq % self.n_slots]
+            if int(slot[0]) == seq:
+                length, tag = int(slot[1]), int(slot[2])
+                data = self._data(seq % self.n_slots, length)
+                if copy:
+                    data = bytes(data)
+                if int(slot[0]) == seq:  # not overwritten while copying
+                    self.next_seq += 1
+                    return seq, tag, data
+            # overwritten meanwhile, the next pass skips ahead
+            self.dropped += 1
+            self.next_seq += 1
+
+    def view(self, seq: int) -> [tuple, None]:
+        """
+        zero-copy access to a record, the data is only valid as long as valid(seq) is True afterwards
+        :param seq: int: sequence number of the record
+        :return: tuple (tag, memoryview) or None if the record is not in the ring
+        """
+        slot = self._slots[seq % self.n_slots]
+        if int(slot[0]) != seq:
+            return None
+        return int(slot[2]), self._data(seq % self.n_slots, int(slot[1]))
+
+    def valid(self, seq: int) -> bool:
+        """:return: bool if the record seq was not overwritten yet"""
+        return int(self._slots[seq % self.n_slots][0]) == seq
+
+    def close(self):
+        """detaches from the ring, the writer also removes it"""
+        # numpy views and memoryviews on the buffer have to go before the block can be closed
+        del self._header, self._slots
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+            _created.discard(self.shm.name)
@@ -1,5 +1,7 @@
+import os
 import socket
 import ssl
+import sys
 import threading
 import select
 import logging
@@ -29,6 +31,20 @@ class MessageType(Enum):
     disconnected = 'disconnected'
     copy_files = 'copy_files'
     purge_files = 'purge_files'
+    prepare_rec = 'prepare_rec'
+    map_samples = 'map_samples'
+    trial_plan = 'trial_plan'
+    trial_start = 'trial_start'
+    trial_end = 'trial_end'
+    file_offer = 'file_offer'
+    file_chunk = 'file_chunk'
+    file_done = 'file_done'
+    agent_job = 'agent_job'
+    agent_progress = 'agent_progress'
+    list_sessions = 'list_sessions'
+    disk_forecast = 'disk_forecast'
+    batch = 'batch'
+    heartbeat = 'heartbeat'
 
 
 class MessageStatus(Enum):
@@ -48,6 +64,29 @@ class MessageStatus(Enum):
     calib_ok = 'calib_ok'
     copy_ok = 'copy_ok'
     copy_fail = 'copy_fail'
+    prepare_ok = 'prepare_ok'
+    prepare_fail = 'prepare_fail'
+    map_ok = 'map_ok'
+    map_fail = 'map_fail'
+    trial_plan_ok = 'trial_plan_ok'
+    trial_start_ok = 'trial_start_ok'
+    trial_end_ok = 'trial_end_ok'
+    trial_fail = 'trial_fail'
+    file_status = 'file_status'
+    chunk_ok = 'chunk_ok'
+    chunk_fail = 'chunk_fail'
+    file_ok = 'file_ok'
+    file_fail = 'file_fail'
+    job_started = 'job_started'
+    job_ok = 'job_ok'
+    job_fail = 'job_fail'
+    sessions_ok = 'sessions_ok'
+    sessions_fail = 'sessions_fail'
+    forecast_ok = 'forecast_ok'
+    forecast_fail = 'forecast_fail'
+    disk_low = 'disk_low'
+    batch_ok = 'batch_ok'
+    batch_fail = 'batch_fail'
 
 
 class SocketMessage:
@@ -71,16 +110,29 @@ class SocketMessage:
     :param stop_video: dict: message to stop the video
     :param start_video_calibrec: dict: message to start the calibration recording
 
+    :param prepare_rec: dict: message to prepare (arm) the recording ahead of its start
+    :param map_samples: dict: message to map an array of samples from stream src to stream dst
+    :param list_sessions: dict: message to list the recorded sessions of the session index, filters None are not applied
+    :param disk_forecast: dict: message to get the forecast of the remaining recording time
+    :param batch: dict: message with an ordered list of steps, each a dict with the command under 'cmd' and its
+        arguments, run in one pass and rolled back if a step fails, see SpikeGLX_Controller.respond_batch
+    :param trial_plan: dict: message to set up a series of trials recorded into one session folder
+    :param trial_start: dict: message to start recording the next trial of the plan
+    :param trial_end: dict: message to stop recording the current trial
     :param copy_files: dict: message to copy the files
     :param purge_files: dict: message to purge the files
     :param view_spike_glx: dict: message to view the spike glx
     :param start_spike_glx: dict: message to start the spike glx
     :param stop_spike_glx: dict: message to stop the spike glx
+
+    Any message may carry a request_id, the replies to it echo the id. Clients can so send further messages before the
+    reply to the previous one arrived and still tell the replies apart.
     """
     status_error = {'type': MessageType.status.value, 'status': MessageStatus.error.value}
     status_ready = {'type': MessageType.status.value, 'status': MessageStatus.ready.value}
     status_recording = {'type': MessageType.status.value, 'status': MessageStatus.recording.value}
     status_viewing = {'type': MessageType.status.value, 'status': MessageStatus.viewing.value}
+    status_disk_low = {'type': MessageType.status.value, 'status': MessageStatus.disk_low.value}
 
     respond_recording = {'type': MessageType.response.value, 'status': MessageStatus.recording_ok.value}
     respond_recording_fail = {'type': MessageType.response.value, 'status': MessageStatus.recording_fail.value}
@@ -90,7 +142,22 @@ class SocketMessage:
     respond_calib = {'type': MessageType.response.value, 'status': MessageStatus.calib_ok.value}
     respond_copy = {'type': MessageType.response.value, 'status': MessageStatus.copy_ok.value}
     respond_copy_fail = {'type': MessageType.response.value, 'status': MessageStatus.copy_fail.value}
+    respond_prepare = {'type': MessageType.response.value, 'status': MessageStatus.prepare_ok.value}
+    respond_prepare_fail = {'type': MessageType.response.value, 'status': MessageStatus.prepare_fail.value}
+    respond_map = {'type': MessageType.response.value, 'status': MessageStatus.map_ok.value}
+    respond_map_fail = {'type': MessageType.response.value, 'status': MessageStatus.map_fail.value}
+    respond_trial_plan = {'type': MessageType.response.value, 'status': MessageStatus.trial_plan_ok.value}
+    respond_trial_start = {'type': MessageType.response.value, 'status': MessageStatus.trial_start_ok.value}
+    respond_trial_end = {'type': MessageType.response.value, 'status': MessageStatus.trial_end_ok.value}
+    respond_trial_fail = {'type': MessageType.response.value, 'status': MessageStatus.trial_fail.value}
+    respond_sessions = {'type': MessageType.response.value, 'status': MessageStatus.sessions_ok.value}
+    respond_sessions_fail = {'type': MessageType.response.value, 'status': MessageStatus.sessions_fail.value}
+    respond_forecast = {'type': MessageType.response.value, 'status': MessageStatus.forecast_ok.value}
+    respond_forecast_fail = {'type': MessageType.response.value, 'status': MessageStatus.forecast_fail.value}
+    respond_batch = {'type': MessageType.response.value, 'status': MessageStatus.batch_ok.value}
+    respond_batch_fail = {'type': MessageType.response.value, 'status': MessageStatus.batch_fail.value}
     client_disconnected = {'type': MessageType.disconnected.value}
+    heartbeat = {'type': MessageType.heartbeat.value}
 
     def __init__(self):
         self._session_path = None
@@ -121,10 +188,22 @@ class SocketMessage:
         self.copy_files = {'type': MessageType.copy_files.value, 'session_id': self._session_id,
                            'session_path': self._session_path}
         self.purge_files = {'type': MessageType.purge_files.value, 'session_id': self._session_id}
+        self.prepare_rec = {'type': MessageType.prepare_rec.value, 'session_id': self._session_id,
+                            'session_path': self._session_path}
+        self.trial_plan = {'type': MessageType.trial_plan.value, 'session_id': self._session_id, 'n_trials': None,
+                           'g_index': 0, 'session_path': self._session_path}
+        self.trial_start = {'type': MessageType.trial_start.value}
+        self.trial_end = {'type': MessageType.trial_end.value}
+        self.map_samples = {'type': MessageType.map_samples.value, 'src': 'nidq', 'dst': 'imec0', 'samples': []}
+        self.disk_forecast = {'type': MessageType.disk_forecast.value}
+        self.batch = {'type': MessageType.batch.value, 'steps': []}
+        self.list_sessions = {'type': MessageType.list_sessions.value, 'pattern': None, 'compressed': None,
+                              'copied': None, 'verified': None, 'older_than': None}
 
         self.view_spike_glx = {'type': MessageType.start_video_view.value,
                                'session_id': self._session_id}  # maybe further params
-        self.start_spike_glx = {'type': MessageType.start_video_rec.value, 'session_id': self._session_id}
+        self.start_spike_glx = {'type': MessageType.start_video_rec.value, 'session_id': self._session_id,
+                                'session_path': self._session_path}  # session_path to replicate while recording
         self.stop_spike_glx = {'type': MessageType.stop_video.value}
         # if i add new ones they also need to addd to the update_messages function or automate this ?
 
@@ -198,11 +277,36 @@ class SocketMessage:
         self.start_video_calibrec.update(**{'session_id': 'calibration', 'setting_file': self.basler_setting_file})
         self.copy_files.update(**{'session_id': self.session_id, 'session_path': self._session_path})
         self.purge_files.update(**{'session_id': self._session_id})
+        self.prepare_rec.update(**{'session_id': self._session_id, 'session_path': self._session_path})
+        self.trial_plan.update(**{'session_id': self._session_id, 'session_path': self._session_path})
         self.view_spike_glx.update(**{'session_id': self._session_id})  # maybe further params
-        self.start_spike_glx.update(**{'session_id': self._session_id})
+        self.start_spike_glx.update(**{'session_id': self._session_id, 'session_path': self._session_path})
         self.stop_spike_glx.update(**{'session_id': self._session_id})
 
 
+def set_keepalive(sock: socket.socket, idle: float = 5., interval: float = 1., count: int = 3):
+    """
+    enables TCP keepalive with short timings, a silently dropped link is then detected after about
+    idle + interval * count seconds even if no data is sent
+    :param sock: socket.socket: connected socket
+    :param idle: float: s without data before the first probe
+    :param interval: float: s between probes
+    :param count: int: unanswered probes after which the connection is dropped, fixed to 10 on windows
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if sys.platform == 'win32':
+        sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, int(idle * 1000), int(interval * 1000)))
+        return
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(idle)))
+    elif hasattr(socket, 'TCP_KEEPALIVE'):  # macOS
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, max(1, int(idle)))
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(interval)))
+    if hasattr(socket, 'TCP_KEEPCNT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+
+
 class SocketComm:
     """
     Class to handle socket communication between processes or devices
@@ -210,6 +314,15 @@ class SocketComm:
     :param host: str: host IP address
     :param port: int: port number
     :param use_ssl: bool: use ssl encryption
+    :param heartbeat_interval: float: s between heartbeats sent to the peer, None to send none. Only peers that sent a
+        heartbeat themselves get them, older clients would take them for replies
+    :param heartbeat_timeout: float: s without any data from a peer that sends heartbeats after which it is considered
+        lost
+    :param keepalive: tuple: TCP keepalive (idle s, probe interval s, probe count) for peers that send no heartbeats,
+        None to leave the system defaults
+    :param on_disconnect: callable() called once when the connection is lost or closed by the peer
+    :param unix_path: str: path of a Unix domain socket to use instead of TCP for a peer on the same computer, host
+        and port are ignored then. Skips the TCP/IP stack of the loopback device, not available on windows.
 
     :param acception_thread: threading.Thread: thread to accept connection
     :param ssl_sock: ssl.SSLSocket: ssl socket
@@ -222,9 +335,14 @@ class SocketComm:
     :param stop_event: threading.Event: event to stop waiting for connection
     :param log: logging.Logger: logger
     :param message_time: float: time of last message
+    :param last_received: float: time.monotonic() of the last data received
+    :param _partial: bytes: start of a message received before a read timed out
+    :param _context: threading.local: request id the replies sent by a thread echo, see reply_to
     """
 
-    def __init__(self, soctype: str = "server", host: str = "localhost", port: int = 8800, use_ssl: bool = False):
+    def __init__(self, soctype: str = "server", host: str = "localhost", port: int = 8800, use_ssl: bool = False,
+                 heartbeat_interval: [float, None] = None, heartbeat_timeout: float = 5.,
+                 keepalive: [tuple, None] = None, on_disconnect=None, unix_path: [str, None] = None):
         self.acception_thread = None
         self.ssl_sock = None
         self.sock = None
@@ -233,6 +351,9 @@ class SocketComm:
         self.type = soctype
         self.host = host
         self.port = port
+        if unix_path is not None and not hasattr(socket, 'AF_UNIX'):
+            raise NotImplementedError("Unix domain sockets are not available on this platform")
+        self.unix_path = unix_path
         if self.type == "server":
             self.context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
         else:
@@ -247,17 +368,35 @@ class SocketComm:
         self.log = logging.getLogger(f"SocketComm_{self.type}")
         self.log.setLevel(logging.DEBUG)
         self.message_time = time.monotonic()
+        self._partial = b''
+        self._context = threading.local()
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.keepalive = keepalive
+        self.on_disconnect = on_disconnect
+        self.last_received = time.monotonic()
+        self._peer_heartbeats = False  # timeouts only apply to peers sending heartbeats, others may stay silent
+        self._send_lock = threading.Lock()  # replies and heartbeats come from several threads
+        self._heartbeat_thread = None
 
     def create_socket(self):
         """
         Creates the socket for the server or client
         """
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        family = socket.AF_INET if self.unix_path is None else socket.AF_UNIX
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
         if self.type == 'client':
             pass
         elif self.type == 'server':
+            # rebind right after a connection was lost, windows allows it anyway
+            if self.unix_path is None and sys.platform != 'win32':
+                self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             try:
-                self._sock.bind((self.host, self.port))
+                if self.unix_path is not None:
+                    self._remove_unix_path()  # left over by a controller that was not closed
+                    self._sock.bind(self.unix_path)
+                else:
+                    self._sock.bind((self.host, self.port))
             except OSError:
                 self.log.warning('Address already in use.. need to delete somehow ?')
             self._sock.listen()
@@ -279,7 +418,7 @@ class SocketComm:
                 if ready:
                     self.ssl_sock, self.addr = self._ssl_sock.accept()
                     self.ssl_sock.settimeout(0.1)
-                    self.connected = True
+                    self._connection_made()
                     self.log.info(f"Connected to {self.addr}")
                     break
             else:
@@ -287,7 +426,7 @@ class SocketComm:
                 if ready:
                     self.sock, self.addr = self._sock.accept()
                     self.sock.settimeout(0.1)
-                    self.connected = True
+                    self._connection_made()
                     self.log.info(f"Connected to {self.addr}")
                     break
         else:
@@ -320,12 +459,51 @@ class SocketComm:
                 self.sock = self._sock
                 self.sock.settimeout(0.1)  # otherwise we get issues if nothing is comming
             self._connect(self.host, self.port)
-            self.connected = True
+            self._connection_made()
             return True
         else:
             return False
             # raise RuntimeError("Error: Cannot connect on server socket")
 
+    def _connection_made(self):
+        """sets up keepalive and heartbeats of a new connection"""
+        sock = self.ssl_sock if self.use_ssl else self.sock
+        if self.keepalive is not None and self.unix_path is None:  # a local peer cant vanish unnoticed
+            set_keepalive(sock, *self.keepalive)
+        self.last_received = time.monotonic()
+        self._peer_heartbeats = False
+        self.connected = True
+        if self.heartbeat_interval:
+            self._heartbeat_thread = threading.Thread(target=self._heartbeat, daemon=True)
+            self._heartbeat_thread.start()
+
+    def _heartbeat(self):
+        """sends heartbeats and declares a heartbeating peer lost if nothing arrived within heartbeat_timeout"""
+        while self.connected:
+            time.sleep(self.heartbeat_interval)
+            if not self.connected:
+                break
+            if not self._peer_heartbeats:
+                continue
+            if time.monotonic() - self.last_received > self.heartbeat_timeout:
+                self.log.warning(f"No heartbeat from the peer for {self.heartbeat_timeout}s")
+                self._connection_lost()
+                break
+            self.send_json_message(SocketMessage.heartbeat, echo_id=False)
+
+    def _connection_lost(self):
+        """marks the connection as lost, unblocks readers and calls on_disconnect once"""
+        with self._send_lock:
+            if not self.connected:
+                return
+            self.connected = False
+        try:
+            (self.ssl_sock if self.use_ssl else self.sock).shutdown(socket.SHUT_RDWR)
+        except OSError:  # already gone
+            pass
+        if self.on_disconnect is not None:
+            self.on_disconnect()
+
     def close_socket(self):
         """
         Closes the socket
@@ -339,8 +517,16 @@ class SocketComm:
             self.sock.close()
         if self._sock:
             self._sock.close()
+        if self.type == 'server' and self.unix_path is not None:
+            self._remove_unix_path()
         self.connected = False
 
+    def _remove_unix_path(self):
+        try:
+            os.unlink(self.unix_path)
+        except FileNotFoundError:
+            pass
+
     def read_json_message(self) -> [dict, None]:
         """
         Reads a json message from the socket until a linebreak is reached then decodes it via json
@@ -348,8 +534,10 @@ class SocketComm:
         """
         try:
             message = self._recv_until(b'\n')
+            if message == -1:
+                return SocketMessage.client_disconnected
             if message is not None:
-                message = json.loads(message.decode())
+                message = self._filter_heartbeat(json.loads(message.decode()))
             else:
                 return message
         except json.decoder.JSONDecodeError:
@@ -366,7 +554,11 @@ class SocketComm:
             if message == -1:
                 return SocketMessage.client_disconnected
             if message is not None:
-                message = json.loads(message.decode())
+                # a heartbeat may arrive in the same bulk as the message
+                messages = [self._filter_heartbeat(json.loads(line)) for line in message.decode().splitlines()
+                            if line.strip()]
+                messages = [m for m in messages if m is not None]
+                message = messages[0] if messages else None
             else:
                 return message
         except json.decoder.JSONDecodeError:
@@ -384,39 +576,68 @@ class SocketComm:
             if message == -1:
                 return SocketMessage.client_disconnected
             if message is not None:
-                message = json.loads(message.decode())
+                message = self._filter_heartbeat(json.loads(message.decode()))
         except json.decoder.JSONDecodeError:
             message = None
             self.log.error('message decoding failed')
         except OSError:
             message = None
             self.log.warning('socket disconnected and deleted')
+            self._connection_lost()
         return message
 
-    def send_json_message(self, message: dict):
+    def _filter_heartbeat(self, message):
+        """notes a heartbeat of the peer, it is handled here and not returned as a message"""
+        if isinstance(message, dict) and message.get('type') == MessageType.heartbeat.value:
+            self._peer_heartbeats = True
+            return None
+        return message
+
+    def reply_to(self, message: [dict, None]):
+        """
+        sets the message the calling thread handles, the messages it sends from now on echo its request_id
+        :param message: dict: received message, None to stop echoing
+        """
+        self._context.request_id = message.get('request_id') if message else None
+
+    @property
+    def request_id(self):
+        """request_id the messages sent by the calling thread echo, see reply_to"""
+        return getattr(self._context, 'request_id', None)
+
+    def send_json_message(self, message: dict, echo_id: bool = True):
         """
         Sends a json message over the socket
         :param message: dict: message to send of SocketMessage type
+        :param echo_id: bool: add the request_id of the message handled by this thread, see reply_to. False for
+            messages that are no reply, e.g. warnings
         :return:
         """
+        request_id = self.request_id
+        if echo_id and request_id is not None and 'request_id' not in message:
+            message = {**message, 'request_id': request_id}
         message = json.dumps(message).encode()
         message += b'\n'
         self._send(message)
 
     def _connect(self, host, port):
-        if self.use_ssl:
+        if self.unix_path is not None:
+            self.sock.connect(self.unix_path)
+        elif self.use_ssl:
             self.ssl_sock.connect((host, port))
         else:
             self.sock.connect((host, port))
 
     def _send(self, data):
         try:
-            if self.use_ssl:
-                self.ssl_sock.sendall(data)
-            else:
-                self.sock.sendall(data)
-        except ConnectionResetError:
+            with self._send_lock:  # whole messages only, several threads send
+                if self.use_ssl:
+                    self.ssl_sock.sendall(data)
+                else:
+                    self.sock.sendall(data)
+        except (BrokenPipeError, ConnectionResetError):
             self.log.error("Connection reset by peer")
+            self._connection_lost()
 
     def _recv(self, size) -> (bytes, int):
         try:
@@ -436,26 +657,38 @@ class SocketComm:
         :param delimiter:  bytes: delimiter to stop receiving
         :return: bytes, None, int: received data or None if no data is received or -1 if client disconnected
         """
-        data = b''
+        data, self._partial = self._partial, b''
         try:
             if self.use_ssl:
                 while not data.endswith(delimiter):
                     received = self.ssl_sock.recv(1)
-                    if received == b'':
-                        self.connected = False
-                        break
-                    data += self.ssl_sock.recv(1)
+                    if received == b'':  # closed by the peer
+                        self._connection_lost()
+                        return -1
+                    self.last_received = time.monotonic()
+                    data += received
             else:
                 while not data.endswith(delimiter):
-                    received = self.sock.recv(1)
-                    if received == b'':
-                        self.connected = False
-                        break
+                    # take a whole message per recv but leave what follows it, e.g. further pipelined messages or
+                    # raw file chunks read directly from the socket
+                    peeked = self.sock.recv(4096, socket.MSG_PEEK)
+                    end = peeked.find(delimiter)
+                    received = self.sock.recv(end + len(delimiter) if end >= 0 else len(peeked))
+                    if received == b'':  # closed by the peer
+                        self._connection_lost()
+                        return -1
+                    self.last_received = time.monotonic()
                     data += received
-        except socket.timeout:
+        except socket.timeout as e:
+            if e.errno is not None:  # keepalive probes unanswered, not the read timeout
+                self.log.warning("Connection timed out")
+                self._connection_lost()
+                return -1
+            self._partial = data  # completed by the next read
             data = None
         except (BrokenPipeError, ConnectionResetError):
             self.log.warning("Client disconnected")
+            self._connection_lost()
             data = -1
         return data
 
@@ -6,7 +6,7 @@ from queue import Queue
 import logging
 from spikeGLX_remote.GUI_utils import RemoteConnDialog
 from PyQt6.QtWidgets import QApplication, QMainWindow, QFileDialog, QMessageBox, QTableWidgetItem
-from PyQt6.QtCore import Qt, QTimer
+from PyQt6.QtCore import Qt, QTimer, pyqtSignal
 from PyQt6 import uic, QtGui
 
 from spikeGLX_remote.spikeGLXremote_ctrl import SpikeGLX_Controller
@@ -28,6 +28,9 @@ class SpikeGLX_ControllerGUI(QMainWindow):
     """
     GUI wrapper for SpikeGLX_Controller
     """
+    # emitted by the controller while it waits for the remote controller to reconnect, handled on the GUI thread
+    remote_reaccepting = pyqtSignal()
+    remote_reaccepted = pyqtSignal(bool)  # True once connected, False if waiting was aborted
 
     def __init__(self):
         super(SpikeGLX_ControllerGUI, self).__init__()
@@ -45,12 +48,18 @@ class SpikeGLX_ControllerGUI(QMainWindow):
         self.console_timer.start(50)  # units are milliseconds
         self.enable_console_logging()
         self.spikeglx_ctrl = SpikeGLX_Controller(self)
+        self.copy_list_timer = QTimer()
+        self.copy_list_timer.timeout.connect(self._poll_copy_list)
+        self.copy_list_timer.start(500)
+        self.forecast_timer = QTimer()
+        self.forecast_timer.timeout.connect(self._show_disk_forecast)
+        self.forecast_timer.start(2000)
         self.set_Icons()
         self.ConnectSignals()
         self.set_save_path(self.spikeglx_ctrl.save_path)
         if not DEVELOPMENT:
             self.connect_spikeglx()
-            if self.spikeglx_ctrl.hSglx is None:
+            if not self.spikeglx_ctrl.is_connected:
                 self.RECButton.setEnabled(False)
                 self.RUNButton.setEnabled(False)
                 self.RemoteModeButton.setEnabled(False)
@@ -155,37 +164,70 @@ class SpikeGLX_ControllerGUI(QMainWindow):
         """
         updates copy_tableWidget with the files to be copied
         """
-        self.copy_tableWidget.setRowCount(len(self.spikeglx_ctrl.files_list2copy))
-        self.copy_tableWidget.setColumnCount(3)
-        self.copy_tableWidget.setHorizontalHeaderLabels(['Session', 'Directory', 'Compressed?'])
-        for row, sess in enumerate(self.spikeglx_ctrl.files_list2copy):
+        sessions = list(self.spikeglx_ctrl.files_list2copy)
+        total = self.spikeglx_ctrl.get_copy_list_estimate()
+        self.copy_tableWidget.setRowCount(len(sessions) + (1 if total['n_sessions'] else 0))
+        self.copy_tableWidget.setColumnCount(6)
+        self.copy_tableWidget.setHorizontalHeaderLabels(['Session', 'Directory', 'Compressed?', 'Compress [min]',
+                                                         'Size [GB] raw/compr.', 'Copy [min] raw/compr.'])
+        for row, sess in enumerate(sessions):
             self.copy_tableWidget.setItem(row, 0, QTableWidgetItem(sess['session']))
             self.copy_tableWidget.setItem(row, 1, QTableWidgetItem(str(sess['directory'])))
             self.copy_tableWidget.setItem(row, 2, QTableWidgetItem(sess.get('compressed', 'No')))
+            if 'estimate' in sess:
+                self._set_estimate_row(row, sess['estimate'])
+        if total['n_sessions']:  # queue total of the sessions estimated so far
+            self.copy_tableWidget.setItem(len(sessions), 0, QTableWidgetItem(f"Total ({total['n_sessions']})"))
+            self._set_estimate_row(len(sessions), total)
         self.copy_tableWidget.horizontalHeader().setStretchLastSection(True)
 
+    def _set_estimate_row(self, row: int, estimate: dict):
+        """fills the estimate columns of the copy view"""
+        self.copy_tableWidget.setItem(row, 3, QTableWidgetItem(f"{estimate['compress_s'] / 60:.0f}"))
+        self.copy_tableWidget.setItem(row, 4, QTableWidgetItem(f"{estimate['raw_bytes'] / 2**30:.1f} / "
+                                                               f"{estimate['compressed_bytes'] / 2**30:.1f}"))
+        self.copy_tableWidget.setItem(row, 5, QTableWidgetItem(f"{estimate['copy_raw_s'] / 60:.0f} / "
+                                                               f"{estimate['copy_compressed_s'] / 60:.0f}"))
+
+    def _poll_copy_list(self):
+        """updates the copy view from the main thread if the controller changed the copy list, called by timer"""
+        if self.spikeglx_ctrl.copy_list_changed.is_set():
+            self.spikeglx_ctrl.copy_list_changed.clear()
+            self.update_copy_view()
+
+    def _show_disk_forecast(self):
+        """shows the remaining recording time in the status bar"""
+        forecast = self.spikeglx_ctrl.disk_forecaster.forecast
+        if forecast is None or forecast['minutes_left'] is None:
+            return
+        minutes = forecast['minutes_left']
+        text = f"{minutes // 60:.0f}h {minutes % 60:.0f}min" if minutes >= 60 else f"{minutes:.0f}min"
+        self.statusbar.showMessage(f"Recording time left: {text} at {forecast['write_MBps']:.1f} MB/s")
+
     def copy_file_list(self):
         """
-        calls the controller to copy the files in the copy list
+        calls the controller to copy the files in the copy list, runs in the background
         """
-        self.spikeglx_ctrl.copy_file_list()
-        self.update_copy_view()
+        self.spikeglx_ctrl.start_file_job(self.spikeglx_ctrl.copy_file_list)
 
     def clear_copy_list(self):
         """
         clears the copy list
         """
         self.spikeglx_ctrl.clear_copy_list()
-        self.update_copy_view()
 
     def compress_list(self):
-        self.spikeglx_ctrl.compress_file_list()
-        self.update_copy_view()
+        """
+        calls the controller to compress (and copy) the files in the copy list, runs in the background
+        """
+        self.spikeglx_ctrl.start_file_job(self.spikeglx_ctrl.compress_file_list)
 
     def ConnectSignals(self):
         """connects events to actions"""
         self.Save_pathButton.clicked.connect(self.set_save_path)
         self.RemoteModeButton.clicked.connect(self.remote_mode)
+        self.remote_reaccepting.connect(self.reaccept_pending)
+        self.remote_reaccepted.connect(self.reaccept_done)
         self.RECButton.clicked.connect(self.start_rec_button)
         self.STOPButton.clicked.connect(self.stop_spikeglx)
         self.RUNButton.clicked.connect(self.start_run)
@@ -274,6 +316,18 @@ class SpikeGLX_ControllerGUI(QMainWindow):
             # self.abort_remoteconnection()
             self.exit_remote_mode()
 
+    def reaccept_pending(self):
+        """the controller waits for the remote controller to reconnect, a second wait on the port would conflict"""
+        self.RemoteModeButton.setEnabled(False)
+        self.Client_label.setText("waiting for the client\nto reconnect...")
+
+    def reaccept_done(self, connected: bool):
+        self.RemoteModeButton.setEnabled(True)
+        if connected:
+            self.enter_remote_mode()
+        else:
+            self.Client_label.setText("disconnected")
+
     def enter_remote_mode(self):
         self.spikeglx_ctrl.enter_remote_mode()
         self.Client_label.setText(f"Connected to Client:\n{self.spikeglx_ctrl.socket_comm.addr}")
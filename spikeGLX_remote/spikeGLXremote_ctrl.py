@@ -1,16 +1,27 @@
 import logging
 import os
 import shutil
+import sqlite3
 import time
 from ctypes import byref, c_bool
 from pathlib import Path
 from threading import Thread, Event
-import numpy as np
 
-from mtscomp import compress as mtscompress
-
-from spikeGLX_remote.sglx_utils import get_num_saved_channels, get_sample_rate, read_meta
+from spikeGLX_remote.acq_agent import AgentClient
+from spikeGLX_remote.batch import get_params, run_batch, set_params
+from spikeGLX_remote.compress_utils import LiveCompressor, compress_folder, estimate_compression, get_codec
+from spikeGLX_remote.disk_forecast import DiskForecaster
+from spikeGLX_remote.drive_balance import DriveBalancer
+from spikeGLX_remote.file_utils import IOThrottle, copy_folder
+from spikeGLX_remote.live_publish import LivePublisher
+from spikeGLX_remote.multi_rig import MAIN_RIG, RigCoordinator
+from spikeGLX_remote.replication import LiveReplicator
+from spikeGLX_remote.retention import RetentionPolicy
+from spikeGLX_remote.session_index import SessionIndex
+from spikeGLX_remote.sglx_pool import SglxHandlePool
+from spikeGLX_remote.sglx_sync import SampleMapper, SessionEventLog, enumerate_streams, get_sync_stamp
 from spikeGLX_remote.socket_utils import SocketComm, SocketMessage, MessageType
+from spikeGLX_remote.transfer import TransferSender
 
 log = logging.getLogger('controller')
 log.setLevel(logging.DEBUG)
@@ -48,8 +59,8 @@ class SpikeGLX_Controller:
     :type is_remote_ctr: bool
     :parameter rec_start_time: time when recording started
     :type rec_start_time: float
-    :parameter hSglx: handle to the spikeglx api connection
-    :type hSglx: ctypes.c_void_p
+    :parameter sglx_pool: pool of handles to the spikeglx api connection, check out a handle per call
+    :type sglx_pool: SglxHandlePool
     :parameter is_recording: flag whether currently recording
     :type is_recording: bool
     :parameter is_viewing: flag whether currently viewing
@@ -58,6 +69,23 @@ class SpikeGLX_Controller:
     :type session_id: str
     :parameter recording_file: placeholder for the recording file
     :type recording_file: Path
+    :parameter armed_session: session id for which the next recording is already prepared
+    :type armed_session: str
+    :parameter prepare_latency: duration of the last recording preparation in s
+    :type prepare_latency: float
+    :parameter trigger_latency: time from start_recording call until the recording was enabled in s
+    :type trigger_latency: float
+    :parameter streams: (js, ip) of all streams of the current run
+    :type streams: list
+    :parameter event_log: log of all commands of the session stamped with the stream sample counts
+    :type event_log: SessionEventLog
+    :parameter sample_mapper: maps samples between streams of the current run
+    :type sample_mapper: SampleMapper
+    :parameter trial_plan: current trial series, with keys session_id, folder, g, t (index of the next or running
+        trial) and n_trials (None for open end)
+    :type trial_plan: dict
+    :parameter trial_armed: flag if the file name of the next trial is already set in spikeGLX
+    :type trial_armed: bool
     :parameter log: logger object
     :type log: logging.Logger
     :parameter socket_comm: socket communication object
@@ -70,8 +98,46 @@ class SpikeGLX_Controller:
     :type check_interval: int
     :parameter can_copy: flag if files can be copied
     :type can_copy: bool
+    :parameter agent: acquisition agent running the file jobs if spikeGLX runs on another computer, else None
+    :type agent: AgentClient
+    :parameter copy_list_changed: set when the list of files to copy changed
+    :type copy_list_changed: threading.Event
+    :parameter io_throttle: I/O budget of background copy and compression, limited while spikeGLX is saving
+    :type io_throttle: IOThrottle
+    :parameter file_job_thread: thread running the current background file job
+    :type file_job_thread: threading.Thread
+    :parameter live_compressor: compresses the files of the current recording while spikeGLX writes them
+    :type live_compressor: LiveCompressor
+    :parameter replication_path: session folder on the server the current recording is replicated to while recording
+    :type replication_path: Path
+    :parameter live_replicator: replicates the files of the current recording while spikeGLX writes them
+    :type live_replicator: LiveReplicator
+    :parameter replicated: (recording folder, session folder) of the last verified replication
+    :type replicated: tuple
+    :parameter copy_rate: bytes/s of the last copy to the data server, for estimating copy times
+    :type copy_rate: float
+    :parameter session_indexes: index of the sessions per data folder, empty if disabled or the files are not local
+    :type session_indexes: dict
+    :parameter retentions: per data folder the policy deleting sessions verified on the data server when space runs
+        low, empty if disabled
+    :type retentions: dict
+    :parameter drive_balancer: picks the data folders of the next session, None with a single data folder
+    :type drive_balancer: DriveBalancer
+    :parameter disk_forecaster: forecasts the remaining recording time from the stream write rates
+    :type disk_forecaster: DiskForecaster
+    :parameter rigs: starts and stops the further spikeGLX instances of RIGS together with this one, None without
+    :type rigs: RigCoordinator
+    :parameter live_publisher: publishes the live data of LIVE_SHM_STREAMS to shared memory while a run lasts, None
+        without
+    :type live_publisher: LivePublisher
     """
 
+    # messages not stamped in the event log on receipt, either stamped at their acknowledgement or plain queries
+    unstamped_messages = (MessageType.start_daq.value, MessageType.stop_daq.value, MessageType.trial_plan.value,
+                          MessageType.trial_start.value, MessageType.trial_end.value, MessageType.poll_status.value,
+                          MessageType.disconnected.value, MessageType.map_samples.value,
+                          MessageType.list_sessions.value, MessageType.disk_forecast.value, MessageType.batch.value)
+
     # TODO if no main use some more descriptive console output
     def __init__(self, main=None):
         self.main = main  # reference to the main gui
@@ -81,23 +147,67 @@ class SpikeGLX_Controller:
         self.session_path = None  # path to copy the files to
         self.is_remote_ctr = False  # bool if in remote control mode
         self.rec_start_time = None  # time when recording started
-        self.hSglx = None  # handle to the spikeglx api connection
+        self.sglx_pool = SglxHandlePool(SPIKEGLX_COMPUTER, SPIKEGLX_PORT, size=SGLX_POOL_SIZE)  # spikeglx api handles
         self.is_recording = False  # bool whether currently recording
         self.is_viewing = False  # bool whether currently viewing
         self.session_id = None  # placeholder for the current session id
         self.recording_file = None  # placeholder for the recording file
+        self.armed_session = None  # session id the next recording is prepared for
+        self.armed_file = None  # folder the next recording is prepared for
+        self.prepare_latency = None  # s duration of the last recording preparation
+        self.trigger_latency = None  # s from start_recording call until spikeGLX confirmed the recording
+        self.streams = None  # (js, ip) of all streams of the current run, queried once per run
+        self.event_log = SessionEventLog()  # sample stamped log of all commands of the session
+        self.sample_mapper = SampleMapper(self.sglx_pool, refresh_interval=SAMPLE_MAP_REFRESH)
+        self.trial_plan = None  # dict with session_id, folder, g, t and n_trials of the current trial series
+        self.trial_armed = False  # bool if the file name of the next trial is already set
         self.log = logging.getLogger('SpikeGLXController')
         self.log.setLevel(logging.INFO)
-        self.socket_comm = SocketComm('server', host=REMOTE_HOST, port=REMOTE_PORT)
+        self.socket_comm = SocketComm('server', host=REMOTE_HOST, port=REMOTE_PORT,
+                                      heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT,
+                                      keepalive=TCP_KEEPALIVE, on_disconnect=self._remote_lost,
+                                      unix_path=REMOTE_UNIX_SOCKET)
         self._save_path = Path(PATH2DATA)
         self.last_t_socket = time.monotonic()  # last time we checked for a message from the remote controller
-        self.check_interval = 1  # s check interval for messages
+        self.check_interval = 0  # s pause after a message before reading the next one
         self.can_copy = True if SPIKEGLX_COMPUTER == 'localhost' else False  # cant copy files if not on same machine
+        self.agent = None  # runs the file jobs next to the data if spikeGLX runs on another computer
+        if not self.can_copy and AGENT_HOST:
+            self.agent = AgentClient(AGENT_HOST, AGENT_PORT, on_progress=self._log_agent_progress)
         self.files_list2copy = []  # list of files to copy
+        self.copy_list_changed = Event()  # set when files_list2copy changed, for the GUI to update
+        self.io_throttle = IOThrottle(self.file_job_budget)  # I/O budget of background file jobs
+        self.file_job_thread = None  # thread running the current background file job
+        self.live_compressor = None  # compresses the files of the current recording while they are written
+        self.replication_path = None  # session folder on the server to replicate the next recording to
+        self.live_replicator = None  # replicates the files of the current recording while they are written
+        self.replication_thread = None  # thread finishing the last replication
+        self.replicated = None  # (recording folder, session folder) of the last verified replication
+        self.copy_rate = COPY_RATE_ESTIMATE * 2**20  # bytes/s of copies to the data server, measured on every copy
+        self.disk_forecaster = DiskForecaster(self.sglx_pool, interval=DISK_FORECAST_INTERVAL,
+                                              warn_minutes=WARN_RECORDING_MINUTES, multi_drive=MULTI_DRIVE,
+                                              on_warning=self.warn_disk_forecast)
+        self.session_indexes = {}  # index of the sessions per data folder
+        self.retentions = {}  # frees space by deleting sessions verified on the data server, per data folder
+        self.drive_balancer = None  # picks the data folders of the next session
+        self.stripe_dirs = []  # further data folders spikeGLX splits the armed recording over
+        self.recording_stripe_dirs = []  # further data folders of the current recording
+        if DATA_DIRS:
+            self.drive_balancer = DriveBalancer(self.data_dirs, busy=self.recording_started)
+            self.refresh_drive_throughput()
+        self.rigs = None  # further spikeGLX instances controlled together with this one
+        if RIGS:
+            self.rigs = RigCoordinator.from_config(self.sglx_pool, RIGS)
+        self.live_publisher = None  # fans the live data out to analysis processes on this computer
+        if LIVE_SHM_STREAMS:
+            self.live_publisher = LivePublisher(self.sglx_pool, LIVE_SHM_STREAMS, prefix=LIVE_SHM_PREFIX,
+                                                block=LIVE_SHM_BLOCK, seconds=LIVE_SHM_SECONDS)
+        self.open_session_index()
         if not DEVELOPMENT:  # switch off spikeGLX if in development mode (not on windows)
             self.connect_spikeglx()
-            if self.hSglx is None:
+            if not self.is_connected:
                 self.log.error("Error connecting to SpikeGLX")
+            self.disk_forecaster.start()  # polls once SpikeGLX is connected
 
     @property
     def save_path(self):
@@ -114,231 +224,626 @@ class SpikeGLX_Controller:
             self._save_path = Path(path)
         except TypeError:
             self.log.error("Error setting save path, must be a str or Path object")
+        if self.drive_balancer is not None:
+            self.drive_balancer.dirs = self.data_dirs
+        self.open_session_index()
+
+    @property
+    def is_connected(self) -> bool:
+        """bool if connected to SpikeGLX"""
+        return self.sglx_pool.connected
 
     def connect_spikeglx(self):
-        """create the connection handle to the SpikeGLX process"""
-        if self.hSglx is None:
+        """create the connection handles to the SpikeGLX process"""
+        if not self.sglx_pool.connected:
             self.log.debug("Calling connect to spikeGLX...")
-            self.hSglx = sglx.c_sglx_createHandle()
-
-            # Using default loopback address and port
-            if sglx.c_sglx_connect(self.hSglx, SPIKEGLX_COMPUTER.encode(), SPIKEGLX_PORT):
-                self.log.info(f"Connected to {sglx.c_sglx_getVersion(self.hSglx).decode()}")
+            if self.sglx_pool.connect():
+                self.log.info(f"Connected to {self.sglx_pool.version}")
+                if self.rigs is not None and not self.rigs.connect():
+                    self.log.error("Not all rigs connected")
             else:
-                error = sglx.c_sglx_getError(self.hSglx).decode()
+                error = self.sglx_pool.last_error
                 if error == "sglx_connect: tcpConnect: Can't connect: No error (0)":
                     self.log.error("Cant establish SpikeGLX connection. is it running ?")
-                self.hSglx = None
+                else:
+                    self.log.error(error)
 
     def disconnect_spikeglx(self):
         """
-        disconnect from the SpikeGLX and delete handle
+        disconnect from the SpikeGLX and delete handles
         :return:
         """
-        if self.hSglx:
+        if self.sglx_pool.connected:
             if self.ask_is_running() or self.ask_is_recording():
                 self.stop_spikeglx()
-            sglx.c_sglx_close(self.hSglx)
-            sglx.c_sglx_destroyHandle(self.hSglx)
-            self.hSglx = None
+            self.sglx_pool.close()
+            if self.rigs is not None:
+                self.rigs.close()
+                self.rigs = RigCoordinator.from_config(self.sglx_pool, RIGS)  # fresh pools for a reconnect
             self.log.debug("Closed connection to SpikeGLX")
 
-    def ask_is_initialized(self) -> bool:
+    def _ask_bool(self, query, name: str) -> bool:
         """
-        checks if spikeGLX is currently initialized, and thus ready to start
-        :return: bool if initialized
+        runs a boolean status query of the SpikeGLX-api on a pooled handle
+        :param query: sglx function taking (byref(c_bool), hSglx)
+        :param name: name of the query as used in the SpikeGLX error messages
+        :return: bool answer, False on error
         """
         hid = c_bool()
-        ok = sglx.c_sglx_isInitialized(byref(hid), self.hSglx)
-        if ok:
-            return bool(hid)
-        else:
-            error = sglx.c_sglx_getError(self.hSglx).decode()
-            if error == "sglx_isInitialized: tcpConnect: Can't connect: No error (0)":
+        broken = False
+        with self.sglx_pool.checkout() as hSglx:
+            if hSglx is None:
+                return False
+            ok = query(byref(hid), hSglx)
+            if ok:
+                return bool(hid)
+            error = sglx.c_sglx_getError(hSglx).decode()
+            if error == f"{name}: tcpConnect: Can't connect: No error (0)":
                 self.log.error("SpikeGLX connection broken, try to reconnect")
-                self.disconnect_spikeglx()
+                broken = True
             else:
                 self.log.error(error)
-            return False
+        if broken:  # handle has to be returned before the pool can be closed
+            self.disconnect_spikeglx()
+        return False
+
+    def ask_is_initialized(self) -> bool:
+        """
+        checks if spikeGLX is currently initialized, and thus ready to start
+        :return: bool if initialized
+        """
+        return self._ask_bool(sglx.c_sglx_isInitialized, "sglx_isInitialized")
 
     def ask_is_running(self) -> bool:
         """
         checks if spikeGLX is currently running
         :return: bool if running
         """
-        hid = c_bool()
-        ok = sglx.c_sglx_isRunning(byref(hid), self.hSglx)
-        if ok:
-            return bool(hid)
-        else:
-            error = sglx.c_sglx_getError(self.hSglx).decode()
-            if error == "sglx_isRunning: tcpConnect: Can't connect: No error (0)":
-                self.log.error("SpikeGLX connection broken, try to reconnect")
-                self.disconnect_spikeglx()
-            else:
-                self.log.error(error)
-            return False
+        return self._ask_bool(sglx.c_sglx_isRunning, "sglx_isRunning")
 
     def ask_is_recording(self) -> bool:
         """
         checks if spikeGLX is currently recording
         :return: bool if recording
         """
-        hid = c_bool()
-        ok = sglx.c_sglx_isSaving(byref(hid), self.hSglx)
-        if ok:
-            return bool(hid)
-        else:
-            self.log.error(f"{sglx.c_sglx_getError(self.hSglx)}")
+        return self._ask_bool(sglx.c_sglx_isSaving, "sglx_isSaving")
+
+    def get_sync_stamp(self, hSglx, file_start: bool = False) -> dict:
+        """
+        gets the spikeGLX time and sample count of every stream, the list of streams is queried only once per run
+        :param hSglx: handle checked out from the sglx_pool
+        :param file_start: bool: also get the first sample of the currently written files
+        :return: dict: sync stamp, see sglx_sync.get_sync_stamp
+        """
+        if self.streams is None:
+            self.streams = enumerate_streams(hSglx)
+        return get_sync_stamp(hSglx, self.streams, file_start=file_start)
+
+    def log_command(self, command: str, session_id: [str, None] = None, **info) -> dict:
+        """
+        adds a command to the session event log, stamped with the current sample counts
+        :param command: str: command or message type
+        :param session_id: str: session the command belongs to, defaults to the current session id
+        :return: dict: the logged event
+        """
+        with self.sglx_pool.checkout() as hSglx:
+            stamp = self.get_sync_stamp(hSglx) if hSglx is not None else None
+        return self.event_log.add(session_id or self.session_id, command, stamp, **info)
+
+    def prepare_recording(self) -> bool:
+        """
+        Does all setup of a recording ahead of time: checks disk space and that spikeGLX is running, creates the
+        session folder and sets the next file name. A following start_recording then only enables the recording.
+        The file name is consumed by the next recording, so arming has to be repeated for every recording.
+        :return: bool if armed
+        """
+        if self.armed_session is not None and self.armed_session == self.session_id:
+            return True
+        if not self.session_id:
+            self.log.error("No session id to prepare the recording for")
+            return False
+        t_start = time.perf_counter()
+        self.check_disk_space()
+        if not self.ask_is_running():
+            self.log.error("SpikeGLX not running")
+            return False
+        with self.sglx_pool.checkout(control=True) as hSglx:
+            if hSglx is None:
+                return False
+            # keep recording_file pointing to the last recording until the new one starts, it may still be copied
+            armed_file = (self.select_data_dirs(hSglx) / self.session_id)
+            armed_file.mkdir(exist_ok=True)
+            file_name = (armed_file / self.session_id).as_posix().encode()
+            ok = sglx.c_sglx_setNextFileName(hSglx, file_name)
+            if not ok:
+                self.log.error(f"{sglx.c_sglx_getError(hSglx)}")
+                return False
+        if self.rigs is not None and not self.rigs.set_next_file_names(self.session_id)['ok']:
             return False
+        self.armed_session = self.session_id
+        self.armed_file = armed_file
+        self.prepare_latency = time.perf_counter() - t_start
+        self.log.info(f"Prepared recording session {self.session_id} in {self.prepare_latency * 1000:.1f}ms")
+        return True
 
     def start_recording(self):
         """
         Sends message to spikeGLX process to start recording.
-        To call this spikeGLX needs to be initialized and running.
+        To call this spikeGLX needs to be initialized and running. If the recording was not prepared for the current
+        session id, it is prepared first.
         """
-        self.files_copied = False
-        self.check_disk_space()
-        if self.ask_is_running():
-            self.recording_file = (self.save_path / self.session_id)
-            self.recording_file.mkdir(exist_ok=True)
-            file_name = (self.recording_file / self.session_id).as_posix().encode()
-            ok = sglx.c_sglx_setNextFileName(self.hSglx, file_name)
-            if ok:
-                ok = sglx.c_sglx_setRecordingEnable(self.hSglx, 1)
-                if ok:
-                    self.log.info(f"Started recording session {self.session_id}")
-                    if self.socket_comm.connected:
-                        self.socket_comm.send_json_message(SocketMessage.respond_recording)
-                    self.is_recording = True
-                    self.rec_start_time = time.monotonic()
-                else:
-                    self.log.error(f"{sglx.c_sglx_getError(self.hSglx)}")
-                    self.send_socket_error()
-            else:
-                self.log.error(f"{sglx.c_sglx_getError(self.hSglx)}")
-                self.send_socket_error()
-        else:
+        stamp = self._start_recording()
+        if stamp is None:
             self.send_socket_error()
-            self.log.error("SpikeGLX not running")
+            return
+        if self.socket_comm.connected:
+            self.socket_comm.send_json_message({**SocketMessage.respond_recording, **self.get_latency_report(),
+                                                'sync': stamp})
+
+    def _start_recording(self) -> [dict, None]:
+        """
+        starts the recording without replying to the remote controller, see start_recording
+        :return: dict: sync stamp of the start, None if the recording did not start
+        """
+        t_start = time.perf_counter()
+        self.files_copied = False
+        if self.armed_session is None or self.armed_session != self.session_id:
+            self.prepare_latency = None
+            if not self.prepare_recording():
+                return None
+        with self.sglx_pool.checkout(control=True) as hSglx:
+            if hSglx is None:
+                return None
+            ok = self.set_recording_enable(hSglx, True)
+            self.armed_session = None  # the file name is used up by this recording
+            if not ok:
+                self.log.error(f"{sglx.c_sglx_getError(hSglx)}")
+                return None
+            self.trigger_latency = time.perf_counter() - t_start
+            self.recording_file = self.armed_file
+            self.recording_stripe_dirs = self.stripe_dirs
+            self.is_recording = True
+            self.rec_start_time = time.monotonic()
+            stamp = self.get_sync_stamp(hSglx, file_start=True)
+        self.start_live_file_jobs()
+        self.log.info(f"Started recording session {self.session_id} "
+                      f"(trigger latency {self.trigger_latency * 1000:.1f}ms)")
+        self.event_log.add(self.session_id, MessageType.start_daq.value, stamp, **self.get_latency_report())
+        self.event_log.set_folder(self.recording_file)
+        return stamp
+
+    def get_latency_report(self) -> dict:
+        """
+        :return: dict with the latencies in ms of the last prepare and recording start, None if not measured
+        """
+        report = {'prepare_ms': None if self.prepare_latency is None else round(self.prepare_latency * 1000, 3),
+                  'trigger_ms': None if self.trigger_latency is None else round(self.trigger_latency * 1000, 3)}
+        if self.rigs is not None:
+            report['rigs'] = self.rigs.last_report
+        return report
+
+    def set_recording_enable(self, hSglx, enable: bool) -> bool:
+        """
+        enables or disables the recording, with RIGS on all rigs at once
+        :param hSglx: handle checked out from the sglx_pool for control commands
+        :param enable: bool: enable recording
+        :return: bool if successful on all rigs
+        """
+        if self.rigs is None:
+            return sglx.c_sglx_setRecordingEnable(hSglx, int(enable))
+        report = self.rigs.set_recording(enable, held={MAIN_RIG: hSglx})
+        self.log.info(f"Recording {'enabled' if enable else 'disabled'} on {len(report['rigs'])} rigs, skew "
+                      f"{report['ack_skew_ms']}ms")
+        return report['ok']
+
+    def start_rig_run(self, hSglx, run_name: str) -> bool:
+        """
+        starts a run, with RIGS on all rigs at once
+        :param hSglx: handle checked out from the sglx_pool for control commands
+        :param run_name: str: run name
+        :return: bool if successful on all rigs
+        """
+        if self.rigs is None:
+            return sglx.c_sglx_startRun(hSglx, run_name.encode())
+        return self.rigs.start_run(run_name, held={MAIN_RIG: hSglx})['ok']
+
+    def stop_rig_run(self, hSglx) -> bool:
+        """
+        stops the run, with RIGS on all rigs at once
+        :param hSglx: handle checked out from the sglx_pool for control commands
+        :return: bool if successful on all rigs
+        """
+        if self.rigs is None:
+            return sglx.c_sglx_stopRun(hSglx)
+        return self.rigs.stop_run(held={MAIN_RIG: hSglx})['ok']
 
     def start_run(self):
         """
         Sends message to spikeGLX process to start viewing.
         To call this spikeGLX needs to be initialized.
         """
-        if self.ask_is_initialized():
-            if self.session_id is None:
-                self.session_id = f'MusterMausTest_{time.strftime("%Y%m%d_%H%M%S")}'
-            ok = sglx.c_sglx_startRun(self.hSglx, self.session_id.encode())
-            if ok:
-                self.log.info(f"Started viewing session {self.session_id}")
-                if self.socket_comm.connected:
-                    self.socket_comm.send_json_message(SocketMessage.respond_viewing)
-                self.is_viewing = True
-                self.rec_start_time = time.monotonic()
-            else:
-                self.log.error(f"{sglx.c_sglx_getError(self.hSglx)}")
-        else:
+        if not self._start_run():
             self.send_socket_error()
+        elif self.socket_comm.connected:
+            self.socket_comm.send_json_message({**SocketMessage.respond_viewing, **(
+                {'rigs': self.rigs.last_report} if self.rigs is not None else {})})
+
+    def _start_run(self) -> bool:
+        """
+        starts the run without replying to the remote controller, see start_run
+        :return: bool if the run started
+        """
+        if not self.ask_is_initialized():
             self.log.error("SpikeGLX not initialized")
+            return False
+        if self.session_id is None:
+            self.session_id = f'MusterMausTest_{time.strftime("%Y%m%d_%H%M%S")}'
+        with self.sglx_pool.checkout(control=True) as hSglx:
+            if hSglx is None:
+                return False
+            if not self.start_rig_run(hSglx, self.session_id):
+                self.log.error(f"{sglx.c_sglx_getError(hSglx)}")
+                return False
+        self.streams = None  # stream layout may have changed with the new run
+        self.sample_mapper.invalidate()
+        self.log.info(f"Started viewing session {self.session_id}")
+        self.is_viewing = True
+        self.rec_start_time = time.monotonic()
+        self.start_live_publisher()
+        return True
+
+    def start_live_publisher(self):
+        """publishes the live data of the new run to shared memory if LIVE_SHM_STREAMS are set"""
+        if self.live_publisher is not None and not self.live_publisher.start():
+            self.log.error("Live data not published to shared memory")
+
+    def stop_live_publisher(self):
+        if self.live_publisher is not None:
+            self.live_publisher.stop()
 
     def start_run_record(self):
         """
         this combines the run and recording start into single function,
         not sure if needed probably manually start the run and then the recording via remote
         """
-        ok = sglx.c_sglx_startRun(self.hSglx, self.session_id.encode())
-        if ok:
-            self.recording_file = (self.save_path / self.session_id)
-            self.recording_file.mkdir(exist_ok=True)
-            file_name = (self.recording_file / self.session_id).as_posix().encode()
-            ok = sglx.c_sglx_setNextFileName(self.hSglx, file_name)
-            ok = sglx.c_sglx_setRecordingEnable(self.hSglx, 1)
+        with self.sglx_pool.checkout(control=True) as hSglx:
+            if hSglx is None:
+                return
+            ok = self.start_rig_run(hSglx, self.session_id)
             if ok:
-                self.log.info(f"Started recording session {self.session_id}")
-                if self.socket_comm.connected:
-                    self.socket_comm.send_json_message(SocketMessage.respond_recording)
-                self.is_recording = True
-                self.rec_start_time = time.monotonic()
+                self.streams = None
+                self.sample_mapper.invalidate()
+                self.start_live_publisher()
+                self.recording_file = (self.select_data_dirs(hSglx) / self.session_id)
+                self.recording_stripe_dirs = self.stripe_dirs
+                self.recording_file.mkdir(exist_ok=True)
+                file_name = (self.recording_file / self.session_id).as_posix().encode()
+                ok = sglx.c_sglx_setNextFileName(hSglx, file_name)
+                if ok and self.rigs is not None:
+                    ok = self.rigs.set_next_file_names(self.session_id)['ok']
+                if not ok:
+                    self.log.error("Cant set the file name of the recording on all rigs")
+                    self.send_socket_error()
+                    return
+                ok = self.set_recording_enable(hSglx, True)
+                if ok:
+                    self.log.info(f"Started recording session {self.session_id}")
+                    if self.socket_comm.connected:
+                        self.socket_comm.send_json_message(SocketMessage.respond_recording)
+                    self.is_recording = True
+                    self.rec_start_time = time.monotonic()
+                    self.start_live_file_jobs()
 
     def stop_recording(self):
         """
         stops recording to file but continues viewing
         """
         if self.ask_is_recording():
-            ok = sglx.c_sglx_setRecordingEnable(self.hSglx, 0)
+            with self.sglx_pool.checkout(control=True) as hSglx:
+                if hSglx is None:
+                    self.send_socket_error()
+                    return
+                ok = self.set_recording_enable(hSglx, False)
+                if ok:
+                    stamp = self.get_sync_stamp(hSglx, file_start=True)
+                    duration = time.monotonic() - self.rec_start_time
+                    self.log.info(f"Stopped recording session {self.session_id} after {duration:.1f}s")
+                    if self.socket_comm.connected:
+                        self.socket_comm.send_json_message({**SocketMessage.respond_stop, 'sync': stamp, **(
+                            {'rigs': self.rigs.last_report} if self.rigs is not None else {})})
+                    self.event_log.add(self.session_id, MessageType.stop_daq.value, stamp, duration=duration)
+                    self.is_recording = False
+                    self.finish_live_file_jobs()
+                    self.refresh_session_index()
+                    self.refresh_drive_throughput()
+                else:
+                    self.log.error(f"{sglx.c_sglx_getError(hSglx)}")
+                    self.send_socket_error()
+
+    def stop_spikeglx(self):
+        """
+        Sends message to spikeGLX process to stop recording or viewing
+        """
+        with self.sglx_pool.checkout(control=True) as hSglx:
+            if hSglx is None:
+                self.send_socket_error()
+                return
+            if self.is_recording:  # last chance to get the sample counts of this run
+                stamp = self.get_sync_stamp(hSglx, file_start=True)
+            self.stop_live_publisher()  # its fetches fail once the run stopped
+            ok = self.stop_rig_run(hSglx)
             if ok:
-                self.log.info(f"Stopped recording session {self.session_id} after "
-                              f"{time.monotonic() - self.rec_start_time:.1f}s")
-                if self.socket_comm.connected:
-                    self.socket_comm.send_json_message(SocketMessage.respond_stop)
+                self.armed_session = None  # file name override is gone with the run
+                self.trial_armed = False
+                if self.is_recording:
+                    duration = time.monotonic() - self.rec_start_time
+                    self.log.info(f"Stopped recording session {self.session_id} after {duration:.1f}s")
+                    if self.socket_comm.connected:
+                        self.socket_comm.send_json_message({**SocketMessage.respond_stop, 'sync': stamp})
+                    self.event_log.add(self.session_id, MessageType.stop_daq.value, stamp, duration=duration)
+                self.streams = None
+                self.sample_mapper.invalidate()
                 self.is_recording = False
+                self.is_viewing = False
+                self.finish_live_file_jobs()
             else:
-                self.log.error(f"{sglx.c_sglx_getError(self.hSglx)}")
+                self.log.error(f"{sglx.c_sglx_getError(hSglx)}")
                 self.send_socket_error()
+                self.start_live_publisher()
 
-    def stop_spikeglx(self):
+    def plan_trials(self, session_id: str, n_trials: [int, None] = None, g_index: int = 0) -> bool:
         """
-        Sends message to spikeGLX process to stop recording or viewing
+        Sets up a software triggered trial series. All trials are saved flat into one session folder with file names
+        <session_id>.g<g_index>_t<t>, the t-index is tracked here. The name of the first trial is set right away, so
+        start_trial only has to enable the recording.
+        To call this spikeGLX needs to be running.
+        :param session_id: str: session id, also the name of the session folder
+        :param n_trials: int: number of trials in the series, None for open end
+        :param g_index: int: g-index of the file names
+        :return: bool if the trial series is ready
+        """
+        if self.is_recording:
+            self.log.error("Cant plan trials while recording")
+            return False
+        if not self.ask_is_running():
+            self.log.error("SpikeGLX not running")
+            return False
+        self.session_id = session_id
+        self.check_disk_space()
+        with self.sglx_pool.checkout(control=True) as hSglx:
+            if hSglx is None:
+                return False
+            folder = self.select_data_dirs(hSglx) / session_id
+            folder.mkdir(exist_ok=True)
+            self.files_copied = False
+            self.recording_file = folder
+            self.recording_stripe_dirs = self.stripe_dirs
+            self.armed_session = None  # a trial file name replaces a prepared recording
+            self.trial_plan = {'session_id': session_id, 'folder': folder, 'g': g_index, 't': 0,
+                               'n_trials': n_trials}
+            self.trial_armed = False
+            self.event_log.add(session_id, MessageType.trial_plan.value, n_trials=n_trials, g=g_index)
+            self.event_log.set_folder(folder)
+            self.start_live_file_jobs()
+            self._arm_trial(hSglx)
+        self.log.info(f"Planned {n_trials or 'open-ended'} trials for session {session_id}")
+        return self.trial_armed
+
+    def _arm_trial(self, hSglx):
+        """
+        sets the file name of the next trial in spikeGLX, with RIGS on all rigs, the trial is only armed if all are set
+        :param hSglx: handle checked out from the sglx_pool for control commands
+        """
+        plan = self.trial_plan
+        if plan['n_trials'] is not None and plan['t'] >= plan['n_trials']:
+            return
+        file_name = plan['folder'] / f"{plan['session_id']}_g{plan['g']}_t{plan['t']}"
+        self.trial_armed = sglx.c_sglx_setNextFileName(hSglx, file_name.as_posix().encode())
+        if not self.trial_armed:
+            self.log.error(f"{sglx.c_sglx_getError(hSglx)}")
+            return
+        if self.rigs is not None and not self.rigs.set_next_file_names(plan['session_id'],
+                                                                       file_name=file_name.name)['ok']:
+            self.log.error(f"Not all rigs armed for trial {plan['t']}")
+            self.trial_armed = False
+
+    def start_trial(self):
+        """
+        starts recording the next trial of the trial plan, only enables the recording if its file name is already set
+        """
+        t_start = time.perf_counter()
+        plan = self.trial_plan
+        if plan is None or self.is_recording:
+            self.log.error("No trial planned or already recording")
+            self.socket_comm.send_json_message(SocketMessage.respond_trial_fail)
+            return
+        if plan['n_trials'] is not None and plan['t'] >= plan['n_trials']:
+            self.log.error(f"All {plan['n_trials']} planned trials are done")
+            self.socket_comm.send_json_message(SocketMessage.respond_trial_fail)
+            return
+        with self.sglx_pool.checkout(control=True) as hSglx:
+            if hSglx is None:
+                self.socket_comm.send_json_message(SocketMessage.respond_trial_fail)
+                return
+            if not self.trial_armed:
+                self._arm_trial(hSglx)
+            ok = self.trial_armed and self.set_recording_enable(hSglx, True)
+            self.trial_armed = False
+            if not ok:
+                self.log.error(f"{sglx.c_sglx_getError(hSglx)}")
+                self.socket_comm.send_json_message(SocketMessage.respond_trial_fail)
+                return
+            self.trigger_latency = time.perf_counter() - t_start
+            self.is_recording = True
+            self.rec_start_time = time.monotonic()
+            stamp = self.get_sync_stamp(hSglx)
+        self.log.debug(f"Started trial {plan['t']} (trigger latency {self.trigger_latency * 1000:.1f}ms)")
+        info = {'g': plan['g'], 'trial': plan['t'], 'trigger_ms': round(self.trigger_latency * 1000, 3)}
+        self.socket_comm.send_json_message({**SocketMessage.respond_trial_start, **info, 'sync': stamp})
+        self.event_log.add(plan['session_id'], MessageType.trial_start.value, stamp, **info)
+
+    def end_trial(self):
+        """
+        stops recording the current trial and right away sets the file name of the next trial
         """
-        ok = sglx.c_sglx_stopRun(self.hSglx)
-        if ok:
-            if self.is_recording:
-                self.log.info(f"Stopped recording session {self.session_id} after "
-                              f"{time.monotonic() - self.rec_start_time:.1f}s")
-                if self.socket_comm.connected:
-                    self.socket_comm.send_json_message(SocketMessage.respond_stop)
+        plan = self.trial_plan
+        if plan is None or not self.is_recording:
+            self.log.error("No trial running")
+            self.socket_comm.send_json_message(SocketMessage.respond_trial_fail)
+            return
+        with self.sglx_pool.checkout(control=True) as hSglx:
+            if hSglx is None:
+                self.socket_comm.send_json_message(SocketMessage.respond_trial_fail)
+                return
+            ok = self.set_recording_enable(hSglx, False)
+            if not ok:
+                self.log.error(f"{sglx.c_sglx_getError(hSglx)}")
+                self.socket_comm.send_json_message(SocketMessage.respond_trial_fail)
+                return
             self.is_recording = False
-            self.is_viewing = False
-        else:
-            self.log.error(f"{sglx.c_sglx_getError(self.hSglx)}")
-            self.send_socket_error()
+            info = {'g': plan['g'], 'trial': plan['t'], 'duration': time.monotonic() - self.rec_start_time}
+            plan['t'] += 1
+            self._arm_trial(hSglx)
+            stamp = self.get_sync_stamp(hSglx, file_start=True)
+        self.socket_comm.send_json_message({**SocketMessage.respond_trial_end, **info, 'sync': stamp})
+        self.event_log.add(plan['session_id'], MessageType.trial_end.value, stamp, **info)
+        if plan['n_trials'] is not None and plan['t'] >= plan['n_trials']:
+            self.log.info(f"Finished all {plan['n_trials']} trials of session {plan['session_id']}")
+            self.finish_live_file_jobs()
 
     def purge_recorded_file(self):
         """
-        deletes the previously recorded files
+        deletes the previously recorded files, locally in the background
         """
         if self.is_recording is False and self.recording_file is not None:
-            if not self.can_copy:
+            if not self.can_copy and self.agent is None:
                 self.log.error("Cant delete files if not on same machine")
                 self.socket_comm.send_json_message(SocketMessage.respond_copy_fail)
                 return
             self.log.info("Purging recorded files")
-            shutil.rmtree(self.recording_file)
+            for folder in self.recording_folders():
+                if self.agent is not None:
+                    try:
+                        self.agent.run('purge', folder=str(folder))
+                    except IOError as e:
+                        self.log.error(f"Error purging files {e}")
+                        self.socket_comm.send_json_message(SocketMessage.respond_copy_fail)
+                        return
+                else:
+                    Thread(target=self._purge_folder, args=(folder,), daemon=True).start()
         self.recording_file = None
+        self.recording_stripe_dirs = []
+
+    def _purge_folder(self, folder: Path):
+        try:
+            shutil.rmtree(folder)
+        except OSError as e:
+            self.log.error(f"Error purging files {e}")
+            self.socket_comm.send_json_message(SocketMessage.respond_copy_fail)
+            return
+        index = self.get_session_index(folder)
+        if index is not None:
+            self._scan_session_index(index)
 
     @staticmethod
-    def compress_recorded_file(path2file: [Path, str]) -> [Path, int]:
+    def compress_recorded_file(path2file: [Path, str], throttle: [IOThrottle, None] = None) -> [Path, int]:
+        """
+        compresses the previously recorded files, each stream kind (ap, lf, nidq, obx) with the codec set in
+        COMPRESSION, kinds without settings are not compressed
+        :param path2file: session folder or file in it
+        :param throttle: IOThrottle: budget for reading the files, None for no limit
+        """
+        return compress_folder(path2file, COMPRESSION, throttle=throttle) or 0
+
+    def start_live_file_jobs(self):
         """
-        compresses the previously recorded files
+        starts compressing and replicating the files of the current recording while spikeGLX writes them, if enabled
         """
-        if isinstance(path2file, str):
-            path2file = Path(path2file)
-        if path2file.exists():
-            if not path2file.is_dir():
-                path2file = path2file.parent
-            # find the ap.bin file get its name
+        if not self.can_copy:  # files need to be on this machine
+            return
+        running = self.live_compressor or self.live_replicator
+        if running is not None and running.folder != self.recording_file:  # jobs of a previous recording
+            replication_path = self.replication_path
+            self.finish_live_file_jobs()
+            self.replication_path = replication_path
+        # running jobs keep going e.g. for the next trial of a trial series
+        if LIVE_COMPRESS and COMPRESSION.get('ap') and self.live_compressor is None:
             try:
-                metafile = list(path2file.glob('*.ap.meta'))[0]
-                bin_file = list(path2file.glob('*.ap.bin'))[0]
-                out_file = bin_file.with_suffix('.cbin')
-                out_meta = bin_file.with_suffix('.ch')
-                out_file = out_file.parent / 'compressed' / out_file.name
-                out_meta = out_meta.parent / 'compressed' / out_meta.name
-                meta = read_meta(metafile)
-                sample_rate = get_sample_rate(meta)
-                n_channels = get_num_saved_channels(meta)
-            except IndexError:
-                log.error(f"No ap.bin file found at {path2file}")
-                return 0
-            mtscompress(bin_file, out_file, out_meta, sample_rate=sample_rate, n_channels=n_channels, dtype=np.int16)
-            # copy meta file
-            shutil.copy2(metafile, out_meta.parent)
-        else:
-            log.error(f"Path {path2file} not found")
-            return 0
-        return out_file.parent
+                codec = get_codec(**COMPRESSION['ap'])
+            except ValueError as e:
+                self.log.error(f"Cant compress while recording: {e}")
+            else:
+                self.live_compressor = LiveCompressor(self.recording_file, lag=LIVE_COMPRESS_LAG, codec=codec,
+                                                      throttle=self.io_throttle)
+                self.live_compressor.start()
+        if LIVE_REPLICATE and self.replication_path is not None and self.live_replicator is None:
+            if not self.replication_path.exists() and 'MusterMaus' not in self.session_id:
+                self.log.error(f"Session path {self.replication_path} doesnt exist, cant replicate")
+                return
+            self.live_replicator = LiveReplicator(self.recording_file, self.replication_path,
+                                                  interval=LIVE_REPLICATE_INTERVAL, throttle=self.io_throttle,
+                                                  chunk_size=IO_CHUNK_SIZE * 2**20)
+            self.live_replicator.start()
+
+    def finish_live_file_jobs(self):
+        """
+        finalizes the compression and replication in the background once spikeGLX closed the recorded files
+        """
+        compressor, self.live_compressor = self.live_compressor, None
+        replicator, self.live_replicator = self.live_replicator, None
+        self.replication_path = None  # the next recording needs its own session folder
+        if compressor is None and replicator is None:
+            return
+
+        def finish():
+            if compressor is not None:
+                if compressor.stop():
+                    self.log.info(f"Finished compressing {compressor.folder} while recording")
+                else:
+                    self.log.error(f"Compression while recording failed for {compressor.folder}, "
+                                   f"compress it again after the session")
+            if replicator is not None:
+                if replicator.stop():
+                    self.replicated = (replicator.folder, replicator.destination)
+                    self.index_copy(replicator.folder, replicator.destination, verified=True)
+                    self.log.info(f"Finished replicating {replicator.folder} to {replicator.destination}")
+                else:
+                    self.log.error(f"Replication while recording failed for {replicator.folder}, "
+                                   f"the files will be copied again")
+
+        self.replication_thread = Thread(target=finish, daemon=True)
+        self.replication_thread.start()
+
+    @property
+    def replication_pending(self) -> bool:
+        """bool if the final catch-up of the last replication is still running"""
+        return self.replication_thread is not None and self.replication_thread.is_alive()
+
+    def after_replication(self, job):
+        """
+        runs a copy job once the final catch-up of the replication finished, in a background thread so the remote
+        controller is served meanwhile. The replies of the job echo the request id of the current message.
+        :param job: callable
+        """
+        self.log.info("Waiting for the replication to finish before copying")
+        request_id, replication_thread = self.socket_comm.request_id, self.replication_thread
+
+        def run():
+            replication_thread.join()
+            self.socket_comm.reply_to({'request_id': request_id})
+            job()
+
+        Thread(target=run, daemon=True).start()
+
+    def is_replicated(self, folder: Path, directory: Path) -> bool:
+        """
+        checks if a recording folder was replicated to the session folder while recording, call once the replication
+        finished, see replication_pending
+        :param folder: Path: recording folder
+        :param directory: Path: session folder on the server
+        :return: bool if all files are there and verified
+        """
+        return self.replicated == (Path(folder), Path(directory))
 
     def copy_recorded_file(self):
         """
@@ -346,69 +851,388 @@ class SpikeGLX_Controller:
         """
         if self.is_recording is False and not self.files_copied and self.recording_file is not None:
             # copy the recorded files to the session folder
-            if not self.can_copy:
+            if not self.can_copy and self.agent is None:
                 self.log.error("Cant copy files if not on same machine")
                 self.socket_comm.send_json_message(SocketMessage.respond_copy_fail)
                 return
-            self.log.info(f"Copying folder {self.recording_file} to {self.session_path}")
-            try:
-                if 'MusterMaus' in self.session_id:
-                    shutil.copytree(self.recording_file, self.session_path)
-                else:
-                    if self.session_path.exists():
-                        self.session_path.mkdir(exist_ok=True)  # make sure we have the ephys folder ready
-                        # copy only the folder content not the folder itself
-                        [shutil.copy2(file, self.session_path) for file in self.recording_file.rglob('*')]
-                        # shutil.copytree(self.recording_file, self.session_path / self.recording_file.name)
-                    else:
-                        raise FileNotFoundError(f"Session path {self.session_path} doesnt exist")
-
-            except (FileNotFoundError, IOError) as e:
-                self.socket_comm.send_json_message(SocketMessage.respond_copy_fail)
-                self.log.error(f"Error copying file {e}")
+            if self.replication_pending:  # would copy the files the catch-up still writes
+                self.after_replication(self.copy_recorded_file)
                 return
+            folders = self.recording_folders()
+            if len(folders) == 1 and self.is_replicated(self.recording_file, self.session_path):
+                self.log.info(f"Files were already replicated to {self.session_path} while recording")
+                self.files_copied = True
+                self.socket_comm.send_json_message(SocketMessage.respond_copy)
+                return
+            for folder in folders:
+                self.log.info(f"Copying folder {folder} to {self.session_path}")
+                t_start = time.monotonic()
+                try:
+                    self.transfer_folder(folder, self.session_path, self.session_id)
+                except (FileNotFoundError, IOError) as e:
+                    self.socket_comm.send_json_message(SocketMessage.respond_copy_fail)
+                    self.log.error(f"Error copying file {e}")
+                    return
+                self._measure_copy_rate(folder, t_start)
+                self.index_copy(folder, self.session_path)
             self.files_copied = True
             self.log.info(f"Finished copying files to {self.session_path}")
             self.socket_comm.send_json_message(SocketMessage.respond_copy)
 
+    def transfer_folder(self, src: Path, dst: Path, session_id: str, dry_run: bool = False) -> [list, None]:
+        """
+        copies a recorded folder to the session folder on the data server. Test sessions (MusterMaus) keep their
+        folder structure and may create dst, other sessions are copied flat into the existing session folder.
+        With COPY_SYNC only files and blocks missing or changed at dst are transferred. With TRANSFER_HOST the files are
+        uploaded to the transfer receiver on the data server instead, see upload_folder. If spikeGLX runs on another
+        computer the acquisition agent copies the files.
+        :param src: Path: recorded folder
+        :param dst: Path: session folder on the data server
+        :param session_id: str: id of the session
+        :param dry_run: bool: only report what would be transferred, needs COPY_SYNC
+        :return: list of the sync reports with COPY_SYNC, else None
+        """
+        flat = 'MusterMaus' not in session_id
+        if TRANSFER_HOST and not dry_run:
+            return self.upload_folder(src, dst, flat)
+        if self.agent is not None:  # dst is checked by the agent
+            return self.agent.run('copy', src=str(src), dst=str(dst), flat=flat, sync=COPY_SYNC,
+                                  chunk_size=IO_CHUNK_SIZE * 2**20, n_workers=COPY_WORKERS,
+                                  part_size=COPY_PART_SIZE * 2**20, dry_run=dry_run)['reports']
+        if flat and not dst.exists():
+            raise FileNotFoundError(f"Session path {dst} doesnt exist")
+        # copy only the folder content not the folder itself, test sessions keep their subfolders
+        return copy_folder(src, dst, flat=flat, sync=COPY_SYNC, throttle=self.io_throttle,
+                           chunk_size=IO_CHUNK_SIZE * 2**20, n_workers=COPY_WORKERS, part_size=COPY_PART_SIZE * 2**20,
+                           dry_run=dry_run)
+
+    def upload_folder(self, src: Path, dst: Path, flat: bool) -> None:
+        """
+        uploads a recorded folder to the transfer receiver on the data server, dst has to lie below TRANSFER_ROOT
+        whose counterpart is the root folder of the receiver
+        :param src: Path: recorded folder
+        :param dst: Path: session folder on the data server as seen from here
+        :param flat: bool: copy all files directly into dst, else keep the subfolders and create dst if needed
+        """
+        try:
+            session = Path(dst).relative_to(TRANSFER_ROOT).as_posix()
+        except ValueError:
+            raise IOError(f"Session path {dst} is not below TRANSFER_ROOT {TRANSFER_ROOT}")
+        if self.agent is not None:
+            self.agent.run('upload', src=str(src), host=TRANSFER_HOST, port=TRANSFER_PORT, session=session, flat=flat,
+                           n_workers=COPY_WORKERS)
+            return
+        sender = TransferSender(TRANSFER_HOST, TRANSFER_PORT, n_connections=COPY_WORKERS, throttle=self.io_throttle)
+        report = sender.send_folder(src, session, flat=flat, mkdir=not flat)
+        if report['failed']:
+            raise IOError(f"Upload of {report['failed']} failed")
+
+    def dry_run_copy_list(self) -> dict:
+        """
+        reports per session of the copy list what a sync would transfer, without copying
+        :return: dict: sync reports per session id
+        """
+        reports = {}
+        for sess in list(self.files_list2copy):
+            try:
+                reports[sess['session']] = self.transfer_folder(sess['files'], sess['directory'], sess['session'],
+                                                                dry_run=True)
+            except (FileNotFoundError, IOError) as e:
+                self.log.error(f"Dry run failed for {sess['session']}: {e}")
+        return reports
+
     def add_to_copy_list(self):
         """
         adds recorded files to the list to be copied later as copy might be long
         """
         if self.is_recording is False and self.recording_file is not None:
             # copy the recorded files to the session folder
-            if not self.can_copy:
+            if not self.can_copy and self.agent is None:
                 self.log.error("Cant copy files if not on same machine")
                 self.socket_comm.send_json_message(SocketMessage.respond_copy_fail)
                 return
-            self.log.info(f"adding folder {self.recording_file} to list")
-            self.files_list2copy.append({'session': self.session_id, 'files': self.recording_file,
-                                         'directory': self.session_path})
-            if self.main:
-                self.main.update_copy_view()
+            if self.replication_pending:  # would copy the files the catch-up still writes
+                self.after_replication(self.add_to_copy_list)
+                return
+            folders = self.recording_folders()
+            if len(folders) == 1 and self.is_replicated(self.recording_file, self.session_path):
+                self.log.info(f"Files were already replicated to {self.session_path} while recording")
+                self.files_copied = True
+                self.socket_comm.send_json_message(SocketMessage.respond_copy)
+                return
+            for folder in folders:  # one entry per data drive the session was split over
+                self.log.info(f"adding folder {folder} to list")
+                self.files_list2copy.append({'session': self.session_id, 'files': folder,
+                                             'directory': self.session_path})
+            self.copy_list_changed.set()
+            Thread(target=self.estimate_copy_list, daemon=True).start()
+
+    def estimate_copy_list(self):
+        """
+        estimates compression time, size after compression and copy time with and without compression for all sessions
+        in the copy list without estimate. The estimate is stored in the session entry under 'estimate'.
+        """
+        for sess in list(self.files_list2copy):
+            if 'estimate' in sess:
+                continue
+            compressed = sess.get('compressed') == 'Yes'
+            try:
+                if self.agent is not None:
+                    estimate = self.agent.run('estimate', folder=str(sess['files']),
+                                              compression={} if compressed else COMPRESSION)
+                elif compressed:
+                    size = sum(f.stat().st_size for f in Path(sess['files']).rglob('*') if f.is_file())
+                    estimate = {'raw_bytes': size, 'compressed_bytes': size, 'compress_s': 0., 'files': {}}
+                else:
+                    estimate = estimate_compression(sess['files'], COMPRESSION)
+                if compressed:
+                    estimate['compressed_bytes'] = estimate['raw_bytes']
+            except (OSError, ValueError, KeyError) as e:
+                self.log.error(f"Could not estimate compression of {sess['files']}: {e}")
+                continue
+            estimate['copy_raw_s'] = estimate['raw_bytes'] / self.copy_rate
+            estimate['copy_compressed_s'] = estimate['compressed_bytes'] / self.copy_rate
+            sess['estimate'] = estimate
+            self.copy_list_changed.set()
+
+    def get_copy_list_estimate(self) -> dict:
+        """
+        sums the estimates of all sessions in the copy list, e.g. to decide whether to compress or to copy raw data
+        :return: dict with raw_bytes, compressed_bytes, compress_s, copy_raw_s, copy_compressed_s and n_sessions
+            estimated so far
+        """
+        keys = ('raw_bytes', 'compressed_bytes', 'compress_s', 'copy_raw_s', 'copy_compressed_s')
+        total = dict.fromkeys(keys, 0.)
+        total['n_sessions'] = 0
+        for sess in list(self.files_list2copy):
+            if 'estimate' in sess:
+                for key in keys:
+                    total[key] += sess['estimate'][key]
+                total['n_sessions'] += 1
+        return total
+
+    def _measure_copy_rate(self, folder: Path, t_start: float):
+        """updates copy_rate from a finished copy of folder that started at t_start (time.monotonic)"""
+        n_bytes = sum(f.stat().st_size for f in Path(folder).rglob('*') if f.is_file())
+        elapsed = time.monotonic() - t_start
+        if n_bytes > 2**27 and elapsed > 0:  # small copies are dominated by latencies
+            self.copy_rate = n_bytes / elapsed
+
+    def _log_agent_progress(self, job: str, fraction: float, detail: str):
+        """logs the progress of a file job running on the acquisition agent"""
+        self.log.info(f"Agent {job}: {fraction:.0%} {detail}")
+
+    @property
+    def data_dirs(self) -> list:
+        """list of the data folders sessions are recorded to, the save path first"""
+        return [self._save_path] + [Path(d) for d in DATA_DIRS if Path(d) != self._save_path]
+
+    def recording_started(self) -> bool:
+        """bool if a recording runs, also one started in spikeGLX itself, checked before each drive is measured"""
+        return self.is_recording or (self.is_connected and self.ask_is_recording())
+
+    def refresh_drive_throughput(self):
+        """measures the write throughput of the data drives in the background, only while not recording"""
+        if self.drive_balancer is not None and not self.is_recording:
+            Thread(target=self.drive_balancer.refresh, daemon=True).start()
+
+    def select_data_dirs(self, hSglx) -> Path:
+        """
+        picks the data folder of the next session and tells spikeGLX its data directories. With MULTI_DRIVE multi-drive
+        is enabled in spikeGLX, it splits the probes over the data folders in the order set here, these further folders
+        are kept in stripe_dirs.
+        :param hSglx: handle to the spikeglx api connection
+        :return: Path: data folder the session folder is created in
+        """
+        self.stripe_dirs = []
+        if self.drive_balancer is None:
+            return self._save_path
+        forecast = self.disk_forecaster.forecast
+        write_rate = forecast['write_MBps'] * 2**20 if forecast is not None else 0.
+        n_dirs = len(self.drive_balancer.dirs) if MULTI_DRIVE else 1
+        dirs = self.drive_balancer.rank(write_rate / n_dirs)
+        if not dirs:
+            self.log.error("No data folder reachable, recording to the save path")
+            return self._save_path
+        multi_drive = MULTI_DRIVE
+        if not sglx.c_sglx_setMultiDriveEnable(hSglx, MULTI_DRIVE):
+            self.log.error(f"Cant {'en' if MULTI_DRIVE else 'dis'}able multi-drive: "
+                           f"{sglx.c_sglx_getError(hSglx).decode()}")
+            multi_drive = False  # the session goes to one folder, the best one
+        if multi_drive:
+            for idir, data_dir in enumerate(dirs):
+                if not sglx.c_sglx_setDataDir(hSglx, idir, str(data_dir).encode()):
+                    self.log.error(f"Cant set data folder {idir} to {data_dir}: "
+                                   f"{sglx.c_sglx_getError(hSglx).decode()}")
+                    return self._save_path if idir == 0 else dirs[0]
+                if idir > 0:
+                    self.stripe_dirs.append(data_dir)
+        elif not sglx.c_sglx_setDataDir(hSglx, 0, str(dirs[0]).encode()):
+            self.log.error(f"Cant set the data folder to {dirs[0]}: {sglx.c_sglx_getError(hSglx).decode()}")
+        self.log.info(f"Next session goes to {dirs[0]}" + (f", split over {self.stripe_dirs}" if self.stripe_dirs
+                                                            else ""))
+        return dirs[0]
+
+    def recording_folders(self) -> list:
+        """
+        :return: list of the folders of the current recording, recording_file first, then the folders spikeGLX wrote
+            the probes to on the further data drives
+        """
+        if self.recording_file is None:
+            return []
+        folders = [self.recording_file]
+        for data_dir in self.recording_stripe_dirs:
+            folders += sorted(f for f in Path(data_dir).glob(f"{self.recording_file.name}*") if f.is_dir())
+        return folders
+
+    def open_session_index(self):
+        """opens the session index of every data folder if enabled and the files are on this machine"""
+        for root in [root for root in self.session_indexes if root not in self.data_dirs]:
+            if root in self.retentions:
+                self.retentions.pop(root).stop()
+            self.session_indexes.pop(root).close()
+        if not SESSION_INDEX or not self.can_copy:
+            return
+        for root in self.data_dirs:
+            if root in self.session_indexes:
+                continue
+            try:
+                index = SessionIndex(root)
+            except sqlite3.Error as e:
+                self.log.error(f"Cant open the session index in {root}: {e}")
+                continue
+            self.session_indexes[root] = index
+            if RETENTION_FREE_GB:  # scans the index itself
+                self.retentions[root] = RetentionPolicy(index, RETENTION_FREE_GB, min_age=RETENTION_MIN_AGE * 86400,
+                                                        throttle=self.io_throttle, protected=self.protected_folders,
+                                                        interval=RETENTION_INTERVAL)
+                self.retentions[root].start()
+            else:
+                Thread(target=self._scan_session_index, args=(index,), daemon=True).start()
+
+    def protected_folders(self) -> list:
+        """
+        :return: list of the folders the retention must not delete: the current, the armed and the listed recordings
+        """
+        return ([self.recording_file, self.armed_file] + self.recording_folders()[1:] +
+                [sess['files'] for sess in list(self.files_list2copy)])
+
+    def get_session_index(self, folder: Path) -> [SessionIndex, None]:
+        """
+        :param folder: Path: recorded folder or a folder or file in it
+        :return: SessionIndex of the data folder the folder is in, None if not indexed
+        """
+        for root, index in self.session_indexes.items():
+            if root in Path(folder).parents:
+                return index
+        return None
+
+    def refresh_session_index(self):
+        """updates the session indexes with the changes in the data folders in a background thread"""
+        for index in list(self.session_indexes.values()):
+            Thread(target=self._scan_session_index, args=(index,), daemon=True).start()
+
+    def _scan_session_index(self, index: SessionIndex):
+        try:
+            index.scan()
+        except (OSError, sqlite3.Error) as e:
+            self.log.error(f"Could not update the session index of {index.root}: {e}")
+
+    def index_copy(self, folder: Path, destination: Path, verified: bool = False):
+        """
+        records a finished copy in the session index, the session is indexed first so it is in it
+        :param folder: Path: recorded folder or its compressed subfolder
+        :param destination: Path: session folder on the data server
+        :param verified: bool: the copy was verified against the SHA1 of the meta files
+        """
+        index = self.get_session_index(folder)
+        if index is None:
+            return
+        try:
+            index.scan_session(folder)
+            index.mark_copied(folder, destination)
+            if verified:
+                index.mark_verified(folder)
+        except (OSError, ValueError, sqlite3.Error) as e:
+            self.log.error(f"Could not update the session index: {e}")
+
+    def respond_list_sessions(self, message: dict):
+        """
+        sends the sessions of the session indexes matching the filters of a list_sessions message, oldest first
+        :param message: dict: message with the optional filters pattern, compressed, copied, verified and older_than
+        """
+        if not self.session_indexes:
+            self.log.error("No session index, set SESSION_INDEX and run the controller on the acquisition computer")
+            self.socket_comm.send_json_message(SocketMessage.respond_sessions_fail)
+            return
+        filters = {key: message.get(key) for key in ('pattern', 'compressed', 'copied', 'verified', 'older_than')}
+        sessions = []
+        try:
+            for root, index in list(self.session_indexes.items()):
+                sessions += [{**session, 'root': str(root)} for session in index.list_sessions(**filters)]
+        except sqlite3.Error as e:
+            self.log.error(f"Error listing sessions: {e}")
+            self.socket_comm.send_json_message(SocketMessage.respond_sessions_fail)
+            return
+        sessions.sort(key=lambda session: session['mtime'] or 0)
+        self.socket_comm.send_json_message({**SocketMessage.respond_sessions, 'sessions': sessions})
 
     def clear_copy_list(self):
         """
         clears the list of files to be copied
         """
         self.files_list2copy = []
+        self.copy_list_changed.set()
+
+    def file_job_budget(self) -> (float, float):
+        """
+        I/O budget of background file jobs, limited (or paused) while spikeGLX is saving data, unlimited otherwise
+        :return: (bytes_per_s, ops_per_s), None for no limit, 0 for pause
+        """
+        saving = self.is_recording or (self.is_connected and self.ask_is_recording())
+        if not saving:
+            return None, None
+        if IO_PAUSE_WHILE_RECORDING:
+            return 0, 0
+        bandwidth = None if IO_BUDGET_RECORDING_MBPS is None else IO_BUDGET_RECORDING_MBPS * 2**20
+        return bandwidth, IO_BUDGET_RECORDING_IOPS
+
+    def start_file_job(self, job) -> bool:
+        """
+        runs a file job (compress_file_list, copy_file_list) in a background thread, only one job at a time
+        :param job: callable
+        :return: bool if the job was started
+        """
+        if self.file_job_thread is not None and self.file_job_thread.is_alive():
+            self.log.warning("Another file job is still running")
+            return False
+        self.file_job_thread = Thread(target=job, daemon=True)
+        self.file_job_thread.start()
+        return True
 
     def compress_file_list(self):
         """
         compresses the files in the copy list
         """
-        for sess in self.files_list2copy:
+        for sess in list(self.files_list2copy):
             self.log.info(f"Compressing folder {sess['files']}")
             try:
-                new_path = self.compress_recorded_file(sess['files'])
+                if self.agent is not None:
+                    new_path = Path(self.agent.run('compress', folder=str(sess['files']),
+                                                   compression=COMPRESSION)['path'])
+                else:
+                    new_path = self.compress_recorded_file(sess['files'], throttle=self.io_throttle)
                 if new_path:
                     self.log.info(f"Finished compressing files to {new_path}")
                     sess['files'] = new_path
                     sess["compressed"] = "Yes"
+                    sess.pop('estimate', None)
+                    self.copy_list_changed.set()
                 else:
                     raise IOError
             except (FileNotFoundError, IOError) as e:
                 self.log.error(f"Error compressing file {e}")
+        self.estimate_copy_list()
         if COPY_AFTER_COMPRESS:
             self.copy_file_list()
 
@@ -417,25 +1241,147 @@ class SpikeGLX_Controller:
         copies the files in the list to the session folder on the data server
         """
         copied = False
-        for sess in self.files_list2copy:
+        sessions = list(self.files_list2copy)  # sessions may be added while copying
+        for sess in sessions:
             self.log.info(f"Copying folder {sess['files']} to {sess['directory']}")
+            t_start = time.monotonic()
             try:
-                if 'MusterMaus' in sess['session']:
-                    shutil.copytree(sess['files'], sess['directory'])
-                else:
-                    if sess['directory'].exists():
-                        sess['directory'].mkdir(exist_ok=True)  # make sure we have the ephys folder ready
-                        # copy only the folder content not the folder itself
-                        [shutil.copy2(file, sess['directory']) for file in sess['files'].rglob('*')]
-                        copied = True
-                    else:
-                        raise FileNotFoundError(f"Session path {sess['directory']} doesnt exist")
+                self.transfer_folder(sess['files'], sess['directory'], sess['session'])
+                copied = True
+                self._measure_copy_rate(sess['files'], t_start)
+                self.index_copy(sess['files'], sess['directory'])
             except (FileNotFoundError, IOError) as e:
                 self.socket_comm.send_json_message(SocketMessage.respond_copy_fail)
                 self.log.error(f"Error copying file {e}")
 
-            # if copied: # if succesfully copied
-            self.clear_copy_list()
+        # if copied: # if succesfully copied
+        self.files_list2copy = [sess for sess in self.files_list2copy if sess not in sessions]
+        self.copy_list_changed.set()
+
+    def respond_map_samples(self, message: dict):
+        """
+        maps the samples of a map_samples message and sends them back to the remote controller
+        :param message: dict: message with 'samples', 'src' and 'dst' stream names
+        """
+        src = message.get('src', 'nidq')
+        dst = message.get('dst')
+        try:
+            mapped = self.sample_mapper.map_samples(message.get('samples', []), src, dst)
+        except (TypeError, ValueError) as e:
+            self.log.error(f"Error mapping samples from {src} to {dst}: {e}")
+            mapped = None
+        if mapped is None:
+            self.socket_comm.send_json_message(SocketMessage.respond_map_fail)
+        else:
+            self.socket_comm.send_json_message({**SocketMessage.respond_map, 'src': src, 'dst': dst,
+                                                'samples': mapped.tolist()})
+
+    def get_status_message(self) -> dict:
+        """:return: dict: status message of SocketMessage for the current state"""
+        if self.is_recording:
+            return SocketMessage.status_recording
+        if self.is_viewing:
+            return SocketMessage.status_viewing
+        if self.is_remote_ctr:
+            return SocketMessage.status_ready
+        return SocketMessage.status_error
+
+    def respond_batch(self, message: dict):
+        """
+        Runs the steps of a batch message in one pass and sends one combined reply with the result and duration of
+        every step. If a step fails the completed ones are undone in reverse order. Steps are dicts with the command
+        under 'cmd':
+        session_id (with session_id and optionally session_path), params (with params, a dict of [DAQSettings] set
+        before the run), start_viewing, prepare_rec, start_rec and status_poll
+        :param message: dict: batch message with the list of steps under 'steps'
+        """
+        t_start = time.perf_counter()
+        handlers = {'session_id': self._batch_session_id, 'params': self._batch_params,
+                    MessageType.start_video_view.value: self._batch_start_run,
+                    MessageType.prepare_rec.value: self._batch_prepare, MessageType.start_video_rec.value:
+                    self._batch_start_recording, MessageType.poll_status.value: self._batch_status}
+        report = run_batch(message.get('steps', []), handlers)
+        report['total_ms'] = round((time.perf_counter() - t_start) * 1000, 3)
+        self.log.info(f"Ran batch of {len(report['steps'])} steps in {report['total_ms']:.1f}ms"
+                      + ("" if report['ok'] else f", rolled back {report['rolled_back']}"))
+        self.socket_comm.send_json_message({**(SocketMessage.respond_batch if report['ok'] else
+                                               SocketMessage.respond_batch_fail), **report})
+
+    def _batch_session_id(self, step: dict) -> (bool, callable, dict):
+        previous = self.session_id, self.replication_path
+
+        def undo() -> bool:
+            self.session_id, self.replication_path = previous
+            return True
+
+        self.session_id = step['session_id']
+        self.set_replication_path(step)
+        if self.main:
+            self.main.SessionIDlineEdit.setText(self.session_id)
+        return True, undo, {}
+
+    def _batch_params(self, step: dict) -> (bool, callable, dict):
+        if self.is_viewing:
+            return False, None, {'error': "Run in progress, parameters can only be set before the run"}
+        with self.sglx_pool.checkout(control=True) as hSglx:
+            if hSglx is None:
+                return False, None, {'error': "SpikeGLX not connected"}
+            previous = get_params(hSglx)
+            if previous is None or not set_params(hSglx, step['params']):
+                return False, None, {'error': sglx.c_sglx_getError(hSglx).decode()}
+        previous = {key: previous[key] for key in step['params'] if key in previous}
+
+        def undo() -> bool:
+            with self.sglx_pool.checkout(control=True) as hSglx:
+                return hSglx is not None and set_params(hSglx, previous)
+
+        return True, undo, {}
+
+    def _batch_start_run(self, step: dict) -> (bool, callable, dict):
+        if not self._start_run():
+            return False, None, {'error': "Run did not start"}
+
+        def undo() -> bool:
+            self.stop_live_publisher()
+            with self.sglx_pool.checkout(control=True) as hSglx:
+                if hSglx is None or not self.stop_rig_run(hSglx):
+                    return False
+            self.armed_session = None
+            self.streams = None
+            self.is_viewing = False
+            return True
+
+        return True, undo, {'rigs': self.rigs.last_report} if self.rigs is not None else {}
+
+    def _batch_prepare(self, step: dict) -> (bool, callable, dict):
+        if self.is_recording or not self.prepare_recording():
+            return False, None, {'error': "Recording not prepared"}
+
+        def undo() -> bool:
+            self.armed_session = None
+            return True
+
+        return True, undo, self.get_latency_report()
+
+    def _batch_start_recording(self, step: dict) -> (bool, callable, dict):
+        if self.is_recording:
+            return False, None, {'error': "Already recording"}
+        stamp = self._start_recording()
+        if stamp is None:
+            return False, None, {'error': "Recording did not start"}
+
+        def undo() -> bool:  # the files of the short recording stay
+            with self.sglx_pool.checkout(control=True) as hSglx:
+                if hSglx is None or not self.set_recording_enable(hSglx, False):
+                    return False
+            self.is_recording = False
+            self.finish_live_file_jobs()
+            return True
+
+        return True, undo, {**self.get_latency_report(), 'sync': stamp}
+
+    def _batch_status(self, step: dict) -> (bool, callable, dict):
+        return True, None, {'status': self.get_status_message()['status']}
 
     def send_socket_error(self):
         """sends an error message to the remote main task controller"""
@@ -456,15 +1402,72 @@ class SpikeGLX_Controller:
 
     def check_disk_space(self):
         """
-        Check if we have enough free disk space on the indicated drive for >1h recording
+        Check if we have enough free disk space for WARN_RECORDING_MINUTES of recording with the current streams,
+        falls back to WARN_DISK_SPACE GB on the save path as long as there is no forecast
         :return:
         """
         _, _, free = shutil.disk_usage(self._save_path)
+        if self.drive_balancer is not None:  # the next session goes to the best drive
+            free = max([drive['free_gb'] * 2**30 for drive in self.drive_balancer.status()] + [free])
         free = free // 2**30
-        if free < WARN_DISK_SPACE:
+        for retention in self.retentions.values():
+            if shutil.disk_usage(retention.root).free < RETENTION_FREE_GB * 2**30:
+                retention.trigger()
+        forecast = self.disk_forecaster.forecast
+        if forecast is not None and forecast['minutes_left'] is not None:
+            low = forecast['minutes_left'] < WARN_RECORDING_MINUTES
+        else:
+            low = free < WARN_DISK_SPACE
+        if low:
             self.log.warning(f'Not enough disc space on {self._save_path}')
-            if self.is_remote_ctr:
-                self.socket_comm.send_json_message(SocketMessage.respond_recording_fail)
+            if self.is_remote_ctr:  # a warning, the command that checked still gets its reply
+                self.socket_comm.send_json_message(SocketMessage.respond_recording_fail, echo_id=False)
+
+    def warn_disk_forecast(self, forecast: dict):
+        """
+        tells the remote controller that the disk space lasts for less than WARN_RECORDING_MINUTES
+        :param forecast: dict: forecast of the DiskForecaster
+        """
+        for retention in self.retentions.values():
+            retention.trigger()
+        if self.is_remote_ctr and self.socket_comm.connected:
+            self.socket_comm.send_json_message({**SocketMessage.status_disk_low, **forecast})
+
+    def respond_disk_forecast(self):
+        """sends a fresh forecast of the remaining recording time to the remote controller"""
+        forecast = self.disk_forecaster.update()
+        if forecast is None:
+            self.socket_comm.send_json_message(SocketMessage.respond_forecast_fail)
+        else:
+            self.socket_comm.send_json_message({**SocketMessage.respond_forecast, **forecast})
+
+    def _remote_lost(self):
+        """called by the socket_comm when the connection to the remote controller is lost"""
+        self.log.warning(f"Connection to the remote controller lost"
+                         f"{', recording continues' if self.is_recording else ''}")
+
+    def wait_for_remote(self):
+        """
+        accepts the next connection of a remote controller in the background and enters the remote mode once it is
+        connected, with a GUI via its signals so the widgets only change on the GUI thread
+        """
+        self.socket_comm.threaded_accept_connection()
+        if self.main:
+            self.main.remote_reaccepting.emit()
+
+        def enter_when_connected():
+            while not self.socket_comm.connected:
+                if self.socket_comm.stop_event.is_set():  # waiting was aborted
+                    if self.main:
+                        self.main.remote_reaccepted.emit(False)
+                    return
+                time.sleep(0.1)
+            if self.main:
+                self.main.remote_reaccepted.emit(True)
+            else:
+                self.enter_remote_mode()
+
+        Thread(target=enter_when_connected).start()  # keeps the process alive until the remote thread runs
 
     def exit_remote_mode(self):
         """
@@ -476,6 +1479,16 @@ class SpikeGLX_Controller:
         self.socket_comm.close_socket()
         self.is_remote_ctr = False
 
+    def set_replication_path(self, message: dict):
+        """
+        takes the session folder on the server from a start/prepare message, the recording is replicated there while
+        recording if LIVE_REPLICATE is set. Messages without the key keep the folder of a preceding prepare message,
+        the folder is used for one recording only.
+        :param message: dict: received message
+        """
+        if 'session_path' in message:
+            self.replication_path = Path(message['session_path']) if message['session_path'] else None
+
     def check_and_parse_messages(self):
         """
         timed function that runs in a thread and checks for messages from the remote controller
@@ -494,20 +1507,26 @@ class SpikeGLX_Controller:
                         self.main.exit_remote_mode()
                     else:
                         self.exit_remote_mode()
+                    if REMOTE_REACCEPT:
+                        self.wait_for_remote()
                     return
                 message = self.socket_comm.read_json_message_fast_linebreak()
 
                 if message:
                     self.last_t_socket = time.monotonic()  # reset timer
+                    self.socket_comm.reply_to(message)  # replies echo its request_id
+                    if message['type'] not in self.unstamped_messages:
+                        self.log_command(message['type'], message.get('session_id'))
                     if message['type'] == MessageType.start_video_rec.value \
                             or message['type'] == MessageType.start_video_view.value:
                         if self.is_recording and message['type'] == MessageType.start_video_rec.value:
                             # got record but we already are !
                             self.socket_comm.send_json_message(SocketMessage.status_error)
                             self.log.info("got message to start, but something is already running!")
-                            return
+                            continue
 
                         self.session_id = message.get("session_id", 'MusterMaus')
+                        self.set_replication_path(message)
                         if self.main:
                             self.main.SessionIDlineEdit.setText(self.session_id)
 
@@ -524,6 +1543,29 @@ class SpikeGLX_Controller:
                                 self.main.start_run()
                             else:
                                 self.start_run()
+                            if AUTO_ARM_RECORDING and self.is_viewing:
+                                self.prepare_recording()
+
+                    elif message['type'] == MessageType.prepare_rec.value:
+                        self.log.info("got message to prepare recording")
+                        if self.is_recording:
+                            self.socket_comm.send_json_message(SocketMessage.respond_prepare_fail)
+                            self.log.info("got message to prepare, but already recording!")
+                            continue
+                        session_id = message.get("session_id") or self.session_id
+                        if not session_id:
+                            self.log.error("got message to prepare, but no session id")
+                            self.socket_comm.send_json_message(SocketMessage.respond_prepare_fail)
+                            continue
+                        self.session_id = session_id
+                        self.set_replication_path(message)
+                        if self.main:
+                            self.main.SessionIDlineEdit.setText(self.session_id)
+                        if self.prepare_recording():
+                            self.socket_comm.send_json_message({**SocketMessage.respond_prepare,
+                                                                **self.get_latency_report()})
+                        else:
+                            self.socket_comm.send_json_message(SocketMessage.respond_prepare_fail)
 
                     elif message['type'] == MessageType.stop_video.value:
                         self.log.info("got message to stop")
@@ -534,14 +1576,31 @@ class SpikeGLX_Controller:
                             self.stop_recording()
 
                     elif message['type'] == MessageType.poll_status.value:
-                        if self.is_recording:
-                            self.socket_comm.send_json_message(SocketMessage.status_recording)
-                        elif self.is_viewing:
-                            self.socket_comm.send_json_message(SocketMessage.status_viewing)
-                        elif self.is_remote_ctr:
-                            self.socket_comm.send_json_message(SocketMessage.status_ready)
+                        self.socket_comm.send_json_message(self.get_status_message())
+
+                    elif message['type'] == MessageType.batch.value:
+                        self.respond_batch(message)
+
+                    elif message['type'] == MessageType.trial_plan.value:
+                        self.log.info("got message to plan trials")
+                        session_id = message.get("session_id", 'MusterMaus')
+                        self.set_replication_path(message)
+                        if self.plan_trials(session_id, message.get('n_trials'), message.get('g_index', 0)):
+                            self.socket_comm.send_json_message({**SocketMessage.respond_trial_plan,
+                                                                'n_trials': message.get('n_trials')})
                         else:
-                            self.socket_comm.send_json_message(SocketMessage.status_error)
+                            self.socket_comm.send_json_message(SocketMessage.respond_trial_fail)
+                        if self.main:
+                            self.main.SessionIDlineEdit.setText(self.session_id)
+
+                    elif message['type'] == MessageType.trial_start.value:
+                        self.start_trial()
+
+                    elif message['type'] == MessageType.trial_end.value:
+                        self.end_trial()
+
+                    elif message['type'] == MessageType.map_samples.value:
+                        self.respond_map_samples(message)
 
                     elif message['type'] == MessageType.disconnected.value:
                         self.log.info("got message that client disconnected")
@@ -549,6 +1608,8 @@ class SpikeGLX_Controller:
                             self.main.exit_remote_mode()
                         else:
                             self.exit_remote_mode()
+                        if REMOTE_REACCEPT:
+                            self.wait_for_remote()
 
                     elif message['type'] == MessageType.copy_files.value:
                         self.log.debug('got message to copy files')
@@ -559,6 +1620,12 @@ class SpikeGLX_Controller:
                             else:
                                 self.add_to_copy_list()
 
+                    elif message['type'] == MessageType.disk_forecast.value:
+                        self.respond_disk_forecast()
+
+                    elif message['type'] == MessageType.list_sessions.value:
+                        self.respond_list_sessions(message)
+
                     elif message['type'] == MessageType.purge_files.value:
                         self.log.debug('got message to purge files')
                         self.purge_recorded_file()
@@ -567,8 +1634,4 @@ class SpikeGLX_Controller:
 if __name__ == '__main__':
     logging.info('Starting via __main__')
     controller = SpikeGLX_Controller()
-    controller.socket_comm.threaded_accept_connection()
-    while not controller.socket_comm.connected:
-        time.sleep(0.5)
-        # controller.log.info("waiting for remote connection")
-    controller.enter_remote_mode()
+    controller.wait_for_remote()
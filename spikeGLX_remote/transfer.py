@@ -0,0 +1,361 @@
+"""
+Transfer of session folders to the data server over TCP, for computers where the data server is not mounted or a
+share is too slow. The TransferReceiver runs on the data server, the TransferSender on the acquisition computer.
+Control messages are json lines as in socket_utils, the file data follows a chunk message raw and is sent with
+socket.sendfile. Every chunk carries its SHA1 and is acknowledged. The receiver keeps the verified chunks of a partial
+file next to it, so an interrupted upload resumes with the missing chunks. Chunks are spread over several connections.
+
+Run the receiver on the data server with: python -m spikeGLX_remote.transfer receive <root folder>
+"""
+import argparse
+import hashlib
+import logging
+import os
+import select
+import socket
+import threading
+import time
+from pathlib import Path, PurePosixPath
+from queue import Queue, Empty
+
+from spikeGLX_remote.file_utils import MTIME_TOLERANCE
+from spikeGLX_remote.socket_utils import SocketComm, SocketMessage, MessageType, MessageStatus
+
+log = logging.getLogger('transfer')
+
+TRANSFER_PORT = 8890
+TRANSFER_CHUNK_SIZE = 8 * 2**20  # bytes per checksummed chunk
+
+
+def _socket_comm(sock: socket.socket, soctype: str) -> SocketComm:
+    """wraps a connected socket into a SocketComm to exchange json messages"""
+    comm = SocketComm(soctype)
+    comm.sock = sock
+    comm.connected = True
+    return comm
+
+
+def _recv_exact(sock: socket.socket, n_bytes: int, stop_event: threading.Event) -> bytes:
+    """receives exactly n_bytes, retries on timeouts until stop_event is set"""
+    buffer = bytearray(n_bytes)
+    view = memoryview(buffer)
+    received = 0
+    while received < n_bytes:
+        try:
+            n = sock.recv_into(view[received:])
+        except socket.timeout:
+            if stop_event.is_set():
+                raise ConnectionError("Receiver stopped")
+            continue
+        if n == 0:
+            raise ConnectionError("Connection closed during a chunk")
+        received += n
+    return bytes(buffer)
+
+
+def _n_chunks(size: int, chunk_size: int) -> int:
+    return -(-size // chunk_size)
+
+
+class TransferReceiver:
+    """
+    Accepts session uploads on the data server. Each connection is served by its own thread, files are written to
+    <file>.part and renamed once all chunks are verified. Paths are relative to root and cannot leave it.
+
+    :param root: Path: folder the session paths of the uploads are relative to
+    :param host: str: address to listen on
+    :param port: int: port to listen on
+    """
+
+    def __init__(self, root: Path, host: str = '0.0.0.0', port: int = TRANSFER_PORT):
+        self.root = Path(root).resolve()
+        self.host = host
+        self.port = port
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()  # chunk lists are appended from several connections
+        self._sock = None
+        self._thread = None
+
+    def start(self):
+        """starts listening for connections in a background thread"""
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.host, self.port))
+        self._sock.listen()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._accept_loop, daemon=True)
+        self._thread.start()
+        log.info(f"Receiving uploads to {self.root} on port {self.port}")
+
+    def stop(self):
+        """stops accepting connections, running connections end after their current message"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._sock.close()
+
+    def _accept_loop(self):
+        while not self._stop_event.is_set():
+            ready, _, _ = select.select([self._sock], [], [], 0.5)
+            if ready:
+                conn, addr = self._sock.accept()
+                threading.Thread(target=self._handle, args=(conn, addr), daemon=True).start()
+
+    def _resolve(self, session: str, name: str) -> Path:
+        target = (self.root / session / name).resolve()
+        if self.root not in target.parents:
+            raise ValueError(f"{session}/{name} is outside of the receiver root")
+        return target
+
+    def _handle(self, conn: socket.socket, addr):
+        log.info(f"Connected to {addr}")
+        conn.settimeout(1.)
+        comm = _socket_comm(conn, 'server')
+        while not self._stop_event.is_set() and comm.connected:
+            message = comm.read_json_message_fast_linebreak()
+            if not message:
+                continue
+            if message['type'] == MessageType.disconnected.value:
+                break
+            try:
+                if message['type'] == MessageType.file_offer.value:
+                    reply = self._offer(message)
+                elif message['type'] == MessageType.file_chunk.value:
+                    reply = self._chunk(message, conn)
+                elif message['type'] == MessageType.file_done.value:
+                    reply = self._done(message)
+                else:
+                    reply = {'type': MessageType.response.value, 'status': MessageStatus.error.value}
+            except ConnectionError:
+                break
+            except (OSError, ValueError, KeyError) as e:
+                log.error(f"Error receiving from {addr}: {e}")
+                reply = {'type': MessageType.response.value, 'status': MessageStatus.file_fail.value,
+                         'error': str(e)}
+            comm.send_json_message(reply)
+        conn.close()
+        log.info(f"Disconnected from {addr}")
+
+    @staticmethod
+    def _part_paths(target: Path) -> (Path, Path):
+        return target.with_name(target.name + '.part'), target.with_name(target.name + '.part.chunks')
+
+    def _read_chunk_list(self, chunks_file: Path) -> (dict, set):
+        with self._lock:
+            lines = chunks_file.read_text().split()
+        fields = lines[0].split(',')
+        header = {'size': int(fields[0]), 'chunk_size': int(fields[1]),
+                  'mtime': float(fields[2]) if len(fields) > 2 else None}
+        return header, {int(line) for line in lines[1:]}
+
+    def _offer(self, message: dict) -> dict:
+        target = self._resolve(message['session'], message['file'])
+        if not target.parent.exists():
+            if not message.get('mkdir'):
+                raise FileNotFoundError(f"Session path {target.parent} doesnt exist")
+            target.parent.mkdir(parents=True, exist_ok=True)
+        if target.exists() and target.stat().st_size == message['size'] \
+                and abs(target.stat().st_mtime - message['mtime']) <= MTIME_TOLERANCE:
+            return {'type': MessageType.response.value, 'status': MessageStatus.file_ok.value, 'verified': None}
+        part, chunks_file = self._part_paths(target)
+        verified = set()
+        if part.exists() and chunks_file.exists():
+            header, verified = self._read_chunk_list(chunks_file)
+            if header != {'size': message['size'], 'chunk_size': message['chunk_size'], 'mtime': message['mtime']}:
+                verified = set()  # the file or the chunking changed, start over
+        if not verified:
+            with part.open('wb') as f:
+                f.truncate(message['size'])
+            with self._lock:
+                chunks_file.write_text(f"{message['size']},{message['chunk_size']},{message['mtime']!r}\n")
+        return {'type': MessageType.response.value, 'status': MessageStatus.file_status.value,
+                'verified': sorted(verified)}
+
+    def _chunk(self, message: dict, conn: socket.socket) -> dict:
+        data = _recv_exact(conn, message['length'], self._stop_event)  # read first to stay in sync with the stream
+        reply = {'type': MessageType.response.value, 'index': message['index']}
+        if hashlib.sha1(data).hexdigest() != message['sha1']:
+            log.warning(f"Checksum mismatch in chunk {message['index']} of {message['file']}")
+            return {**reply, 'status': MessageStatus.chunk_fail.value}
+        part, chunks_file = self._part_paths(self._resolve(message['session'], message['file']))
+        with part.open('r+b') as f:
+            f.seek(message['offset'])
+            f.write(data)
+        with self._lock:
+            with chunks_file.open('a') as f:
+                f.write(f"{message['index']}\n")
+        return {**reply, 'status': MessageStatus.chunk_ok.value}
+
+    def _done(self, message: dict) -> dict:
+        target = self._resolve(message['session'], message['file'])
+        part, chunks_file = self._part_paths(target)
+        header, verified = self._read_chunk_list(chunks_file)
+        missing = sorted(set(range(_n_chunks(header['size'], header['chunk_size']))) - verified)
+        if missing:
+            return {'type': MessageType.response.value, 'status': MessageStatus.file_fail.value, 'missing': missing}
+        os.replace(part, target)
+        os.utime(target, (message['mtime'], message['mtime']))
+        chunks_file.unlink()
+        log.info(f"Received {target}")
+        return {'type': MessageType.response.value, 'status': MessageStatus.file_ok.value}
+
+
+class TransferSender:
+    """
+    Uploads folders to a TransferReceiver. File offers and completions go over one control connection, the chunks
+    the receiver is missing are sent over n_connections parallel connections.
+
+    :param host: str: address of the data server
+    :param port: int: port of the receiver
+    :param n_connections: int: number of parallel connections for the chunks
+    :param chunk_size: int: bytes per checksummed chunk
+    :param throttle: file_utils.IOThrottle: budget for reading, None for no limit
+    :param timeout: float: s to wait for a reply of the receiver
+    """
+
+    def __init__(self, host: str, port: int = TRANSFER_PORT, n_connections: int = 4,
+                 chunk_size: int = TRANSFER_CHUNK_SIZE, throttle=None, timeout: float = 30.):
+        self.host = host
+        self.port = port
+        self.n_connections = max(1, n_connections)
+        self.chunk_size = chunk_size
+        self.throttle = throttle
+        self.timeout = timeout
+
+    def _connect(self) -> SocketComm:
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        return _socket_comm(sock, 'client')
+
+    @staticmethod
+    def _close(comm: SocketComm):
+        """tells the receiver that the connection ends and closes it"""
+        try:
+            comm.send_json_message(SocketMessage.client_disconnected)
+        finally:
+            comm.close_socket()
+
+    @staticmethod
+    def _request(comm: SocketComm, message: dict) -> dict:
+        comm.send_json_message(message)
+        reply = comm.read_json_message_fast_linebreak()
+        if not reply or reply == {'type': MessageType.disconnected.value}:
+            raise ConnectionError("No reply from the transfer receiver")
+        return reply
+
+    def send_folder(self, src: Path, session: str, flat: bool = True, mkdir: bool = False) -> dict:
+        """
+        uploads all files of a folder and its subfolders, files the receiver already has are skipped and partial
+        files are resumed
+        :param src: Path: folder to upload
+        :param session: str: session folder relative to the root of the receiver, with / as separator
+        :param flat: bool: put all files directly into the session folder, else keep the subfolders
+        :param mkdir: bool: create the session folder if it does not exist
+        :return: dict with the numbers of files sent, skipped and failed, bytes, seconds and MBps
+        """
+        src = Path(src)
+        t_start = time.monotonic()
+        files = []
+        for file in sorted(f for f in src.rglob('*') if f.is_file()):
+            rel = Path(file.name) if flat else file.relative_to(src)
+            stat = file.stat()
+            files.append({'path': file, 'session': (PurePosixPath(session) / rel.parent.as_posix()).as_posix(),
+                          'file': rel.name, 'size': stat.st_size, 'mtime': stat.st_mtime})
+        control = self._connect()
+        jobs = Queue()
+        pending = []
+        try:
+            for entry in files:
+                offer = {'type': MessageType.file_offer.value, 'session': entry['session'], 'file': entry['file'],
+                         'size': entry['size'], 'mtime': entry['mtime'], 'chunk_size': self.chunk_size,
+                         'mkdir': mkdir}
+                reply = self._request(control, offer)
+                if reply['status'] == MessageStatus.file_fail.value:
+                    raise IOError(f"Receiver refused {entry['file']}: {reply.get('error')}")
+                if reply['verified'] is None:  # already complete
+                    continue
+                pending.append(entry)
+                for index in set(range(_n_chunks(entry['size'], self.chunk_size))) - set(reply['verified']):
+                    jobs.put((entry, index))
+            n_bytes = [0] * self.n_connections
+            workers = [threading.Thread(target=self._send_chunks, args=(jobs, n_bytes, i), daemon=True)
+                       for i in range(min(self.n_connections, jobs.qsize()))]
+            [worker.start() for worker in workers]
+            [worker.join() for worker in workers]
+            failed = []
+            for entry in pending:
+                done = {'type': MessageType.file_done.value, 'session': entry['session'], 'file': entry['file'],
+                        'mtime': entry['mtime']}
+                if self._request(control, done)['status'] != MessageStatus.file_ok.value:
+                    failed.append(entry['file'])
+        finally:
+            self._close(control)
+        seconds = time.monotonic() - t_start
+        report = {'sent': len(pending) - len(failed), 'skipped': len(files) - len(pending), 'failed': failed,
+                  'bytes': sum(n_bytes), 'seconds': seconds, 'MBps': sum(n_bytes) / 2**20 / max(seconds, 1e-9)}
+        log.info(f"Uploaded {report['sent']} files ({report['skipped']} already there, {len(failed)} failed), "
+                 f"{report['bytes'] / 2**30:.2f} GB at {report['MBps']:.1f} MB/s")
+        return report
+
+    def _send_chunks(self, jobs: Queue, n_bytes: list, worker: int):
+        """sends chunks from the job queue over an own connection, each chunk is tried twice"""
+        try:
+            comm = self._connect()
+        except OSError as e:
+            log.error(f"Could not connect to the transfer receiver: {e}")
+            return
+        try:
+            while True:
+                try:
+                    entry, index = jobs.get_nowait()
+                except Empty:
+                    break
+                for _ in range(2):
+                    if self._send_chunk(comm, entry, index):
+                        n_bytes[worker] += min(self.chunk_size, entry['size'] - index * self.chunk_size)
+                        break
+        except OSError as e:
+            log.error(f"Upload connection failed, the file will be resumed on the next upload: {e}")
+        finally:
+            self._close(comm)
+
+    def _send_chunk(self, comm: SocketComm, entry: dict, index: int) -> bool:
+        offset = index * self.chunk_size
+        length = min(self.chunk_size, entry['size'] - offset)
+        if self.throttle is not None:
+            self.throttle.consume(length)
+        with entry['path'].open('rb') as f:
+            f.seek(offset)
+            sha1 = hashlib.sha1(f.read(length)).hexdigest()
+            comm.send_json_message({'type': MessageType.file_chunk.value, 'session': entry['session'],
+                                    'file': entry['file'], 'index': index, 'offset': offset, 'length': length,
+                                    'sha1': sha1})
+            comm.sock.sendfile(f, offset, length)  # the chunk was just read, so it comes from the page cache
+        reply = comm.read_json_message_fast_linebreak()
+        return bool(reply) and reply.get('status') == MessageStatus.chunk_ok.value
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Transfer of session folders to the data server')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    receive = subparsers.add_parser('receive', help='run the receiver on the data server')
+    receive.add_argument('root', type=Path, help='folder session paths are relative to')
+    receive.add_argument('--port', type=int, default=TRANSFER_PORT)
+    send = subparsers.add_parser('send', help='upload a folder')
+    send.add_argument('src', type=Path, help='folder to upload')
+    send.add_argument('session', help='session folder relative to the root of the receiver')
+    send.add_argument('--host', required=True)
+    send.add_argument('--port', type=int, default=TRANSFER_PORT)
+    send.add_argument('--connections', type=int, default=4)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'receive':
+        receiver = TransferReceiver(args.root, port=args.port)
+        receiver.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            receiver.stop()
+    else:
+        TransferSender(args.host, args.port, n_connections=args.connections).send_folder(args.src, args.session,
+                                                                                         mkdir=True)